@@ -3,3 +3,14 @@ from django.apps import AppConfig
 
 class MainConfig(AppConfig):
     name = 'main'
+
+    def ready(self):
+        """
+        Предварительная генерация таблиц стилей Pygments при старте
+        и подключение замера запросов к БД
+        """
+        from django.db.backends.signals import connection_created
+        from main.highlight import build_stylesheets
+        from main.metrics import install_query_timer
+        build_stylesheets()
+        connection_created.connect(install_query_timer)
@@ -0,0 +1,172 @@
+"""
+Асинхронные варианты view-функций сниппетов для запуска через ASGI
+
+Блокирующая работа - чтение файлов, форматирование и подсветка -
+выполняется в пуле потоков размером ``ASYNC_VIEW_WORKERS``, а одновременные
+запросы одного и того же кода ждут одно выполняющееся задание (:func:`run_once`).
+Код готовится только если ответа нет в кеше страниц и ETag
+не совпадает с ``If-None-Match`` (:func:`check_page`), после чего
+страница строится синхронной view-функцией из :mod:`main.views`.
+Сниппет загружается из БД один раз (:func:`main.views.get_owned_snippet`).
+"""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from main import storage, views
+from main.formatter import get_formatter_classes
+from main.jobs import warm_code
+from main.page_cache import get_cached_response
+from main.workers import FormatterError
+
+executor = ThreadPoolExecutor(max_workers=settings.ASYNC_VIEW_WORKERS,
+                              thread_name_prefix='snippet-io')
+_in_flight = {}
+
+
+async def run_blocking(func, *args):
+    """
+    Выполнение блокирующей функции в пуле потоков
+
+    Функция выполняется в копии контекста вызывающего кода,
+    поэтому замеры этапов (:func:`main.metrics.timed`) попадают в запрос.
+
+    :param func: функция
+    :param args: аргументы функции
+    :return: результат функции
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args))
+
+
+async def run_once(key, func, *args):
+    """
+    Выполнение блокирующей функции не более одного раза одновременно для ключа
+
+    Запросы, пришедшие во время выполнения, ожидают тот же результат.
+    Отмена ожидающего запроса не отменяет само выполнение.
+
+    :param key: ключ задания
+    :param func: функция
+    :param args: аргументы функции
+    :return: результат функции
+    """
+    key = (id(asyncio.get_running_loop()), key)
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(run_blocking(func, *args))
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+    return await asyncio.shield(future)
+
+
+def is_supported_utility(utility):
+    """
+    Проверка, что утилита или цепочка утилит поддерживается
+
+    :param utility: название утилиты или цепочки через ``+``
+    :rtype: :class:`bool`
+    """
+    try:
+        get_formatter_classes(utility)
+    except KeyError:
+        return False
+    return True
+
+
+def check_page(request, snippet_id, utility=None):
+    """
+    Проверка, можно ли ответить на запрос страницы сниппета без чтения файлов
+
+    Сначала ищется страница в кеше страниц, затем ETag сравнивается
+    с ``If-None-Match``: в обоих случаях код не нужно готовить.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :param utility: имя утилиты или ``None`` для исходного кода
+    :return: кортеж (ответ из кеша или ``None``, SHA1-хеш кода, который
+             нужно подготовить, или ``None``)
+    :rtype: :class:`tuple`
+    """
+    record = views.get_owned_snippet(request, snippet_id)
+    if record is None:
+        return None, None  # the sync view redirects to login or answers with 404
+    response = get_cached_response(request)
+    if response is not None:
+        return response, None
+    etag = views.get_page_etag(request, snippet_id, utility)
+    if etag and get_conditional_response(request, etag=quote_etag(etag)) is not None:
+        return None, None  # the sync view answers with 304 from the same ETag
+    return None, record.sha1
+
+
+async def view_snippet_page(request, snippet_id):
+    """
+    Асинхронный вариант :func:`main.views.view_snippet_page`
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :return: объект ответа сервера с HTML-кодом внутри
+    """
+    response, sha1 = await sync_to_async(check_page)(request, snippet_id)
+    if response is not None:
+        return response
+    if sha1:
+        try:
+            await run_once((sha1, None), warm_code, storage.get_filename(sha1))
+        except FileNotFoundError:
+            pass  # the sync view answers with 404
+    return await sync_to_async(views.view_snippet_page)(request, snippet_id)
+
+
+async def view_formatted_code_page(request, snippet_id, utility):
+    """
+    Асинхронный вариант :func:`main.views.view_formatted_code_page`
+
+    Форматирование и подсветка выполняются в пуле потоков,
+    одновременные запросы одного кода и утилиты ждут одно задание.
+    Если включено фоновое форматирование, код не форматируется здесь.
+    На ошибку процесса-форматтера отвечает кодом 503
+    (:func:`main.views.get_formatter_error_response`).
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :param utility: имя утилиты
+    :return: объект ответа сервера с HTML-кодом внутри
+    """
+    response, sha1 = await sync_to_async(check_page)(request, snippet_id, utility)
+    if response is not None:
+        return response
+    if sha1 and is_supported_utility(utility) and not settings.FORMAT_JOBS_ASYNC:
+        try:
+            await run_once((sha1, utility), warm_code, storage.get_filename(sha1), utility)
+        except FileNotFoundError:
+            pass  # the sync view answers with 404
+        except FormatterError:
+            return views.get_formatter_error_response(utility)
+    return await sync_to_async(views.view_formatted_code_page)(request, snippet_id, utility)
+
+
+async def my_snippets_page(request):
+    """
+    Асинхронный вариант :func:`main.views.my_snippets_page`
+
+    Страница не читает файлов, поэтому целиком выполняется
+    в потоке для синхронного кода.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :return: объект ответа сервера с HTML-кодом внутри
+    """
+    return await sync_to_async(views.my_snippets_page)(request)
@@ -0,0 +1,86 @@
+"""
+Первичное заполнение индексов по файлам с кодом
+
+Общая основа команд ``index_symbols`` и ``index_similarity``.
+Сниппеты выбираются пачками по диапазонам ID, поэтому в памяти
+одновременно находится только окно пачек, а запись в индекс
+не влияет на ещё не прочитанную выборку. Чтение файлов и разбор кода
+выполняются в пуле процессов, запись в БД - основным процессом,
+по транзакции на пачку.
+"""
+
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.db import transaction
+
+from main import storage
+
+
+def iter_batches(queryset, batch_size):
+    """
+    Обход сниппетов выборки пачками по возрастанию ID
+
+    :param queryset: выборка сниппетов
+    :param batch_size: количество сниппетов в пачке
+    :return: генератор списков пар (ID сниппета, имя файла с кодом)
+    """
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', 'sha1')[:batch_size])
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [(snippet_id, storage.get_filename(sha1)) for snippet_id, sha1 in rows]
+
+
+def process_files(func, items):
+    """
+    Применение функции к коду пачки файлов в процессе пула
+
+    :param func: функция от кода (должна быть доступна по имени модуля)
+    :param items: список пар (ID сниппета, имя файла с кодом)
+    :return: список пар (ID сниппета, результат функции).
+             Отсутствующие файлы пропускаются
+    :rtype: :class:`list`
+    """
+    result = []
+    for snippet_id, filename in items:
+        try:
+            code = storage.load_code(filename)
+        except FileNotFoundError:
+            continue
+        result.append((snippet_id, func(code)))
+    return result
+
+
+def run_backfill(queryset, func, save, workers=None, batch_size=200):
+    """
+    Вычисление функции от кода сниппетов выборки и запись результатов
+
+    В пул одновременно отправляется не больше двух пачек на процесс.
+
+    :param queryset: выборка сниппетов
+    :param func: функция от кода, выполняемая в пуле процессов
+    :param save: функция записи результата ``save(ID сниппета, результат)``
+    :param workers: количество процессов (по умолчанию - по числу ядер)
+    :param batch_size: количество сниппетов в задании процесса
+    :return: генератор количества обработанных сниппетов после каждого окна заданий
+    """
+    batches = iter_batches(queryset, batch_size)
+    window = (workers or os.cpu_count() or 1) * 2
+    processed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            futures = [executor.submit(functools.partial(process_files, func), batch)
+                       for batch in islice(batches, window)]
+            if not futures:
+                return
+            for future in futures:
+                with transaction.atomic():
+                    for snippet_id, value in future.result():
+                        save(snippet_id, value)
+                        processed += 1
+            yield processed
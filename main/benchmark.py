@@ -0,0 +1,372 @@
+"""
+Замеры производительности полного цикла работы со сниппетами
+
+Замеряются сохранение (:meth:`main.models.Snippet.save`), чтение кода
+(:meth:`main.models.Snippet.get_code`), каждая утилита из
+:data:`main.formatter.AVAILABLE_FORMATTERS`, подсветка и страницы сайта
+(через тестовый клиент Django) на синтетическом наборе сниппетов.
+
+Каждая операция замеряется дважды:
+
+* ``cold`` - после сброса кешей: кеша страниц, кеша подсветки в памяти
+  и всех производных файлов (форматированного кода и HTML);
+* ``warm`` - повторно, с заполненными кешами.
+
+Для каждого прохода считаются пропускная способность и процентили
+задержки, для страниц - также средняя длительность этапов из заголовка
+``Server-Timing`` (:mod:`main.metrics`). Результаты двух запусков
+сравниваются функцией :func:`compare_results`.
+"""
+
+import os
+import platform
+import random
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from main import page_cache, storage
+from main.formatter import AVAILABLE_FORMATTERS
+from main.highlight import get_highlighted_code, get_stylesheet, get_stylesheet_url, highlight_cache
+from main.metrics import QUANTILES
+from main.models import Snippet
+
+PHASES = ('cold', 'warm')
+USERNAME = 'benchmark'
+
+CODE_BLOCKS = (
+    "def {name}( value,count = {number} ):\n"
+    "    '''   Вычисление значения {name}.   '''\n"
+    "    result  =  value * count + {number}\n"
+    "    if result > {number} :\n"
+    "        return  \"{name}: %d\" % result\n"
+    "    return result\n",
+    "class {title}(object):\n"
+    "    def __init__(self,items=None):\n"
+    "        self.items  =  items or []\n"
+    "    def total(self):\n"
+    "        return sum( [item * {number} for item in self.items] )\n",
+    "for index in range( {number} ):\n"
+    "    if index % {modulo} == 0: print( 'index', index )\n",
+)
+
+
+class BenchmarkError(Exception):
+    """
+    Ошибка во время замеров
+    """
+
+
+def generate_code(rng, index, lines):
+    """
+    Генерация синтетического кода сниппета
+
+    Код нарочно оформлен небрежно (лишние импорты, пробелы, кавычки),
+    чтобы утилитам форматирования было что исправлять.
+
+    :param rng: генератор случайных чисел (:class:`random.Random`)
+    :param index: номер сниппета, делает код уникальным
+    :param lines: примерное количество строк
+    :return: код
+    :rtype: :class:`str`
+    """
+    parts = ['import os, sys\nimport re\n# snippet {}\n'.format(index)]
+    size = 3
+    block = 0
+    while size < lines:
+        name = 'func_{}_{}'.format(index, block)
+        part = rng.choice(CODE_BLOCKS).format(name=name, title=name.title().replace('_', ''),
+                                              number=rng.randint(1, 1000), modulo=rng.randint(2, 9))
+        parts.append('\n' + part)
+        size += part.count('\n') + 1
+        block += 1
+    return ''.join(parts)
+
+
+def summarize(durations):
+    """
+    Сводка по замерам одного прохода
+
+    :param durations: список длительностей в секундах
+    :return: словарь с количеством операций, общим временем, пропускной способностью
+             и задержками в миллисекундах (среднее, процентили :data:`main.metrics.QUANTILES`, максимум)
+    :rtype: :class:`dict`
+    """
+    total = sum(durations)
+    ordered = sorted(durations)
+    summary = {
+        'count': len(durations),
+        'total_s': round(total, 6),
+        'ops_per_s': round(len(durations) / total, 3) if total else None,
+        'mean_ms': round(total / len(durations) * 1000, 3) if durations else None,
+    }
+    for quantile in QUANTILES:
+        value = ordered[min(int(quantile * len(ordered)), len(ordered) - 1)] if ordered else None
+        summary['p{}_ms'.format(int(quantile * 100))] = round(value * 1000, 3) if ordered else None
+    summary['max_ms'] = round(ordered[-1] * 1000, 3) if ordered else None
+    return summary
+
+
+def measure(func, items, setup=None):
+    """
+    Замер одного прохода операции по всем элементам
+
+    :param func: операция, вызывается с одним элементом. Может вернуть
+                 словарь этап -> длительность в миллисекундах (``Server-Timing``)
+    :param items: список элементов
+    :param setup: функция без аргументов, вызываемая перед каждой операцией
+                  вне замера, или ``None``
+    :return: сводка :func:`summarize`, при наличии этапов - со средним
+             временем каждого этапа в ``server_timing_ms``
+    :rtype: :class:`dict`
+    """
+    durations = []
+    stages = defaultdict(list)
+    for item in items:
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        timings = func(item)
+        durations.append(time.perf_counter() - start)
+        for stage, duration in (timings if isinstance(timings, dict) else {}).items():
+            stages[stage].append(duration)
+    summary = summarize(durations)
+    if stages:
+        summary['server_timing_ms'] = {stage: round(sum(values) / len(values), 3)
+                                       for stage, values in sorted(stages.items())}
+    return summary
+
+
+def clear_memory_caches():
+    """
+    Сброс кешей в памяти процесса: страниц, подсветки и таблиц стилей
+    """
+    page_cache.get_cache().clear()
+    highlight_cache.clear()
+    get_stylesheet.cache_clear()
+
+
+def reset_caches():
+    """
+    Сброс всех кешей, включая производные файлы в хранилище
+
+    Остаются только файлы с оригинальным кодом сниппетов.
+    """
+    clear_memory_caches()
+    for sha1, path in list(storage.iter_stored_files()):
+        if path != storage.get_filename(sha1):
+            storage.remove_file(path)
+
+
+def parse_server_timing(header):
+    """
+    Разбор заголовка ``Server-Timing``
+
+    :param header: значение заголовка
+    :return: словарь этап -> длительность в миллисекундах
+    :rtype: :class:`dict`
+    """
+    timings = {}
+    for metric in filter(None, (item.strip() for item in header.split(','))):
+        name, _, params = metric.partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                timings[name] = float(value)
+    return timings
+
+
+@contextmanager
+def benchmark_environment():
+    """
+    Окружение для замеров
+
+    Временный ``MEDIA_ROOT``, собственный кеш страниц в памяти процесса
+    и синхронное форматирование без прогрева после сохранения.
+    """
+    caches = {'default': settings.CACHES['default'],
+              settings.PAGE_CACHE_ALIAS: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                          'LOCATION': 'benchmark'}}
+    with tempfile.TemporaryDirectory() as media_root, \
+            override_settings(MEDIA_ROOT=media_root, CACHES=caches, FORMAT_JOBS_ASYNC=False,
+                              WARM_ON_WRITE=False, SNIPPET_STORAGE_LEGACY_LAYOUTS=[],
+                              ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']):
+        yield
+
+
+class Benchmark:
+    """
+    Набор замеров на синтетическом корпусе сниппетов
+
+    Сниппеты и пользователь создаются в текущей БД и в ``MEDIA_ROOT``,
+    поэтому запускать замеры следует на тестовой БД в окружении
+    :func:`benchmark_environment` (так делает команда ``manage.py benchmark``).
+
+    :param snippets: количество сниппетов
+    :param lines: примерное количество строк в сниппете
+    :param seed: начальное значение генератора случайных чисел
+    """
+
+    def __init__(self, snippets, lines, seed):
+        """
+        Конструктор объекта.
+        """
+        self.snippets = snippets
+        self.lines = lines
+        self.seed = seed
+        self.records = []
+        self.results = {}
+
+    def run_phases(self, name, func, items, reset=reset_caches, setup=None):
+        """
+        Замер холодного и тёплого прохода операции
+
+        :param name: название операции в результатах
+        :param func: операция, вызывается с одним элементом
+        :param items: список элементов
+        :param reset: сброс кешей перед холодным проходом
+        :param setup: функция, вызываемая перед каждой операцией холодного прохода
+        """
+        reset()
+        self.results[name] = {'cold': measure(func, items, setup),
+                              'warm': measure(func, items)}
+
+    def bench_save(self, user):
+        """
+        Сохранение: холодный проход создаёт сниппеты с новым кодом,
+        тёплый - сохраняет их повторно без изменения кода
+
+        :param user: владелец сниппетов
+        """
+        rng = random.Random(self.seed)
+        codes = [generate_code(rng, index, self.lines) for index in range(self.snippets)]
+
+        def create(index):
+            record = Snippet(name='benchmark {}'.format(index), creation_date=timezone.now(), user=user)
+            record.code = codes[index]
+            record.save()
+            self.records.append(record)
+
+        self.results['snippet.save'] = {'cold': measure(create, range(self.snippets)),
+                                        'warm': measure(Snippet.save, self.records)}
+
+    def bench_code(self):
+        """
+        Чтение кода, форматирование каждой утилитой и подсветка
+        """
+        self.run_phases('snippet.get_code', Snippet.get_code, self.records)
+        for utility in AVAILABLE_FORMATTERS:
+            self.run_phases('format.{}'.format(utility),
+                            lambda record, utility=utility: record.get_formatted_code(utility),
+                            self.records)
+        self.run_phases('highlight',
+                        lambda record: get_highlighted_code(record.get_filename(), record.get_code),
+                        self.records)
+
+    def bench_views(self, user):
+        """
+        Страницы сайта через тестовый клиент от имени владельца сниппетов
+
+        Страницы отдельных сниппетов запрашиваются по разу для каждого сниппета.
+        Общие страницы запрашиваются столько же раз, а в холодном проходе
+        перед каждым запросом сбрасываются кеши в памяти.
+
+        :param user: владелец сниппетов
+        """
+        client = Client()
+        client.force_login(user)
+
+        def get_request(status):
+            def request(url):
+                response = client.get(url)
+                if response.streaming:
+                    b''.join(response.streaming_content)  # the client closes the response at the end
+                if response.status_code != status:
+                    raise BenchmarkError('{}: код ответа {}'.format(url, response.status_code))
+                return parse_server_timing(response.get('Server-Timing', ''))
+            return request
+
+        common = {
+            'index': reverse('index'),
+            'add_snippet': reverse('add_snippet'),
+            'my_snippets': reverse('my_snippets'),
+            'search': reverse('search') + '?q=return',
+            'symbols': reverse('symbols') + '?kind=import&name=re',
+            'stats': reverse('stats'),
+            'pygments_css': get_stylesheet_url(),
+        }
+        for name, url in common.items():
+            self.run_phases('view.' + name, get_request(200), [url] * len(self.records),
+                            reset=clear_memory_caches, setup=clear_memory_caches)
+        per_snippet = {
+            'view_snippet': (lambda record: reverse('view_snippet', args=[record.id]), 200),
+            'raw_snippet': (lambda record: reverse('raw_snippet', args=[record.id]), 200),
+            'find_snippet_by_hash': (lambda record: reverse('find_snippet_by_hash', args=[record.sha1]), 302),
+        }
+        for utility in AVAILABLE_FORMATTERS:
+            per_snippet['view_format.' + utility] = \
+                (lambda record, utility=utility: reverse('view_format', args=[record.id, utility]), 200)
+        for name, (get_url, status) in per_snippet.items():
+            self.run_phases('view.' + name, get_request(status), [get_url(record) for record in self.records])
+
+    def run(self):
+        """
+        Создание корпуса и выполнение всех замеров
+
+        :return: результаты: параметры запуска, окружение и сводки
+                 по операциям и проходам (см. :func:`summarize`)
+        :rtype: :class:`dict`
+        """
+        user = User.objects.create(username=USERNAME, is_staff=True)  # the stats page is staff-only
+        reset_caches()
+        self.bench_save(user)
+        self.bench_code()
+        self.bench_views(user)
+        clear_memory_caches()
+        return {
+            'started': timezone.now().isoformat(),
+            'parameters': {'snippets': self.snippets, 'lines': self.lines, 'seed': self.seed},
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'database': settings.DATABASES['default']['ENGINE'],
+                'storage_layout': settings.SNIPPET_STORAGE_LAYOUT,
+                'storage_compression': settings.SNIPPET_STORAGE_COMPRESSION,
+                'storage_deltas': settings.SNIPPET_STORAGE_DELTAS,
+                'format_workers': settings.FORMAT_WORKERS,
+            },
+            'results': self.results,
+        }
+
+
+def compare_results(baseline, current, threshold, metric='p50_ms'):
+    """
+    Поиск регрессий относительно предыдущего запуска
+
+    :param baseline: результаты предыдущего запуска
+    :param current: результаты текущего запуска
+    :param threshold: допустимый относительный рост задержки (0.2 - на 20%)
+    :param metric: сравниваемая величина сводки
+    :return: список кортежей (операция, проход, старое значение, новое значение)
+             для операций, замедлившихся больше допустимого
+    :rtype: :class:`list`
+    """
+    regressions = []
+    for name, phases in sorted(current['results'].items()):
+        for phase in PHASES:
+            old = baseline['results'].get(name, {}).get(phase, {}).get(metric)
+            new = phases.get(phase, {}).get(metric)
+            if old and new is not None and new > old * (1 + threshold):
+                regressions.append((name, phase, old, new))
+    return regressions
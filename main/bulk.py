@@ -0,0 +1,378 @@
+"""
+Массовый импорт и экспорт сниппетов
+
+Поддерживаются два формата:
+
+* JSON Lines - по одному объекту ``{"name", "user", "creation_date", "code"}``
+  на строку;
+* tar-архив (в том числе сжатый) - по одному файлу на сниппет.
+  Название, автор и дата создания хранятся в PAX-заголовках
+  ``PYTHONBIN.*``; для архивов без них название берётся из имени файла,
+  дата - из времени изменения.
+
+Данные читаются и пишутся потоково, пачками по ``batch_size`` записей,
+поэтому объём памяти не зависит от размера архива.
+"""
+
+import datetime
+import io
+import json
+import os
+import tarfile
+import uuid
+from collections import defaultdict, namedtuple
+from contextlib import ExitStack
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from main import search, storage
+from main.hashing import get_digests
+from main.models import Blob, Snippet, SnippetBand, SnippetStats, SnippetSymbol
+from main.page_cache import invalidate_user_pages
+from main.similarity import get_buckets, get_signature
+from main.symbols import extract_symbols
+
+FORMATS = ('jsonl', 'tar')
+PAX_PREFIX = 'PYTHONBIN.'
+
+SnippetRecord = namedtuple('SnippetRecord', ['name', 'user', 'creation_date', 'code'])
+PreparedCode = namedtuple('PreparedCode', ['digests', 'minhash', 'symbols'])
+
+
+class SnippetImportError(Exception):
+    """
+    Ошибка в импортируемых данных
+    """
+
+
+def guess_format(path):
+    """
+    Определение формата по имени файла
+
+    :param path: имя файла
+    :return: ``tar`` для архивов, иначе ``jsonl``
+    :rtype: :class:`str`
+    """
+    if path.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+        return 'tar'
+    return 'jsonl'
+
+
+def parse_date(value):
+    """
+    Разбор даты создания
+
+    :param value: дата в формате ISO 8601, объект :class:`datetime.datetime` или ``None``
+    :return: дата с часовым поясом. Для ``None`` - текущее время
+    :rtype: :class:`datetime.datetime`
+    """
+    if not value:
+        return timezone.now()
+    date = value if isinstance(value, datetime.datetime) else parse_datetime(value)
+    if date is None:
+        raise SnippetImportError('Неверная дата: {}'.format(value))
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, datetime.timezone.utc)
+    return date
+
+
+def read_jsonl(stream):
+    """
+    Чтение записей в формате JSON Lines
+
+    :param stream: бинарный поток
+    :return: генератор объектов :class:`SnippetRecord`
+    """
+    for number, line in enumerate(io.TextIOWrapper(stream, encoding='utf8'), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            yield SnippetRecord(item['name'], item.get('user'),
+                                parse_date(item.get('creation_date')), item['code'])
+        except (ValueError, KeyError, TypeError) as error:
+            raise SnippetImportError('Строка {}: {!r}'.format(number, error)) from error
+
+
+def read_tar(stream):
+    """
+    Чтение записей из tar-архива
+
+    :param stream: бинарный поток
+    :return: генератор объектов :class:`SnippetRecord`
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            headers = member.pax_headers
+            code = archive.extractfile(member).read().decode('utf8')
+            name = headers.get(PAX_PREFIX + 'name') or os.path.splitext(os.path.basename(member.name))[0]
+            date = headers.get(PAX_PREFIX + 'creation_date') or \
+                datetime.datetime.fromtimestamp(member.mtime, datetime.timezone.utc)
+            yield SnippetRecord(name, headers.get(PAX_PREFIX + 'user'), parse_date(date), code)
+
+
+def read_records(stream, fmt):
+    """
+    Чтение записей в указанном формате
+
+    :param stream: бинарный поток
+    :param fmt: формат, один из :data:`FORMATS`
+    :return: генератор объектов :class:`SnippetRecord`
+    """
+    return read_tar(stream) if fmt == 'tar' else read_jsonl(stream)
+
+
+def save_code_file(sha1, code):
+    """
+    Запись файла с кодом, если его ещё нет
+
+    Вызывающий код должен удерживать блокировку файла
+    (:func:`main.storage.lock_file`), как и :meth:`main.models.Snippet.save`,
+    иначе сборщик мусора может удалить файл сразу после проверки.
+
+    :param sha1: SHA1-хеш кода
+    :param code: код
+    """
+    path = storage.get_filename(sha1)
+    if not storage.exists(path):
+        storage.save_code(path, code.replace('\r\n', '\n'))
+
+
+def prepare_code(code):
+    """
+    Вычисление хешей, сигнатуры и символов кода и запись файла
+
+    Выполняется в процессе пула, поэтому в основной процесс
+    возвращаются только результаты, а не сам код.
+
+    :param code: код
+    :return: хеши, MinHash-сигнатура и множество символов
+    :rtype: :class:`PreparedCode`
+    """
+    digests = get_digests(code)
+    with storage.lock_file(storage.get_filename(digests.sha1)):
+        save_code_file(digests.sha1, code)
+    return PreparedCode(digests, get_signature(code), extract_symbols(code))
+
+
+def insert_snippets(snippets):
+    """
+    Вставка сниппетов одним запросом с получением их ID
+
+    На СУБД, не возвращающих ID из ``INSERT`` (SQLite), все строки пачки
+    получают общую случайную метку ``import_token``, по которой они
+    и находятся после вставки. Строки с одинаковыми пользователем, хешем
+    и названием различаются только датой создания, поэтому их ID
+    раздаются по порядку.
+
+    :param snippets: список несохранённых объектов :class:`main.models.Snippet`
+    """
+    if not snippets:
+        return
+    token = None
+    if not connection.features.can_return_rows_from_bulk_insert:
+        token = uuid.uuid4()
+        for snippet in snippets:
+            snippet.import_token = token
+    Snippet.objects.bulk_create(snippets)
+    if snippets[0].pk is not None:
+        return
+    rows = Snippet.objects.filter(import_token=token).order_by('id').values_list('id', 'user_id', 'sha1', 'name')
+    ids = defaultdict(list)
+    for pk, *key in rows:
+        ids[tuple(key)].append(pk)
+    for snippet in reversed(snippets):
+        snippet.id = ids[(snippet.user_id, snippet.sha1, snippet.name)].pop()
+
+
+class SnippetImporter:
+    """
+    Потоковый импорт сниппетов пачками
+
+    Хеширование, запись файлов и разбор кода выполняются в пуле процессов,
+    вставка в БД - одной транзакцией на пачку с ``bulk_create``.
+    Счётчики :class:`main.models.Blob`, статистика, поисковый индекс,
+    индекс символов и похожих сниппетов обновляются там же,
+    кеш страниц пользователей сбрасывается после каждой пачки.
+    Авторы проверяются до записи файлов, чтобы ошибка в данных
+    не оставляла файлов без записей :class:`main.models.Blob`.
+    Файлы пачки блокируются до начала транзакции, как в
+    :meth:`main.models.Snippet.save`, чтобы сборщик мусора не удалил их.
+
+    :param executor: пул для :func:`prepare_code` (:class:`concurrent.futures.Executor`)
+    :param batch_size: количество сниппетов в одной транзакции
+    :param default_user: пользователь для записей без автора
+    """
+
+    def __init__(self, executor, batch_size, default_user=None):
+        """
+        Конструктор объекта.
+        """
+        self.executor = executor
+        self.batch_size = batch_size
+        self.default_user = default_user
+        self.users = {}
+
+    def get_user_id(self, username):
+        """
+        Получение ID пользователя по имени с кешированием
+
+        :param username: имя пользователя или ``None``
+        :raises: :class:`SnippetImportError` в случае неизвестного пользователя
+        :return: ID пользователя
+        """
+        if not username:
+            if self.default_user is None:
+                raise SnippetImportError('Не указан пользователь сниппета')
+            return self.default_user.id
+        if username not in self.users:
+            user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+            if user_id is None:
+                raise SnippetImportError('Неизвестный пользователь: {}'.format(username))
+            self.users[username] = user_id
+        return self.users[username]
+
+    def import_batch(self, records):
+        """
+        Импорт одной пачки записей
+
+        :param records: список объектов :class:`SnippetRecord`
+        :return: количество импортированных сниппетов
+        :rtype: :class:`int`
+        """
+        user_ids = [self.get_user_id(record.user) for record in records]
+        prepared = list(self.executor.map(prepare_code, [record.code for record in records]))
+        snippets = [Snippet(name=record.name[:200], creation_date=record.creation_date,
+                            user_id=user_id, sha1=item.digests.sha1,
+                            sha256=item.digests.sha256, md5=item.digests.md5, minhash=item.minhash)
+                    for record, user_id, item in zip(records, user_ids, prepared)]
+        blobs = {}
+        stats = defaultdict(lambda: [0, 0, None])
+        for snippet, item in zip(snippets, prepared):
+            count, size = blobs.get(snippet.sha1, (0, item.digests.size))
+            blobs[snippet.sha1] = (count + 1, size)
+            user_stats = stats[snippet.user_id]
+            user_stats[0] += 1
+            user_stats[1] += item.digests.size
+            user_stats[2] = max(user_stats[2] or snippet.creation_date, snippet.creation_date)
+        codes = {snippet.sha1: record.code for snippet, record in zip(snippets, records)}
+        # the same lock order as Snippet.save and Blob.collect_garbage: files first,
+        # sorted so that concurrent imports do not deadlock, then the transaction
+        with ExitStack() as locks:
+            for sha1 in sorted(codes):
+                locks.enter_context(storage.lock_file(storage.get_filename(sha1)))
+            with transaction.atomic():
+                insert_snippets(snippets)
+                Blob.acquire_many(blobs)
+                # the garbage collector may have removed a file after prepare_code saw it
+                for sha1, code in codes.items():
+                    save_code_file(sha1, code)
+                for user_id, (count, size, last_created) in stats.items():
+                    SnippetStats.record_created(user_id, size, last_created, count)
+                search.index_snippets((snippet.id, record.code) for snippet, record in zip(snippets, records))
+                SnippetSymbol.objects.bulk_create(
+                    [SnippetSymbol(snippet_id=snippet.id, kind=kind, name=name)
+                     for snippet, item in zip(snippets, prepared) for kind, name in sorted(item.symbols)])
+                SnippetBand.objects.bulk_create(
+                    [SnippetBand(snippet_id=snippet.id, bucket=bucket)
+                     for snippet in snippets for bucket in get_buckets(snippet.minhash)])
+        for user_id in stats:
+            invalidate_user_pages(user_id)
+        return len(snippets)
+
+    def run(self, records):
+        """
+        Импорт всех записей
+
+        :param records: итератор объектов :class:`SnippetRecord`
+        :return: генератор количества импортированных сниппетов после каждой пачки
+        """
+        imported = 0
+        records = iter(records)
+        for batch in iter(lambda: list(islice(records, self.batch_size)), []):
+            imported += self.import_batch(batch)
+            yield imported
+
+
+def load_codes(executor, sha1s):
+    """
+    Чтение кода пачки сниппетов в пуле
+
+    :param executor: пул (:class:`concurrent.futures.Executor`)
+    :param sha1s: список SHA1-хешей
+    :return: список кодов. Для отсутствующих файлов - ``None``
+    :rtype: :class:`list`
+    """
+    def load(sha1):
+        try:
+            return storage.load_code(storage.get_filename(sha1))
+        except FileNotFoundError:
+            return None
+    return list(executor.map(load, sha1s))
+
+
+def iter_export_records(queryset, executor, batch_size):
+    """
+    Потоковое чтение сниппетов для экспорта
+
+    :param queryset: выборка сниппетов
+    :param executor: пул для чтения файлов
+    :param batch_size: количество одновременно читаемых файлов
+    :return: генератор объектов :class:`SnippetRecord`. Сниппеты без файлов пропускаются
+    """
+    rows = queryset.order_by('id').values_list('name', 'user__username', 'creation_date', 'sha1') \
+        .iterator(chunk_size=batch_size)
+    for batch in iter(lambda: list(islice(rows, batch_size)), []):
+        codes = load_codes(executor, [row[3] for row in batch])
+        for (name, username, creation_date, _), code in zip(batch, codes):
+            if code is not None:
+                yield SnippetRecord(name, username, creation_date, code)
+
+
+def write_jsonl(stream, records):
+    """
+    Запись сниппетов в формате JSON Lines
+
+    :param stream: бинарный поток
+    :param records: итератор объектов :class:`SnippetRecord`
+    :return: количество записанных сниппетов
+    :rtype: :class:`int`
+    """
+    count = 0
+    for record in records:
+        item = {'name': record.name, 'user': record.user,
+                'creation_date': record.creation_date.isoformat(), 'code': record.code}
+        stream.write(json.dumps(item, ensure_ascii=False).encode('utf8') + b'\n')
+        count += 1
+    return count
+
+
+def write_tar(stream, records, compression=''):
+    """
+    Запись сниппетов в tar-архив
+
+    :param stream: бинарный поток
+    :param records: итератор объектов :class:`SnippetRecord`
+    :param compression: ``''``, ``gz``, ``bz2`` или ``xz``
+    :return: количество записанных сниппетов
+    :rtype: :class:`int`
+    """
+    count = 0
+    with tarfile.open(fileobj=stream, mode='w|' + compression, format=tarfile.PAX_FORMAT) as archive:
+        for record in records:
+            count += 1
+            data = record.code.encode('utf8')
+            info = tarfile.TarInfo('{:08d}.py'.format(count))
+            info.size = len(data)
+            info.mtime = record.creation_date.timestamp()
+            info.pax_headers = {PAX_PREFIX + 'name': record.name,
+                                PAX_PREFIX + 'user': record.user or '',
+                                PAX_PREFIX + 'creation_date': record.creation_date.isoformat()}
+            archive.addfile(info, io.BytesIO(data))
+    return count
@@ -0,0 +1,26 @@
+"""
+Контекстные процессоры шаблонов
+"""
+
+from django.utils.functional import SimpleLazyObject
+
+from main.models import SnippetStats
+
+
+def snippet_stats(request):
+    """
+    Добавление статистики сниппетов пользователя в контекст шаблонов
+
+    Статистика загружается из БД только при обращении к ней в шаблоне.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :return: словарь с ключом ``snippet_stats``
+    (``None`` для неавторизованного пользователя)
+    :rtype: :class:`dict`
+    """
+    def get_stats():
+        if not request.user.is_authenticated:
+            return None
+        return SnippetStats.for_user(request.user)
+    return {'snippet_stats': SimpleLazyObject(get_stats)}
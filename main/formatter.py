@@ -2,9 +2,14 @@
 Классы для работы с утилитами автоформатирования кода
 """
 
-import os
-from shutil import copyfile
+import autoflake
 import autopep8
+import docformatter
+import unify
+
+from main import storage
+from main.metrics import timed
+from main.workers import run_formatter
 
 
 class BaseFormatter:
@@ -55,7 +60,7 @@ class BaseFormatter:
         :return: логическое значение
         :rtype: :class:`bool`
         """
-        return os.path.exists(self.get_formatted_code_name())
+        return storage.exists(self.get_formatted_code_name())
 
     @staticmethod
     def get_code_from_file(filename):
@@ -66,29 +71,54 @@ class BaseFormatter:
         :return: код, хранящийся в файле.
         :rtype: :class:`str`
         """
-        with open(filename, 'r') as file:
-            code = file.read()
-        return code
+        with timed('read'):
+            return storage.load_code(filename)
 
-    def save_formatted_code_to_file(self):
+    @classmethod
+    def format_code(cls, code):
         """
-        Сохранение отформатированного утилитой кода в файл.
+        Форматирование кода утилитой.
         Заготовка для наследных классов
 
+        :param code: исходный код
         :raises: :class:`NotImplementedError` ибо это всего лишь прототип.
         """
         raise NotImplementedError
 
+    def save_formatted_code_to_file(self):
+        """
+        Сохранение отформатированного утилитой кода в файл
+
+        Утилита вызывается через программный интерфейс без запуска
+        командной оболочки: в пуле процессов :mod:`main.workers`
+        или, если пул отключён, в текущем процессе.
+
+        :return: форматированный код.
+        :rtype: :class:`str`
+        """
+        code = self.get_code_from_file(self.filename)
+        with timed('format'):
+            fixed_code = run_formatter(type(self), code)
+        storage.save_code(self.get_formatted_code_name(), fixed_code, base=self.filename)
+        return fixed_code
+
     def get_formatted_code(self):
         """
         Получение форматированного кода на основе
         имеющегося имени файла с оригинальным кодом.
 
+        Одновременные запросы одного кода и утилиты из разных потоков
+        и процессов запускают утилиту один раз (:func:`main.storage.lock_file`):
+        остальные дожидаются записи файла и читают его.
+
         :return: форматированный код.
         :rtype: :class:`str`
         """
         if not self.formatted_code_exists():
-            self.save_formatted_code_to_file()
+            with storage.lock_file(self.get_formatted_code_name()):
+                # another thread or process may have finished while we waited
+                if not self.formatted_code_exists():
+                    return self.save_formatted_code_to_file()
         return self.get_code_from_file(self.get_formatted_code_name())
 
 
@@ -100,55 +130,19 @@ class Pep8Formatter(BaseFormatter):
     """
     UTILITY = 'autopep8'
 
-    def save_formatted_code_to_file(self):
-        """
-        Сохранение отформатированного через autopep8 кода в файл
-
-        Утилита вызывается через программный интерфейс
+    @classmethod
+    def format_code(cls, code):
         """
-        with open(self.filename, 'r') as file:
-            self.code = file.read()
-        fixed_code = autopep8.fix_code(self.code, options={'aggressive': 1})
-        with open(self.get_formatted_code_name(), 'w') as file:
-            file.write(fixed_code)
-
-
-class CommandLineFormatter(BaseFormatter):
-    """
-    Базовый класс для всех утилит, работающих из командной строки.
-
-    :param OPTS: параметры запуска утилиты
-    (все, кроме имени обрабатываемого файла)
-    """
-    OPTS = ''
+        Форматирование кода через autopep8
 
-    def __init__(self, filename):
-        """
-        Конструктор объекта.
-
-        В ходе работы пытается импортировать утилиту в виде python-модуля
-        :raises: :class:`ModuleNotFoundError` в случае,
-        если утилита не установлена.
-        """
-        super().__init__(filename)
-        __import__(self.UTILITY)
-
-    def save_formatted_code_to_file(self):
-        """
-        Сохранение кода, отформатированного через консольную утилиту, в файл
-
-        Формат работы: исходный код сначала копируется в результирующий файл,
-        затем над ним производятся требуемые действия
+        :param code: исходный код
+        :return: форматированный код
+        :rtype: :class:`str`
         """
-        copyfile(self.filename, self.get_formatted_code_name())
-        os.system('{} {} {}'.format(
-            self.UTILITY,
-            self.OPTS,
-            self.get_formatted_code_name()
-        ))
+        return autopep8.fix_code(code, options={'aggressive': 1})
 
 
-class DocFormatter(CommandLineFormatter):
+class DocFormatter(BaseFormatter):
     """
     Класс, форматирующий код через docformatter
 
@@ -156,29 +150,61 @@ class DocFormatter(CommandLineFormatter):
     в соответствие с рекомендациям PEP257
     """
     UTILITY = 'docformatter'
-    OPTS = '--pre-summary-newline --in-place'
 
+    @classmethod
+    def format_code(cls, code):
+        """
+        Форматирование кода через docformatter
 
-class AutoFlakeFormatter(CommandLineFormatter):
+        :param code: исходный код
+        :return: форматированный код
+        :rtype: :class:`str`
+        """
+        return docformatter.format_code(code, pre_summary_newline=True)
+
+
+class AutoFlakeFormatter(BaseFormatter):
     """
     Класс, форматирующий код через autoflake
 
     autoflake - утилита, чистящая код от неиспользуемых импортов и переменных
     """
     UTILITY = 'autoflake'
-    OPTS = '--remove-all-unused-imports ' \
-           '--remove-duplicate-keys ' \
-           '--remove-unused-variables ' \
-           '--in-place'
 
-class UnifyFormatter(CommandLineFormatter):
+    @classmethod
+    def format_code(cls, code):
+        """
+        Форматирование кода через autoflake
+
+        :param code: исходный код
+        :return: форматированный код
+        :rtype: :class:`str`
+        """
+        return autoflake.fix_code(code,
+                                  remove_all_unused_imports=True,
+                                  remove_duplicate_keys=True,
+                                  remove_unused_variables=True)
+
+
+class UnifyFormatter(BaseFormatter):
     """
     Класс, форматирующий код через Unify
 
     Unify - утилита, приводящая в соответсвие строки кода
     """
     UTILITY = 'unify'
-    OPTS = '--in-place'
+
+    @classmethod
+    def format_code(cls, code):
+        """
+        Форматирование кода через unify
+
+        :param code: исходный код
+        :return: форматированный код
+        :rtype: :class:`str`
+        """
+        return unify.format_code(code)
+
 
 AVAILABLE_FORMATTERS = {
     'pep8': Pep8Formatter,
@@ -186,3 +212,118 @@ AVAILABLE_FORMATTERS = {
     'autoflake': AutoFlakeFormatter,
     'unify': UnifyFormatter
 }
+
+PIPELINE_SEPARATOR = '+'
+
+
+class FormatterPipeline(BaseFormatter):
+    """
+    Цепочка форматтеров, применяемых последовательно
+
+    Входом каждого шага служит файл с результатом предыдущего шага
+    ``<sha1>_<утилита>_<утилита>.py``, поэтому результаты шагов кешируются
+    и переиспользуются цепочками с общим началом. Итогом цепочки служит
+    файл последнего шага. Все файлы шагов начинаются с хеша оригинала
+    и удаляются вместе с ним сборщиком мусора
+    (:meth:`main.models.Blob.collect_garbage`).
+
+    :param formatters: список классов форматтеров
+    """
+
+    def __init__(self, filename, formatters):
+        """
+        Конструктор объекта.
+
+        :param filename: имя оригинального файла
+        :param formatters: список классов форматтеров в порядке применения
+        """
+        super().__init__(filename)
+        self.formatters = formatters
+        self.UTILITY = PIPELINE_SEPARATOR.join(  # pylint: disable=invalid-name
+            formatter.UTILITY for formatter in formatters)
+
+    def get_steps(self):
+        """
+        Получение форматтеров шагов цепочки
+
+        :return: список объектов форматтеров, каждый из которых
+                 читает файл предыдущего шага
+        :rtype: :class:`list`
+        """
+        steps = []
+        filename = self.filename
+        for formatter in self.formatters:
+            steps.append(formatter(filename))
+            filename = steps[-1].get_formatted_code_name()
+        return steps
+
+    def get_formatted_code_name(self):
+        """
+        Получение имени файла с итогом цепочки - файла последнего шага
+
+        :return: имя файла
+        :rtype: :class:`str`
+        """
+        return self.get_steps()[-1].get_formatted_code_name()
+
+    def get_formatted_code(self):
+        """
+        Последовательный запуск всех форматтеров цепочки
+
+        Каждый шаг сам пропускает уже выполненную работу
+        и запускает утилиту не более одного раза одновременно.
+
+        :return: форматированный код.
+        :rtype: :class:`str`
+        """
+        code = None
+        for step in self.get_steps():
+            code = step.get_formatted_code()
+        return code
+
+    def save_formatted_code_to_file(self):
+        """
+        Запуск цепочки: файл с итогом записывает последний шаг
+
+        :return: форматированный код.
+        :rtype: :class:`str`
+        """
+        return self.get_formatted_code()
+
+
+def get_formatter_classes(utility):
+    """
+    Получение классов форматтеров по названию утилиты или цепочки утилит
+
+    Утилиты в цепочке не повторяются, поэтому её длина не превышает
+    количества поддерживаемых утилит.
+
+    :param utility: название утилиты или цепочки через ``+``
+    :raises: :class:`KeyError` в случае, если утилита не поддерживается
+             или повторяется в цепочке
+    :return: список классов форматтеров
+    :rtype: :class:`list`
+    """
+    names = utility.split(PIPELINE_SEPARATOR)
+    if len(set(names)) != len(names):
+        raise KeyError(utility)
+    return [AVAILABLE_FORMATTERS[name] for name in names]
+
+
+def get_formatter(filename, utility):
+    """
+    Создание форматтера по названию утилиты или цепочки утилит
+
+    Цепочка записывается через ``+``, например ``autoflake+docformatter+pep8``.
+
+    :param filename: имя оригинального файла
+    :param utility: название утилиты или цепочки
+    :raises: :class:`KeyError` в случае, если утилита не поддерживается
+             или повторяется в цепочке
+    :return: объект форматтера
+    :rtype: :class:`BaseFormatter`
+    """
+    formatters = get_formatter_classes(utility)
+    if len(formatters) == 1:
+        return formatters[0](filename)
+    return FormatterPipeline(filename, formatters)
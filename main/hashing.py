@@ -0,0 +1,36 @@
+"""
+Вычисление хешей кода сниппетов
+
+Код кодируется в UTF-8 один раз, после чего все хеши
+вычисляются за один проход по общему буферу (:class:`memoryview`)
+кусками по ``CHUNK_SIZE`` байт. При массовом импорте хеши
+вычисляются в пуле процессов вместе с разбором кода
+(:func:`main.bulk.prepare_code`).
+"""
+
+import hashlib
+from collections import namedtuple
+
+CHUNK_SIZE = 1024 * 1024
+
+Digests = namedtuple('Digests', ['md5', 'sha1', 'sha256', 'size'])
+
+
+def get_digests(code):
+    """
+    Получение MD5-, SHA1- и SHA256-хешей кода за один проход
+
+    :param code: код
+    :type code: :class:`str`
+    :return: хеши в виде строк и размер кода в байтах
+    :rtype: :class:`Digests`
+    """
+    data = memoryview(code.encode('utf8'))
+    md5, sha1, sha256 = hashlib.md5(), hashlib.sha1(), hashlib.sha256()
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        md5.update(chunk)
+        sha1.update(chunk)
+        sha256.update(chunk)
+    return Digests(md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest(), len(data))
+
@@ -0,0 +1,289 @@
+"""
+Подсветка синтаксиса кода сниппетов
+
+Результат работы Pygments кешируется на двух уровнях:
+LRU-словарь внутри процесса и HTML-файлы в отдельном каталоге
+``MEDIA_ROOT/highlight/`` (``ab/<sha1>.<отпечаток>.html``,
+``ab/<sha1>_<utility>.<отпечаток>.html``). Размер каталога считается
+один раз на процесс и затем ведётся по мере записи, а обход
+при вытеснении затрагивает только HTML-файлы, но не файлы кода.
+
+Таблицы стилей генерируются один раз на процесс и отдаются
+по адресам с отпечатком содержимого, что позволяет кешировать их в браузере.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import pygments
+from django.conf import settings
+from django.urls import reverse
+from pygments import highlight
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers.python import PythonLexer
+from pygments.styles import get_all_styles
+
+from main import storage
+from main.metrics import timed
+
+
+def get_formatter_options():
+    """
+    Получение параметров HTML-форматтера Pygments из настроек проекта
+
+    :return: словарь параметров для :class:`pygments.formatters.html.HtmlFormatter`
+    :rtype: :class:`dict`
+    """
+    options = {'style': settings.PYGMENTS_STYLE}
+    options.update(settings.PYGMENTS_FORMATTER_OPTIONS)
+    return options
+
+
+def get_options_fingerprint():
+    """
+    Получение отпечатка параметров подсветки
+
+    Отпечаток входит в ключ кеша, поэтому смена стиля, параметров
+    или версии Pygments не приводит к выдаче устаревшего HTML.
+
+    :return: первые 12 символов SHA1-хеша параметров
+    :rtype: :class:`str`
+    """
+    raw = '{}:{}'.format(pygments.__version__,
+                         sorted(get_formatter_options().items()))
+    return hashlib.sha1(raw.encode('utf8')).hexdigest()[:12]
+
+
+class HighlightCache:
+    """
+    Кеш подсвеченного HTML-кода
+
+    Ключом служит имя файла с кодом (а значит, SHA1-хеш сниппета и утилита)
+    вместе с отпечатком параметров подсветки. Сниппеты неизменяемы,
+    поэтому записи кеша никогда не устаревают и лишь вытесняются.
+
+    :param max_entries: количество записей в памяти процесса
+    :param disk_limit: суммарный размер HTML-файлов на диске в байтах
+    """
+
+    def __init__(self, max_entries, disk_limit):
+        """
+        Конструктор объекта.
+
+        :param max_entries: количество записей в памяти процесса
+        :param disk_limit: суммарный размер HTML-файлов на диске в байтах
+        """
+        self.max_entries = max_entries
+        self.disk_limit = disk_limit
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_usage = None
+
+    @staticmethod
+    def get_html_name(filename):
+        """
+        Получение имени HTML-файла для файла с кодом
+
+        :param filename: имя файла с кодом
+        :return: имя файла с подсвеченным кодом
+        :rtype: :class:`str`
+        """
+        name = os.path.basename(filename)
+        return os.path.join(storage.get_html_dir(name),
+                            '{}.{}.html'.format(name[:-3], get_options_fingerprint()))
+
+    def get_from_memory(self, key):
+        """
+        Получение записи из памяти процесса с обновлением её позиции в LRU
+
+        :param key: ключ записи
+        :return: HTML-код или ``None``
+        """
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+            return html
+
+    def put_to_memory(self, key, html):
+        """
+        Сохранение записи в памяти процесса с вытеснением самых старых
+
+        :param key: ключ записи
+        :param html: HTML-код
+        """
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save_to_disk(self, path, html):
+        """
+        Атомарная запись HTML-файла с последующим контролем размера кеша
+
+        :param path: имя HTML-файла
+        :param html: HTML-код
+        """
+        data = html.encode('utf8')
+        storage.write_file(path, data)
+        with self.lock:
+            if self.disk_usage is None:
+                self.disk_usage = self.scan_disk_usage()
+            else:
+                self.disk_usage += len(data)
+            overflow = self.disk_usage > self.disk_limit
+        if overflow:
+            self.evict()
+
+    @staticmethod
+    def list_html_files():
+        """
+        Получение списка HTML-файлов кеша
+
+        :return: список кортежей (время изменения, размер, имя файла)
+        :rtype: :class:`list`
+        """
+        files = []
+        for root, _, names in os.walk(os.path.join(settings.MEDIA_ROOT, storage.HTML_DIR)):
+            for name in names:
+                if not name.endswith('.html'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def scan_disk_usage(self):
+        """
+        Подсчёт суммарного размера HTML-файлов кеша
+
+        :return: размер в байтах
+        :rtype: :class:`int`
+        """
+        return sum(size for _, size, _ in self.list_html_files())
+
+    def evict(self):
+        """
+        Удаление самых старых HTML-файлов до тех пор,
+        пока кеш не займёт не более 90% от допустимого размера
+        """
+        files = sorted(self.list_html_files())
+        usage = sum(size for _, size, _ in files)
+        target = self.disk_limit * 0.9
+        for _, size, path in files:
+            if usage <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            usage -= size
+        with self.lock:
+            self.disk_usage = usage
+
+    def get_highlighted_code(self, filename, get_code):
+        """
+        Получение подсвеченного кода
+
+        Порядок поиска: память процесса, HTML-файл на диске,
+        и только затем запуск Pygments.
+
+        :param filename: имя файла с кодом
+        :param get_code: функция без аргументов, возвращающая код.
+                         Вызывается только при промахе кеша
+        :return: HTML-код
+        :rtype: :class:`str`
+        """
+        path = self.get_html_name(filename)
+        html = self.get_from_memory(path)
+        if html is not None:
+            return html
+        try:
+            with open(path, 'r', encoding='utf8') as file:
+                html = file.read()
+        except FileNotFoundError:
+            code = get_code()
+            with timed('highlight'):
+                html = highlight(code, PythonLexer(), HtmlFormatter(**get_formatter_options()))
+            self.save_to_disk(path, html)
+        self.put_to_memory(path, html)
+        return html
+
+    def clear(self):
+        """
+        Очистка кеша в памяти процесса
+        """
+        with self.lock:
+            self.entries.clear()
+            self.disk_usage = None
+
+
+highlight_cache = HighlightCache(settings.HIGHLIGHT_CACHE_SIZE,
+                                 settings.HIGHLIGHT_CACHE_DISK_LIMIT)
+
+
+def get_highlighted_code(filename, get_code):
+    """
+    Получение подсвеченного кода через общий кеш процесса
+
+    :param filename: имя файла с кодом
+    :param get_code: функция без аргументов, возвращающая код
+    :return: HTML-код
+    :rtype: :class:`str`
+    """
+    return highlight_cache.get_highlighted_code(filename, get_code)
+
+
+@lru_cache(maxsize=None)
+def get_stylesheet(style):
+    """
+    Генерация таблицы стилей Pygments
+
+    Результат запоминается, поэтому CSS для каждого стиля
+    строится не более одного раза за время жизни процесса.
+
+    :param style: название стиля Pygments
+    :return: кортеж (CSS-код, отпечаток содержимого)
+    :rtype: :class:`tuple`
+    """
+    css = HtmlFormatter(style=style).get_style_defs('.highlight')
+    return css, hashlib.sha1(css.encode('utf8')).hexdigest()[:12]
+
+
+def get_available_styles():
+    """
+    Получение списка поддерживаемых стилей Pygments
+
+    :return: множество названий стилей
+    :rtype: :class:`set`
+    """
+    return set(get_all_styles())
+
+
+def build_stylesheets():
+    """
+    Предварительная генерация таблиц стилей для всех поддерживаемых стилей
+    """
+    for style in get_available_styles():
+        get_stylesheet(style)
+
+
+def get_stylesheet_url(style=None):
+    """
+    Получение адреса таблицы стилей с отпечатком содержимого
+
+    :param style: название стиля. По умолчанию - стиль из настроек проекта
+    :return: адрес таблицы стилей
+    :rtype: :class:`str`
+    """
+    style = style or settings.PYGMENTS_STYLE
+    _, fingerprint = get_stylesheet(style)
+    return reverse('pygments_css', kwargs={'style': style,
+                                           'fingerprint': fingerprint})
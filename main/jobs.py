@@ -0,0 +1,243 @@
+"""
+Фоновая очередь заданий на форматирование кода
+
+Задания хранятся в модели :class:`main.models.FormatJob`,
+а выполняются ограниченным пулом процессов
+в команде ``manage.py format_worker``.
+
+Если включена настройка ``WARM_ON_WRITE``, после сохранения сниппета
+все варианты его кода форматируются и подсвечиваются заранее
+(:func:`schedule_warm_up`): через очередь, если включено фоновое
+форматирование, иначе - в фоновом потоке веб-процесса.
+"""
+
+import datetime
+import itertools
+import queue
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from main import storage
+from main.formatter import AVAILABLE_FORMATTERS, get_formatter
+from main.highlight import HighlightCache, get_highlighted_code
+from main.models import FormatJob
+
+
+def job_output_exists(sha1, utility):
+    """
+    Проверка наличия результата задания на диске
+
+    :param sha1: SHA1-хеш форматируемого кода
+    :param utility: название утилиты. Пустая строка - подсветка оригинального кода
+    :return: логическое значение. Для неподдерживаемой утилиты - ``True``,
+             такое задание перезапускать бессмысленно
+    :rtype: :class:`bool`
+    """
+    filename = storage.get_filename(sha1)
+    if not utility:
+        return storage.exists(HighlightCache.get_html_name(filename))
+    try:
+        return get_formatter(filename, utility).formatted_code_exists()
+    except KeyError:
+        return True
+
+
+def enqueue_format_job(sha1, utility, priority=FormatJob.PRIORITY_REQUESTED):
+    """
+    Постановка задания на форматирование в очередь
+
+    Повторная постановка того же задания не создаёт дубликатов,
+    но может повысить приоритет ожидающего задания.
+    Завершившееся с ошибкой задание, а также выполненное задание,
+    чей результат уже удалён с диска (например, сборщиком мусора),
+    возвращается в очередь условным UPDATE.
+
+    :param sha1: SHA1-хеш форматируемого кода
+    :param utility: название утилиты. Пустая строка - подсветка оригинального кода
+    :param priority: приоритет задания
+    :return: объект задания
+    :rtype: :class:`main.models.FormatJob`
+    """
+    job, created = FormatJob.objects.get_or_create(sha1=sha1, utility=utility,
+                                                   defaults={'priority': priority})
+    if created:
+        return job
+    if job.status == FormatJob.FAILED or \
+            (job.status == FormatJob.DONE and not job_output_exists(sha1, utility)):
+        if FormatJob.objects.filter(id=job.id, status=job.status) \
+                .update(status=FormatJob.PENDING, error='', updated=timezone.now()):
+            job.status, job.error = FormatJob.PENDING, ''
+    if job.priority < priority:
+        FormatJob.objects.filter(id=job.id, priority__lt=priority).update(priority=priority)
+    return job
+
+
+def format_file(filename, utility):
+    """
+    Форматирование и подсветка файла указанной утилитой
+
+    Выполняется в процессе пула, поэтому не обращается к БД.
+
+    :param filename: имя файла с оригинальным кодом
+    :param utility: название утилиты или цепочки утилит.
+                    Пустая строка - только подсветка оригинального кода
+    """
+    warm_code(filename, utility or None)
+
+
+def warm_code(filename, utility=None):
+    """
+    Подготовка кода к показу: форматирование (если указана утилита)
+    и подсветка синтаксиса с сохранением результатов в кеши
+
+    :param filename: имя файла с оригинальным кодом
+    :param utility: название утилиты или цепочки утилит.
+                    ``None`` - подсветить оригинальный код
+    :raises: :class:`KeyError` в случае, если утилита не поддерживается
+    """
+    if utility is None:
+        get_highlighted_code(filename, lambda: storage.load_code(filename))
+        return
+    formatter = get_formatter(filename, utility)
+    code = formatter.get_formatted_code()
+    get_highlighted_code(formatter.get_formatted_code_name(), lambda: code)
+
+
+def claim_pending_jobs(limit):
+    """
+    Захват ожидающих заданий
+
+    Задания выбираются по убыванию приоритета, затем в порядке постановки.
+    Задание переводится в состояние «выполняется» условным UPDATE,
+    поэтому одно задание не достанется двум обработчикам.
+
+    :param limit: максимальное количество заданий
+    :return: список захваченных заданий
+    :rtype: :class:`list`
+    """
+    claimed = []
+    pending = FormatJob.objects.filter(status=FormatJob.PENDING).order_by('-priority', 'created')
+    for job in pending[:limit]:
+        updated = FormatJob.objects.filter(id=job.id, status=FormatJob.PENDING) \
+            .update(status=FormatJob.RUNNING, updated=timezone.now())
+        if updated:
+            claimed.append(job)
+    return claimed
+
+
+def release_stale_jobs():
+    """
+    Возврат в очередь заданий, зависших в состоянии «выполняется»
+    дольше ``FORMAT_JOB_TIMEOUT`` секунд (например, после падения обработчика)
+
+    :return: количество возвращённых заданий
+    :rtype: :class:`int`
+    """
+    deadline = timezone.now() - datetime.timedelta(seconds=settings.FORMAT_JOB_TIMEOUT)
+    return FormatJob.objects.filter(status=FormatJob.RUNNING, updated__lt=deadline) \
+        .update(status=FormatJob.PENDING)
+
+
+def process_pending_jobs(executor, limit):
+    """
+    Выполнение пачки ожидающих заданий
+
+    :param executor: пул исполнителей (:class:`concurrent.futures.Executor`)
+    :param limit: максимальное количество заданий в пачке
+    :return: количество обработанных заданий
+    :rtype: :class:`int`
+    """
+    jobs = claim_pending_jobs(limit)
+    futures = [(job, executor.submit(format_file, job.get_filename(), job.utility))
+               for job in jobs]
+    for job, future in futures:
+        try:
+            future.result(timeout=settings.FORMAT_JOB_TIMEOUT)
+        except Exception as error:  # pylint: disable=broad-except
+            job.status = FormatJob.FAILED
+            job.error = repr(error)
+        else:
+            job.status = FormatJob.DONE
+            job.error = ''
+        job.save(update_fields=['status', 'error', 'updated'])
+    return len(jobs)
+
+
+def get_warm_up_utilities():
+    """
+    Получение списка вариантов кода для прогрева в порядке убывания приоритета
+
+    Первым идёт оригинальный код (пустая строка), затем утилиты
+    в порядке кнопок на странице сниппета.
+
+    :rtype: :class:`list`
+    """
+    return [''] + list(AVAILABLE_FORMATTERS)
+
+
+class BackgroundWarmer:
+    """
+    Прогрев кешей в фоновом потоке веб-процесса
+
+    Задания упорядочены по приоритету (:class:`queue.PriorityQueue`),
+    при равном приоритете - по времени постановки. Поток запускается
+    при первом задании и работает до завершения процесса.
+    """
+
+    def __init__(self):
+        """
+        Конструктор объекта.
+        """
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, filename, utility, priority):
+        """
+        Постановка задания
+
+        :param filename: имя файла с оригинальным кодом
+        :param utility: название утилиты или ``None`` для оригинального кода
+        :param priority: приоритет задания
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='snippet-warmer', daemon=True)
+                self.thread.start()
+        self.queue.put((-priority, next(self.counter), filename, utility))
+
+    def run(self):
+        """
+        Основной цикл потока
+        """
+        while True:
+            _, _, filename, utility = self.queue.get()
+            try:
+                warm_code(filename, utility)
+            except Exception:  # pylint: disable=broad-except
+                pass  # best effort: the page formats the code on demand
+            finally:
+                self.queue.task_done()
+
+
+warmer = BackgroundWarmer()
+
+
+def schedule_warm_up(sha1):
+    """
+    Планирование форматирования и подсветки всех вариантов кода
+
+    Вызывается после фиксации транзакции сохранения сниппета.
+
+    :param sha1: SHA1-хеш оригинального кода
+    """
+    utilities = get_warm_up_utilities()
+    for index, utility in enumerate(utilities):
+        priority = FormatJob.PRIORITY_WARM_UP + len(utilities) - index
+        if settings.FORMAT_JOBS_ASYNC:
+            enqueue_format_job(sha1, utility, priority)
+        else:
+            warmer.submit(storage.get_filename(sha1), utility or None, priority)
@@ -0,0 +1,70 @@
+"""
+Команда замеров производительности
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from main.benchmark import Benchmark, BenchmarkError, benchmark_environment, compare_results
+
+
+class Command(BaseCommand):
+    """
+    Замеры производительности на синтетическом наборе сниппетов
+
+    Как и тесты, замеры выполняются на отдельной тестовой БД, которая
+    создаётся миграциями и удаляется по окончании, и во временном
+    ``MEDIA_ROOT``, поэтому данные сайта не меняются и основная БД
+    не блокируется. Кеш страниц на время замеров заменяется кешем в памяти.
+    Результаты записываются в JSON; с ``--compare`` они сравниваются
+    с предыдущим запуском, и при замедлении больше ``--threshold``
+    команда завершается с ошибкой.
+
+    Пример: ``python manage.py benchmark --snippets 200 --output new.json --compare old.json``
+    """
+    help = 'Замеры производительности сохранения, форматирования, подсветки и страниц'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--snippets', type=int, default=100,
+                            help='количество сниппетов в наборе')
+        parser.add_argument('--lines', type=int, default=40,
+                            help='примерное количество строк в сниппете')
+        parser.add_argument('--seed', type=int, default=1,
+                            help='начальное значение генератора случайных чисел')
+        parser.add_argument('--output', default='-',
+                            help='файл результатов или "-" для стандартного вывода')
+        parser.add_argument('--compare', default=None,
+                            help='файл результатов предыдущего запуска')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='допустимый рост медианной задержки (0.2 - на 20%%)')
+
+    def handle(self, *args, **options):
+        if options['snippets'] < 1:
+            raise CommandError('Количество сниппетов должно быть положительным')
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf8') as file:
+                baseline = json.load(file)
+        benchmark = Benchmark(options['snippets'], options['lines'], options['seed'])
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with benchmark_environment():
+                results = benchmark.run()
+        except BenchmarkError as error:
+            raise CommandError(error)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+        data = json.dumps(results, ensure_ascii=False, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(data)
+        else:
+            with open(options['output'], 'w', encoding='utf8') as file:
+                file.write(data + '\n')
+        if baseline is not None:
+            regressions = compare_results(baseline, results, options['threshold'])
+            for name, phase, old, new in regressions:
+                self.stderr.write('{} ({}): {:.3f} мс -> {:.3f} мс'.format(name, phase, old, new))
+            if regressions:
+                raise CommandError('Обнаружены регрессии: {}'.format(len(regressions)))
@@ -0,0 +1,38 @@
+"""
+Команда сборки мусора в хранилище кода
+"""
+
+from django.core.management.base import BaseCommand
+
+from main import storage
+from main.models import Blob
+
+
+class Command(BaseCommand):
+    """
+    Удаление файлов, на которые не ссылается ни один сниппет
+
+    Пример: ``python manage.py collect_blobs --recount --orphans``
+    """
+    help = 'Удаление неиспользуемых файлов с кодом и производных от них файлов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recount', action='store_true',
+                            help='предварительно пересчитать счётчики ссылок по таблице сниппетов')
+        parser.add_argument('--orphans', action='store_true',
+                            help='обойти MEDIA_ROOT и удалить файлы без записи в учёте ссылок')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            self.stdout.write('Исправлено счётчиков: {}'.format(Blob.recount()))
+        removed = Blob.collect_garbage()
+        if options['orphans']:
+            referenced = set(Blob.objects.filter(refcount__gt=0).values_list('sha1', flat=True))
+            for sha1, path in list(storage.iter_stored_files()):
+                if sha1 in referenced:
+                    continue
+                # a snippet with this code may have been saved since the snapshot
+                with storage.lock_file(storage.get_filename(sha1)):
+                    if not Blob.objects.filter(sha1=sha1, refcount__gt=0).exists():
+                        removed += storage.remove_file(path)
+        self.stdout.write('Удалено файлов: {}'.format(removed))
@@ -0,0 +1,56 @@
+"""
+Команда массового экспорта сниппетов
+"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from main.bulk import FORMATS, guess_format, iter_export_records, write_jsonl, write_tar
+from main.models import Snippet
+
+TAR_COMPRESSION = {'.tar.gz': 'gz', '.tgz': 'gz', '.tar.bz2': 'bz2', '.tar.xz': 'xz'}
+
+
+class Command(BaseCommand):
+    """
+    Потоковый экспорт сниппетов в файл JSON Lines или tar-архив
+
+    Файлы с кодом читаются пачками в пуле потоков.
+
+    Пример: ``python manage.py export_snippets dump.tar.gz --user vasya``
+    """
+    help = 'Экспорт сниппетов в JSON Lines или tar-архив'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='имя файла или "-" для стандартного вывода')
+        parser.add_argument('--format', choices=FORMATS, default=None,
+                            help='формат (по умолчанию - по расширению файла)')
+        parser.add_argument('--user', default=None,
+                            help='экспортировать только сниппеты пользователя')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='количество потоков чтения файлов')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='количество одновременно читаемых сниппетов')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+        queryset = Snippet.objects.all()
+        if options['user']:
+            queryset = queryset.filter(user__username=options['user'])
+        stream = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        try:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                records = iter_export_records(queryset, executor, options['batch_size'])
+                if fmt == 'tar':
+                    compression = next((value for suffix, value in TAR_COMPRESSION.items()
+                                        if path.endswith(suffix)), '')
+                    count = write_tar(stream, records, compression)
+                else:
+                    count = write_jsonl(stream, records)
+        finally:
+            if stream is not sys.stdout.buffer:
+                stream.close()
+        self.stderr.write('Экспортировано сниппетов: {}'.format(count))
@@ -0,0 +1,44 @@
+"""
+Команда запуска обработчика очереди форматирования
+"""
+
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.jobs import process_pending_jobs, release_stale_jobs
+
+
+class Command(BaseCommand):
+    """
+    Обработчик очереди заданий на форматирование
+
+    Пример: ``python manage.py format_worker --workers 4``
+    """
+    help = 'Обработка очереди заданий на форматирование кода'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.FORMAT_WORKERS,
+                            help='количество процессов-исполнителей')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='пауза между опросами пустой очереди, секунд')
+        parser.add_argument('--once', action='store_true',
+                            help='обработать текущую очередь и завершиться')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        # with warm formatter processes enabled the CPU work already runs
+        # in main.workers, so jobs only need threads to wait on them
+        executor_class = ThreadPoolExecutor if settings.FORMATTER_POOL_SIZE else ProcessPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+            while True:
+                release_stale_jobs()
+                processed = process_pending_jobs(executor, workers * 2)
+                if processed:
+                    self.stdout.write('Обработано заданий: {}'.format(processed))
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['interval'])
@@ -0,0 +1,55 @@
+"""
+Команда массового импорта сниппетов
+"""
+
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from main.bulk import FORMATS, SnippetImporter, SnippetImportError, guess_format, read_records
+
+
+class Command(BaseCommand):
+    """
+    Потоковый импорт сниппетов из файла JSON Lines или tar-архива
+
+    Каждая пачка сниппетов вставляется в отдельной транзакции,
+    поэтому при ошибке уже импортированные пачки сохраняются.
+
+    Пример: ``python manage.py import_snippets dump.tar.gz --user vasya --workers 4``
+    """
+    help = 'Импорт сниппетов из JSON Lines или tar-архива'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='имя файла или "-" для стандартного ввода')
+        parser.add_argument('--format', choices=FORMATS, default=None,
+                            help='формат (по умолчанию - по расширению файла)')
+        parser.add_argument('--user', default=None,
+                            help='пользователь для сниппетов без автора')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='количество процессов (по умолчанию - по числу ядер)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='количество сниппетов в одной транзакции')
+
+    def handle(self, *args, **options):
+        default_user = None
+        if options['user']:
+            default_user = User.objects.filter(username=options['user']).first()
+            if default_user is None:
+                raise CommandError('Неизвестный пользователь: {}'.format(options['user']))
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+        stream = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        imported = 0
+        try:
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                importer = SnippetImporter(executor, options['batch_size'], default_user)
+                for imported in importer.run(read_records(stream, fmt)):
+                    self.stdout.write('Импортировано сниппетов: {}'.format(imported))
+        except SnippetImportError as error:
+            raise CommandError('{} (импортировано сниппетов: {})'.format(error, imported))
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
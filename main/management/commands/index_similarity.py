@@ -0,0 +1,46 @@
+"""
+Команда заполнения индекса похожих сниппетов
+"""
+
+from django.core.management.base import BaseCommand
+
+from main.backfill import run_backfill
+from main.models import Snippet, SnippetBand
+from main.similarity import get_buckets, get_signature
+
+
+class Command(BaseCommand):
+    """
+    Вычисление MinHash-сигнатур и корзин LSH для сниппетов в пуле процессов
+    (:func:`main.backfill.run_backfill`)
+
+    Пример: ``python manage.py index_similarity --workers 4 --missing``
+    """
+    help = 'Заполнение индекса похожих сниппетов (MinHash/LSH)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='количество процессов (по умолчанию - по числу ядер)')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='количество сниппетов в задании процесса')
+        parser.add_argument('--missing', action='store_true',
+                            help='обработать только сниппеты без сигнатуры')
+
+    def handle(self, *args, **options):
+        records = Snippet.objects.all()
+        if options['missing']:
+            records = records.filter(minhash__isnull=True)
+        for indexed in run_backfill(records, get_signature, self.save,
+                                    options['workers'], options['batch_size']):
+            self.stdout.write('Обработано сниппетов: {}'.format(indexed))
+
+    @staticmethod
+    def save(snippet_id, signature):
+        """
+        Запись сигнатуры сниппета и его корзин LSH
+
+        :param snippet_id: ID сниппета
+        :param signature: MinHash-сигнатура
+        """
+        Snippet.objects.filter(id=snippet_id).update(minhash=signature)
+        SnippetBand.replace_for(snippet_id, get_buckets(signature))
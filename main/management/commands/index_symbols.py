@@ -0,0 +1,35 @@
+"""
+Команда заполнения индекса символов
+"""
+
+from django.core.management.base import BaseCommand
+
+from main.backfill import run_backfill
+from main.models import Snippet, SnippetSymbol
+from main.symbols import extract_symbols
+
+
+class Command(BaseCommand):
+    """
+    Разбор кода сниппетов и заполнение индекса символов в пуле процессов
+    (:func:`main.backfill.run_backfill`)
+
+    Пример: ``python manage.py index_symbols --workers 4 --missing``
+    """
+    help = 'Заполнение индекса символов (определения, импорты, вызовы)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='количество процессов (по умолчанию - по числу ядер)')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='количество сниппетов в задании процесса')
+        parser.add_argument('--missing', action='store_true',
+                            help='обработать только сниппеты без символов в индексе')
+
+    def handle(self, *args, **options):
+        records = Snippet.objects.all()
+        if options['missing']:
+            records = records.filter(symbols__isnull=True)
+        for indexed in run_backfill(records, extract_symbols, SnippetSymbol.replace_for,
+                                    options['workers'], options['batch_size']):
+            self.stdout.write('Обработано сниппетов: {}'.format(indexed))
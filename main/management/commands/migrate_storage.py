@@ -0,0 +1,58 @@
+"""
+Команда переноса файлов хранилища между схемами расположения
+"""
+
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main import storage
+
+
+class Command(BaseCommand):
+    """
+    Перенос файлов с кодом в текущую схему расположения без остановки сайта
+
+    Порядок работы:
+
+    1. в настройках указать новую схему в ``SNIPPET_STORAGE_LAYOUT``,
+       а старую - в ``SNIPPET_STORAGE_LEGACY_LAYOUTS``, и перезапустить сайт;
+    2. запустить ``python manage.py migrate_storage --from flat``;
+    3. после завершения очистить ``SNIPPET_STORAGE_LEGACY_LAYOUTS``.
+
+    Файлы переносятся пачками с паузой между ними,
+    чтобы не отнимать дисковый ввод-вывод у работающего сайта.
+    """
+    help = 'Перенос файлов с кодом из старой схемы расположения в текущую'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='source', required=True,
+                            choices=sorted(storage.LAYOUTS),
+                            help='схема, из которой переносятся файлы')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='количество файлов в пачке')
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='пауза между пачками, секунд')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        target = settings.SNIPPET_STORAGE_LAYOUT
+        if source == target:
+            raise CommandError('Схема {} уже является текущей'.format(source))
+        if source not in settings.SNIPPET_STORAGE_LEGACY_LAYOUTS:
+            raise CommandError('Схема {} должна быть указана в SNIPPET_STORAGE_LEGACY_LAYOUTS, '
+                               'иначе сайт не найдёт ещё не перенесённые файлы'.format(source))
+        files = storage.get_layout(source).iter_files()
+        moved = 0
+        while True:
+            batch = list(islice(files, options['batch_size']))
+            if not batch:
+                break
+            for _, path in batch:
+                storage.move_file(path, target)
+            moved += len(batch)
+            self.stdout.write('Перенесено файлов: {}'.format(moved))
+            time.sleep(options['pause'])
+        self.stdout.write('Перенос завершён')
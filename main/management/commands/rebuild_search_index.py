@@ -0,0 +1,56 @@
+"""
+Команда перестроения поискового индекса
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main import search
+from main.models import Snippet
+
+
+class Command(BaseCommand):
+    """
+    Полное перестроение индекса полнотекстового поиска по файлам с кодом
+
+    Пример: ``python manage.py rebuild_search_index --batch-size 500``
+    """
+    help = 'Перестроение индекса полнотекстового поиска'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='количество сниппетов в одной транзакции')
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            self.stderr.write('Полнотекстовый поиск доступен только для SQLite')
+            return
+        batch_size = options['batch_size']
+        records = Snippet.objects.only('id', 'sha1').order_by('id').iterator()
+        with transaction.atomic():
+            search.clear_index()
+        indexed = 0
+        batch = []
+        for record in records:
+            try:
+                batch.append((record.id, record.get_code()))
+            except Snippet.DoesNotExist:
+                continue
+            if len(batch) >= batch_size:
+                indexed += self.flush(batch)
+        indexed += self.flush(batch)
+        self.stdout.write('Проиндексировано сниппетов: {}'.format(indexed))
+
+    @staticmethod
+    def flush(batch):
+        """
+        Запись пачки сниппетов в индекс
+
+        :param batch: список кортежей для :func:`main.search.index_snippets`
+        :return: количество записанных сниппетов
+        """
+        with transaction.atomic():
+            search.index_snippets(batch)
+        count = len(batch)
+        batch.clear()
+        return count
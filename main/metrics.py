@@ -0,0 +1,260 @@
+"""
+Замеры времени обработки запросов
+
+:class:`TimingMiddleware` измеряет полное время каждого запроса
+и время его этапов: запросов к БД (``db``), чтения файлов (``read``),
+форматирования (``format``), подсветки (``highlight``) и сборки шаблона
+(``render``). Этапы отмечаются в коде контекстным менеджером :func:`timed`.
+
+Замеры отдаются клиенту в заголовке ``Server-Timing`` и накапливаются
+в скользящем окне из ``METRICS_WINDOW`` последних значений для каждой
+view-функции и этапа. Процентили по окну отдаются в текстовом формате
+Prometheus (см. :func:`main.views.metrics_page`).
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Замер времени этапа обработки текущего запроса
+
+    Время одноимённых этапов суммируется. Вне запроса замер не ведётся.
+
+    :param stage: название этапа
+    """
+    timings = _request_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] += time.perf_counter() - start
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Обёртка запросов к БД, относящая их время к этапу ``db``
+
+    Подключается ко всем соединениям с БД (:func:`install_query_timer`).
+
+    :param execute: следующий обработчик запроса
+    :param sql: текст запроса
+    :param params: параметры запроса
+    :param many: признак ``executemany``
+    :param context: контекст выполнения
+    :return: результат запроса
+    """
+    with timed('db'):
+        return execute(sql, params, many, context)
+
+
+class TimingRegistry:
+    """
+    Скользящие окна замеров времени
+
+    :param window: количество последних значений, хранимых для каждого ключа
+    """
+
+    def __init__(self, window):
+        """
+        Конструктор объекта.
+
+        :param window: размер окна
+        """
+        self.window = window
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+        self.totals = defaultdict(lambda: [0, 0.0])
+        self.lock = threading.Lock()
+
+    def record(self, key, duration):
+        """
+        Сохранение замера
+
+        :param key: кортеж (view-функция, этап); этап ``total`` - весь запрос
+        :param duration: длительность в секундах
+        """
+        with self.lock:
+            self.samples[key].append(duration)
+            total = self.totals[key]
+            total[0] += 1
+            total[1] += duration
+
+    def snapshot(self):
+        """
+        Получение процентилей по всем окнам
+
+        :return: словарь ключ -> (процентили по :data:`QUANTILES`,
+                 количество замеров за всё время, сумма за всё время)
+        :rtype: :class:`dict`
+        """
+        with self.lock:
+            items = [(key, sorted(samples), tuple(self.totals[key]))
+                     for key, samples in self.samples.items()]
+        return {key: ([samples[min(int(quantile * len(samples)), len(samples) - 1)]
+                       for quantile in QUANTILES], count, total)
+                for key, samples, (count, total) in items}
+
+    def clear(self):
+        """
+        Удаление всех замеров
+        """
+        with self.lock:
+            self.samples.clear()
+            self.totals.clear()
+
+
+registry = TimingRegistry(settings.METRICS_WINDOW)
+
+
+def escape_label(value):
+    """
+    Экранирование значения метки Prometheus
+
+    :param value: значение
+    :rtype: :class:`str`
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """
+    Формирование метрик в текстовом формате Prometheus
+
+    Полное время запросов отдаётся как ``snippet_request_duration_seconds``,
+    время этапов - как ``snippet_stage_duration_seconds`` (тип summary).
+
+    :rtype: :class:`str`
+    """
+    metrics = {'total': [], 'stage': []}
+    for (view, stage), (values, count, total) in sorted(registry.snapshot().items()):
+        labels = 'view="{}"'.format(escape_label(view))
+        if stage == 'total':
+            name, kind = 'snippet_request_duration_seconds', 'total'
+        else:
+            name, kind = 'snippet_stage_duration_seconds', 'stage'
+            labels += ',stage="{}"'.format(escape_label(stage))
+        lines = metrics[kind]
+        for quantile, value in zip(QUANTILES, values):
+            lines.append('{}{{{},quantile="{}"}} {:.6f}'.format(name, labels, quantile, value))
+        lines.append('{}_sum{{{}}} {:.6f}'.format(name, labels, total))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, count))
+    output = []
+    for kind, name, description in (
+            ('total', 'snippet_request_duration_seconds', 'Request processing time by view'),
+            ('stage', 'snippet_stage_duration_seconds', 'Request stage time by view and stage')):
+        output.append('# HELP {} {}'.format(name, description))
+        output.append('# TYPE {} summary'.format(name))
+        output.extend(metrics[kind])
+    return '\n'.join(output) + '\n'
+
+
+def install_query_timer(sender, connection, **kwargs):  # pylint: disable=unused-argument
+    """
+    Подключение :func:`time_query` к новому соединению с БД
+
+    Обработчик сигнала ``connection_created``. Обёртка стоит на всех
+    соединениях, поэтому учитываются и запросы из потоков асинхронных
+    view-функций; вне запроса она ничего не замеряет.
+
+    :param sender: класс соединения
+    :param connection: соединение с БД
+    """
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+class TimingMiddleware:
+    """
+    Промежуточный слой, замеряющий время обработки запросов
+
+    Должен стоять первым в ``MIDDLEWARE``, чтобы учитывать
+    время всех остальных слоёв. Поддерживает синхронную
+    и асинхронную цепочки, поэтому при запуске через ASGI
+    не добавляет переходов между потоками.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        """
+        Конструктор объекта.
+
+        :param get_response: следующий обработчик цепочки
+        """
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks __call__ as a coroutine function for Django, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # pylint: disable=protected-access
+
+    def __call__(self, request):
+        """
+        Обработка запроса с замером времени
+
+        :param request: объект c деталями запроса
+        :type request: :class:`django.http.HttpRequest`
+        :return: ответ с заголовком ``Server-Timing``
+        """
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        timings = defaultdict(float)
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_timings.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        """
+        Асинхронная обработка запроса с замером времени
+
+        :param request: объект c деталями запроса
+        :type request: :class:`django.http.HttpRequest`
+        :return: ответ с заголовком ``Server-Timing``
+        """
+        timings = defaultdict(float)
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_timings.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - start)
+
+    @staticmethod
+    def finish(request, response, timings, total):
+        """
+        Учёт замеров запроса и запись заголовка ``Server-Timing``
+
+        :param request: объект c деталями запроса
+        :type request: :class:`django.http.HttpRequest`
+        :param response: ответ
+        :param timings: словарь этап -> длительность в секундах
+        :param total: полное время обработки в секундах
+        :return: ответ с заголовком ``Server-Timing``
+        """
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unknown'
+        for stage, duration in timings.items():
+            registry.record((view, stage), duration)
+        registry.record((view, 'total'), total)
+        response['Server-Timing'] = ', '.join(
+            '{};dur={:.1f}'.format(stage, duration * 1000)
+            for stage, duration in sorted(timings.items()) + [('total', total)])
+        return response
@@ -0,0 +1,42 @@
+# Generated by Django 2.1.5 on 2026-10-17 01:51
+
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_references(apps, schema_editor):
+    """
+    Заполнение счётчиков ссылок по уже существующим сниппетам
+    """
+    Snippet = apps.get_model('main', 'Snippet')
+    Blob = apps.get_model('main', 'Blob')
+    counts = Snippet.objects.values_list('sha1').annotate(count=Count('id'))
+    blobs = []
+    for sha1, count in counts:
+        path = os.path.join(settings.MEDIA_ROOT, '{}.py'.format(sha1))
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        blobs.append(Blob(sha1=sha1, refcount=count, size=size))
+    Blob.objects.bulk_create(blobs)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_formatjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha1', models.CharField(max_length=40, unique=True)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('size', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.1.5 on 2026-10-17 01:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_blob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='snippet',
+            name='md5',
+            field=models.CharField(max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='snippet',
+            name='sha1',
+            field=models.CharField(db_index=True, max_length=40),
+        ),
+        migrations.AlterField(
+            model_name='snippet',
+            name='sha256',
+            field=models.CharField(db_index=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['user', 'creation_date'], name='snippet_user_date_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.1.5 on 2026-10-17 01:55
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+import django.db.models.deletion
+
+
+def collect_stats(apps, schema_editor):
+    """
+    Заполнение статистики по уже существующим сниппетам
+    """
+    Snippet = apps.get_model('main', 'Snippet')
+    Blob = apps.get_model('main', 'Blob')
+    SnippetStats = apps.get_model('main', 'SnippetStats')
+    sizes = Blob.objects.filter(sha1=OuterRef('sha1')).values('size')[:1]
+    totals = Snippet.objects.filter(user__isnull=False) \
+        .annotate(size=Subquery(sizes)) \
+        .values('user') \
+        .annotate(count=Count('id'), total_bytes=Sum('size'), last_created=Max('creation_date'))
+    SnippetStats.objects.bulk_create([
+        SnippetStats(user_id=row['user'], count=row['count'],
+                     total_bytes=row['total_bytes'] or 0, last_created=row['last_created'])
+        for row in totals
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0007_hash_columns_and_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_bytes', models.BigIntegerField(default=0)),
+                ('last_created', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snippet_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(collect_stats, migrations.RunPython.noop),
+    ]
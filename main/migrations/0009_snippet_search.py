@@ -0,0 +1,38 @@
+# Generated by Django 2.1.5 on 2026-10-17 02:00
+
+from django.db import migrations
+
+CREATE_SQL = 'CREATE VIRTUAL TABLE main_snippet_fts ' \
+             'USING fts5(name, code, user_id UNINDEXED, tokenize={})'
+
+
+def create_index(apps, schema_editor):
+    """
+    Создание таблицы полнотекстового индекса (только для SQLite).
+    Заполняется командой ``manage.py rebuild_search_index``
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(CREATE_SQL.format("'trigram'"))
+    except Exception:  # SQLite older than 3.34 has no trigram tokenizer
+        schema_editor.execute(CREATE_SQL.format("'unicode61'"))
+
+
+def drop_index(apps, schema_editor):
+    """
+    Удаление таблицы полнотекстового индекса
+    """
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS main_snippet_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_snippetstats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
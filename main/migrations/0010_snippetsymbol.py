@@ -0,0 +1,27 @@
+# Generated by Django 2.1.5 on 2026-10-17 02:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_snippet_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetSymbol',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('def', 'Определение функции'), ('class', 'Определение класса'), ('import', 'Импорт модуля'), ('call', 'Вызов функции')], max_length=10)),
+                ('name', models.CharField(max_length=200)),
+                ('snippet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='symbols', to='main.Snippet')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='snippetsymbol',
+            index=models.Index(fields=['kind', 'name'], name='symbol_kind_name_idx'),
+        ),
+    ]
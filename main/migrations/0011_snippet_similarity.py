@@ -0,0 +1,27 @@
+# Generated by Django 2.1.5 on 2026-10-17 02:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_snippetsymbol'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='minhash',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.CreateModel(
+            name='SnippetBand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.BigIntegerField(db_index=True)),
+                ('snippet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bands', to='main.Snippet')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-17 02:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_snippet_similarity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='formatjob',
+            name='priority',
+            field=models.IntegerField(default=100),
+        ),
+        migrations.AlterField(
+            model_name='formatjob',
+            name='utility',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
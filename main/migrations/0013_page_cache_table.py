@@ -0,0 +1,42 @@
+# Generated by Django 2.1.5 on 2026-10-17 03:10
+
+from django.db import migrations, models
+
+PAGE_CACHE_TABLE = 'main_page_cache'
+
+
+def create_page_cache_table(apps, schema_editor):  # pylint: disable=unused-argument
+    """
+    Создание таблицы кеша страниц (``CACHES['pages']``)
+
+    Схема та же, что у ``manage.py createcachetable``, но не зависит
+    от настройки ``CACHES`` в момент применения миграции.
+    """
+    quote = schema_editor.quote_name
+    connection = schema_editor.connection
+    schema_editor.execute(
+        'CREATE TABLE IF NOT EXISTS {} ({} {} NOT NULL PRIMARY KEY, {} {} NOT NULL, {} {} NOT NULL)'.format(
+            quote(PAGE_CACHE_TABLE),
+            quote('cache_key'), models.CharField(max_length=255).db_type(connection),
+            quote('value'), models.TextField().db_type(connection),
+            quote('expires'), models.DateTimeField().db_type(connection)))
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+        quote(PAGE_CACHE_TABLE + '_expires'), quote(PAGE_CACHE_TABLE), quote('expires')))
+
+
+def drop_page_cache_table(apps, schema_editor):  # pylint: disable=unused-argument
+    """
+    Удаление таблицы кеша страниц
+    """
+    schema_editor.execute('DROP TABLE IF EXISTS {}'.format(schema_editor.quote_name(PAGE_CACHE_TABLE)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_formatjob_priority'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_page_cache_table, drop_page_cache_table),
+    ]
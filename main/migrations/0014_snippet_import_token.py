@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-17 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_page_cache_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='import_token',
+            field=models.UUIDField(db_index=True, editable=False, null=True),
+        ),
+    ]
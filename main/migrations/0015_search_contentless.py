@@ -0,0 +1,74 @@
+# Generated by Django 2.1.5 on 2026-10-17 14:40
+
+from django.db import migrations
+
+from main import storage
+
+CREATE_SQL = "CREATE VIRTUAL TABLE {} USING fts5(code, content='', tokenize={})"
+OLD_CREATE_SQL = 'CREATE VIRTUAL TABLE main_snippet_fts ' \
+                 'USING fts5(name, code, user_id UNINDEXED, tokenize={})'
+NEW_TABLE = 'main_snippet_fts_new'
+
+
+def create_table(schema_editor, sql, table=None):
+    """
+    Создание таблицы индекса с токенизатором ``trigram``,
+    а на SQLite старше 3.34 - ``unicode61``
+    """
+    args = (table,) if table else ()
+    try:
+        schema_editor.execute(sql.format(*args, "'trigram'"))
+    except Exception:  # SQLite older than 3.34 has no trigram tokenizer
+        schema_editor.execute(sql.format(*args, "'unicode61'"))
+
+
+def make_contentless(apps, schema_editor):
+    """
+    Замена индекса с копией кода на бесконтентный (только для SQLite)
+
+    Код переносится из старой таблицы, сниппеты, которых в ней нет,
+    индексируются по файлам. Концы строк приводятся к виду, в котором
+    код хранится в файлах, чтобы строки индекса можно было удалять.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    create_table(schema_editor, CREATE_SQL, NEW_TABLE)
+    schema_editor.execute(
+        'INSERT INTO {} (rowid, code) '
+        'SELECT f.rowid, REPLACE(f.code, char(13) || char(10), char(10)) '
+        'FROM main_snippet_fts f JOIN main_snippet s ON s.id = f.rowid'.format(NEW_TABLE))
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT id, sha1 FROM main_snippet '
+                       'WHERE id NOT IN (SELECT rowid FROM main_snippet_fts)')
+        missing = cursor.fetchall()
+        for snippet_id, sha1 in missing:
+            try:
+                code = storage.load_code(storage.get_filename(sha1))
+            except FileNotFoundError:
+                continue
+            cursor.execute('INSERT INTO {} (rowid, code) VALUES (%s, %s)'.format(NEW_TABLE),
+                           [snippet_id, code])
+    schema_editor.execute('DROP TABLE main_snippet_fts')
+    schema_editor.execute('ALTER TABLE {} RENAME TO main_snippet_fts'.format(NEW_TABLE))
+
+
+def restore_content(apps, schema_editor):
+    """
+    Возврат индекса с копией кода. Заполняется командой
+    ``manage.py rebuild_search_index``
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE main_snippet_fts')
+    create_table(schema_editor, OLD_CREATE_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_snippet_import_token'),
+    ]
+
+    operations = [
+        migrations.RunPython(make_contentless, restore_content),
+    ]
@@ -3,13 +3,23 @@
 """
 
 import hashlib
-import os
+from collections import defaultdict
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
-from main.formatter import AVAILABLE_FORMATTERS
-from prom_sem_kr.settings import MEDIA_ROOT
+from main import search, storage
+from main.formatter import get_formatter
+from main.hashing import get_digests
+from main.metrics import timed
+from main.page_cache import invalidate_user_pages
+from main.similarity import estimate_similarity, get_buckets, get_signature
+from main.symbols import SYMBOL_KINDS, extract_symbols
 
 
 class Snippet(models.Model):
@@ -20,9 +30,13 @@ class Snippet(models.Model):
     :param code: хранимый код (длинное текстовое поле)
     :param creation_date: дата создания, хранится в формате объекта ``datetime.datetime()``
     :param user: ForeignKey к модели :class:`django.contrib.auth.models.User`
-    :param sha1: SHA1-хеш хранимого кода. Используется для имени файла
-    :param sha256: SHA256-хеш хранимого кода
+    :param sha1: SHA1-хеш хранимого кода. Используется для имени файла, индексируется
+    :param sha256: SHA256-хеш хранимого кода, индексируется
     :param md5: MD5-хеш хранимого кода
+    :param minhash: MinHash-сигнатура кода для поиска похожих сниппетов
+                    (см. :mod:`main.similarity`)
+    :param import_token: метка пачки массового импорта, по которой находятся
+                         ID вставленных строк (см. :func:`main.bulk.insert_snippets`)
     :param code: временное хранилище кода перед записью в файл.
                  Устанавливается **после запуска** конструктора вручную
     """
@@ -30,11 +44,18 @@ class Snippet(models.Model):
     creation_date = models.DateTimeField()
     user = models.ForeignKey(to=User, on_delete=models.CASCADE,
                              blank=True, null=True)  # can be empty due to usage of AnonymousUser
-    sha1 = models.TextField(max_length=40)
-    sha256 = models.TextField(max_length=64)
-    md5 = models.TextField(max_length=32)
+    sha1 = models.CharField(max_length=40, db_index=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    md5 = models.CharField(max_length=32)
+    minhash = models.BinaryField(null=True, editable=False)
+    import_token = models.UUIDField(null=True, editable=False, db_index=True)
     code = ''
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'creation_date'], name='snippet_user_date_idx'),
+        ]
+
     def get_sha1(self):
         """
         Получение SHA1-хеша
@@ -77,15 +98,13 @@ class Snippet(models.Model):
         * Формат 1: sha1hash.py
         * Формат 2 (если указана утилита): sha1hash_utility.py
 
+        Каталог определяется схемой расположения из :mod:`main.storage`.
+
         :param modifier: имя утилиты
         :type modifier: :class:`str`
         :return: Имя файла
         """
-        path = os.path.join(MEDIA_ROOT, '{}'.format(self.sha1))
-        if modifier:
-            path += '_' + modifier
-        path += '.py'
-        return path
+        return storage.get_filename(self.sha1, modifier)
 
     def save_to_file(self, modifier=None, code=None):
         """
@@ -94,6 +113,8 @@ class Snippet(models.Model):
         Если код не указан - используется оригинальный код сниппета
         Если модификатор не указан - используется оригинальный файл сниппета
 
+        Запись атомарна: файл сначала пишется во временный, затем переименовывается.
+
         :param modifier: имя утилиты
         :type modifier: :class:`str`
         :param code: код сниппета (возможно, отформатированный)
@@ -102,8 +123,7 @@ class Snippet(models.Model):
         path = self.get_filename(modifier)
         if not code:
             code = self.code
-        with open(path, 'w') as file:
-            file.write(code.replace('\r\n', '\n'))
+        storage.save_code(path, code.replace('\r\n', '\n'))
 
     def get_code(self):
         """
@@ -111,11 +131,25 @@ class Snippet(models.Model):
 
         :return: Код в виде строки
         """
-        if not os.path.exists(self.get_filename()):
+        try:
+            with timed('read'):
+                return storage.load_code(self.get_filename())
+        except FileNotFoundError:
+            raise self.DoesNotExist
+
+    def get_formatter(self, utility):
+        """
+        Получение объекта форматтера для одной из подддерживаемых утилит
+        или цепочки утилит через ``+``
+
+        :raises: :class:`Snippet.DoesNotExist` в случае, указаная утилита не поддерживается
+        :return: объект форматтера, настроенный на файл сниппета
+        :rtype: :class:`main.formatter.BaseFormatter`
+        """
+        try:
+            return get_formatter(self.get_filename(), utility)
+        except KeyError:
             raise self.DoesNotExist
-        with open(self.get_filename(), 'r') as file:
-            data = file.read()
-        return data
 
     def get_formatted_code(self, utility):
         """
@@ -124,18 +158,446 @@ class Snippet(models.Model):
         :raises: :class:`Snippet.DoesNotExist` в случае, указаная утилита не поддерживается
         :return: Форматированный код в виде строки
         """
-        if utility not in AVAILABLE_FORMATTERS:
-            raise self.DoesNotExist
-        return AVAILABLE_FORMATTERS[utility](self.get_filename()).get_formatted_code()
+        return self.get_formatter(utility).get_formatted_code()
+
+    def get_similar(self, threshold, limit, max_candidates):
+        """
+        Поиск похожих сниппетов того же пользователя
+
+        Кандидаты выбираются по общим корзинам LSH (см. :class:`SnippetBand`),
+        больше всего общих корзин - первыми. Для них сравниваются сигнатуры.
+
+        :param threshold: минимальная оценка коэффициента Жаккара
+        :param limit: максимальное количество результатов
+        :param max_candidates: максимальное количество сравниваемых кандидатов
+        :return: список пар (сниппет, оценка сходства) по убыванию сходства
+        :rtype: :class:`list`
+        """
+        if not self.minhash:
+            return []
+        candidates = SnippetBand.objects \
+            .filter(bucket__in=get_buckets(self.minhash), snippet__user_id=self.user_id) \
+            .exclude(snippet_id=self.id) \
+            .values('snippet_id').annotate(shared=Count('id')) \
+            .order_by('-shared', '-snippet_id')[:max_candidates]
+        records = Snippet.objects.filter(id__in=[item['snippet_id'] for item in candidates]) \
+            .only('id', 'name', 'creation_date', 'minhash')
+        similar = [(record, estimate_similarity(self.minhash, record.minhash)) for record in records]
+        similar = [item for item in similar if item[1] >= threshold]
+        similar.sort(key=lambda item: (-item[1], -item[0].id))
+        return similar[:limit]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Создание объекта из записи в БД
+
+        Запоминает хеш, под которым код уже учтён в :class:`Blob`.
+        """
+        instance = super().from_db(db, field_names, values)
+        instance.stored_sha1 = instance.__dict__.get('sha1')
+        return instance
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         """
         Сохранение записи о сниппете в БД
 
-        В момент вызова вычисляются и сохраняются хеши. Также оригинальный код сохраняется в файл.
+        В момент вызова вычисляются и сохраняются хеши (за один проход по коду,
+        см. :func:`main.hashing.get_digests`). Также оригинальный код сохраняется в файл,
+        если его ещё нет: под блокировкой файла и после увеличения счётчика ссылок,
+        чтобы сборщик мусора не удалил файл между проверкой и фиксацией транзакции.
+        Счётчик ссылок на файл в :class:`Blob`, статистика пользователя,
+        поисковый индекс, индекс символов и индекс похожих сниппетов
+        обновляются в той же транзакции. Кеш страниц владельца сбрасывается
+        обработчиком сигнала ``post_save`` (:func:`invalidate_snippet_pages`).
+        Если включена настройка ``WARM_ON_WRITE``, после фиксации транзакции
+        запускается фоновая подготовка всех вариантов кода
+        (:func:`main.jobs.schedule_warm_up`).
+
+        Если у загруженного из БД объекта код не задан (например, при
+        переименовании в админке), хеши, счётчики ссылок и индексы кода
+        не меняются.
+        """
+        if 'code' not in self.__dict__ and self.pk is not None:
+            super().save()
+            return
+        digests = get_digests(self.code)
+        self.md5 = digests.md5
+        self.sha1 = digests.sha1
+        self.sha256 = digests.sha256
+        stored_sha1 = getattr(self, 'stored_sha1', None)
+        if stored_sha1 != self.sha1:
+            # parsing is the slow part of a save, keep it out of the lock and the transaction
+            self.minhash = get_signature(self.code)
+            symbols = extract_symbols(self.code)
+        created = self.pk is None
+        # the lock and the reference keep Blob.collect_garbage from removing
+        # the file between the existence check and the commit
+        with storage.lock_file(self.get_filename()), transaction.atomic():
+            super().save()
+            if stored_sha1 != self.sha1:
+                Blob.acquire(self.sha1, digests.size)
+                if stored_sha1:
+                    Blob.release(stored_sha1)
+            if not storage.exists(self.get_filename()):
+                self.save_to_file()
+            if self.user_id and created:
+                SnippetStats.record_created(self.user_id, digests.size, self.creation_date)
+            elif self.user_id and stored_sha1 != self.sha1:
+                SnippetStats.record_resized(self.user_id, digests.size - Blob.get_size(stored_sha1))
+            if stored_sha1 != self.sha1:
+                if stored_sha1:
+                    search.remove_snippets([(self.id, stored_sha1)])
+                search.index_snippets([(self.id, self.code)])
+                SnippetSymbol.replace_for(self.id, symbols)
+                SnippetBand.replace_for(self.id, get_buckets(self.minhash))
+                if settings.WARM_ON_WRITE:
+                    from main.jobs import schedule_warm_up  # jobs imports this module
+                    sha1 = self.sha1
+                    transaction.on_commit(lambda: schedule_warm_up(sha1))
+        self.stored_sha1 = self.sha1
+
+
+class Blob(models.Model):
+    """
+    Учёт ссылок на файлы с кодом
+
+    Один файл ``<sha1>.py`` может принадлежать нескольким сниппетам
+    с одинаковым кодом. Файл и все производные от него файлы удаляются
+    сборщиком мусора (:meth:`Blob.collect_garbage`), когда ссылок не остаётся.
+
+    :param sha1: SHA1-хеш кода
+    :param refcount: количество сниппетов с этим кодом
+    :param size: размер кода в байтах (UTF-8)
+    """
+    sha1 = models.CharField(max_length=40, unique=True)
+    refcount = models.PositiveIntegerField(default=0)
+    size = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def acquire(cls, sha1, size):
+        """
+        Увеличение счётчика ссылок
+
+        :param sha1: SHA1-хеш кода
+        :param size: размер кода в байтах
+        """
+        if cls.objects.filter(sha1=sha1).update(refcount=F('refcount') + 1):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(sha1=sha1, refcount=1, size=size)
+        except IntegrityError:
+            cls.objects.filter(sha1=sha1).update(refcount=F('refcount') + 1)
+
+    @classmethod
+    def acquire_many(cls, blobs):
+        """
+        Увеличение счётчиков ссылок сразу для многих файлов
+
+        Используется при массовом импорте: недостающие записи создаются
+        одним запросом, существующие обновляются группами с одинаковым приращением.
+
+        :param blobs: словарь SHA1-хеш -> (количество новых ссылок, размер кода в байтах)
+        """
+        existing = set(cls.objects.filter(sha1__in=list(blobs)).values_list('sha1', flat=True))
+        cls.objects.bulk_create([cls(sha1=sha1, refcount=count, size=size)
+                                 for sha1, (count, size) in blobs.items() if sha1 not in existing])
+        by_count = defaultdict(list)
+        for sha1 in existing:
+            by_count[blobs[sha1][0]].append(sha1)
+        for count, hashes in by_count.items():
+            cls.objects.filter(sha1__in=hashes).update(refcount=F('refcount') + count)
+
+    @classmethod
+    def get_size(cls, sha1):
+        """
+        Получение размера кода по хешу
+
+        :param sha1: SHA1-хеш кода
+        :return: размер в байтах или 0, если хеш не учтён
+        :rtype: :class:`int`
+        """
+        return cls.objects.filter(sha1=sha1).values_list('size', flat=True).first() or 0
+
+    @classmethod
+    def release(cls, sha1):
+        """
+        Уменьшение счётчика ссылок
+
+        :param sha1: SHA1-хеш кода
+        """
+        cls.objects.filter(sha1=sha1, refcount__gt=0).update(refcount=F('refcount') - 1)
+
+    @classmethod
+    def recount(cls):
+        """
+        Пересчёт всех счётчиков ссылок по таблице сниппетов
+
+        :return: количество исправленных записей
+        :rtype: :class:`int`
+        """
+        counts = dict(Snippet.objects.values_list('sha1').annotate(count=Count('id')))
+        fixed = 0
+        with transaction.atomic():
+            for blob in cls.objects.all():
+                count = counts.pop(blob.sha1, 0)
+                if blob.refcount != count:
+                    cls.objects.filter(pk=blob.pk).update(refcount=count)
+                    fixed += 1
+            for sha1, count in counts.items():
+                cls.objects.create(sha1=sha1, refcount=count, size=storage.get_code_size(sha1))
+                fixed += 1
+        return fixed
+
+    @classmethod
+    def collect_garbage(cls):
+        """
+        Удаление файлов, на которые не ссылается ни один сниппет,
+        вместе с отформатированными вариантами и подсвеченным HTML
+
+        Запись удаляется условным DELETE под той же блокировкой файла,
+        что и в :meth:`Snippet.save`, поэтому файл, на который
+        только что появилась ссылка, не удаляется.
+
+        :return: количество удалённых файлов
+        :rtype: :class:`int`
+        """
+        removed = 0
+        for blob in cls.objects.filter(refcount=0):
+            with storage.lock_file(storage.get_filename(blob.sha1)), transaction.atomic():
+                if cls.objects.filter(pk=blob.pk, refcount=0).delete()[0]:
+                    removed += storage.remove_blob_files(blob.sha1)
+        return removed
+
+
+class SnippetStats(models.Model):
+    """
+    Сводная статистика сниппетов пользователя
+
+    Поддерживается инкрементально при сохранении и удалении сниппетов,
+    поэтому для её отображения не нужно сканировать таблицу сниппетов.
+    Запись создаётся при первом обращении (:meth:`SnippetStats.for_user`).
+
+    :param user: пользователь
+    :param count: количество сниппетов
+    :param total_bytes: суммарный размер кода в байтах
+    :param last_created: дата создания последнего сниппета
+    """
+    user = models.OneToOneField(to=User, on_delete=models.CASCADE, related_name='snippet_stats')
+    count = models.PositiveIntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    last_created = models.DateTimeField(blank=True, null=True)
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """
+        Пересчёт статистики пользователя по таблицам сниппетов и :class:`Blob`
+
+        :param user_id: ID пользователя
+        :return: объект статистики
+        :rtype: :class:`SnippetStats`
+        """
+        sizes = Blob.objects.filter(sha1=OuterRef('sha1')).values('size')[:1]
+        totals = Snippet.objects.filter(user_id=user_id) \
+            .annotate(size=Subquery(sizes)) \
+            .aggregate(count=Count('id'), total_bytes=Sum('size'), last_created=Max('creation_date'))
+        stats, _ = cls.objects.update_or_create(user_id=user_id, defaults={
+            'count': totals['count'],
+            'total_bytes': totals['total_bytes'] or 0,
+            'last_created': totals['last_created'],
+        })
+        return stats
+
+    @classmethod
+    def for_user(cls, user):
+        """
+        Получение статистики пользователя
+
+        :param user: пользователь
+        :return: объект статистики
+        :rtype: :class:`SnippetStats`
+        """
+        stats = cls.objects.filter(user_id=user.id).first()
+        if stats is None:
+            with transaction.atomic():
+                stats = cls.rebuild(user.id)
+        return stats
+
+    @classmethod
+    def record_created(cls, user_id, size, creation_date, count=1):
+        """
+        Учёт новых сниппетов
+
+        :param user_id: ID пользователя
+        :param size: суммарный размер кода в байтах
+        :param creation_date: дата создания самого нового из сниппетов
+        :param count: количество сниппетов
+        """
+        date = Value(creation_date, output_field=models.DateTimeField())
+        updated = cls.objects.filter(user_id=user_id).update(
+            count=F('count') + count,
+            total_bytes=F('total_bytes') + size,
+            last_created=Greatest(Coalesce('last_created', date), date),
+        )
+        if not updated:
+            cls.rebuild(user_id)
+
+    @classmethod
+    def record_resized(cls, user_id, delta):
+        """
+        Учёт изменения кода существующего сниппета
+
+        :param user_id: ID пользователя
+        :param delta: изменение размера кода в байтах
+        """
+        cls.objects.filter(user_id=user_id).update(total_bytes=F('total_bytes') + delta)
+
+    @classmethod
+    def record_deleted(cls, user_id, size):
+        """
+        Учёт удалённого сниппета
+
+        Дата последнего сниппета берётся из индекса ``(user, creation_date)``.
+
+        :param user_id: ID пользователя
+        :param size: размер кода в байтах
+        """
+        last_created = Snippet.objects.filter(user_id=user_id) \
+            .order_by('-creation_date').values_list('creation_date', flat=True).first()
+        cls.objects.filter(user_id=user_id, count__gt=0).update(
+            count=F('count') - 1,
+            total_bytes=Greatest(F('total_bytes') - size, Value(0)),
+            last_created=last_created,
+        )
+
+
+class SnippetSymbol(models.Model):
+    """
+    Символ, определённый или используемый в сниппете
+
+    Заполняется при сохранении сниппета (см. :mod:`main.symbols`)
+    и командой ``manage.py index_symbols``.
+
+    :param snippet: сниппет
+    :param kind: вид символа: определение функции, класса, импорт или вызов
+    :param name: имя символа
+    """
+    snippet = models.ForeignKey(to=Snippet, on_delete=models.CASCADE, related_name='symbols')
+    kind = models.CharField(max_length=10, choices=SYMBOL_KINDS)
+    name = models.CharField(max_length=200)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['kind', 'name'], name='symbol_kind_name_idx'),
+        ]
+
+    @classmethod
+    def replace_for(cls, snippet_id, symbols):
+        """
+        Замена всех символов сниппета
+
+        :param snippet_id: ID сниппета
+        :param symbols: множество пар (вид символа, имя)
+        """
+        cls.objects.filter(snippet_id=snippet_id).delete()
+        cls.objects.bulk_create([cls(snippet_id=snippet_id, kind=kind, name=name)
+                                 for kind, name in sorted(symbols)])
+
+
+class SnippetBand(models.Model):
+    """
+    Корзина LSH, в которую попала одна из полос MinHash-сигнатуры сниппета
+
+    Заполняется при сохранении сниппета и командой ``manage.py index_similarity``.
+
+    :param snippet: сниппет
+    :param bucket: номер корзины (хеш номера полосы и её значений), индексируется
+    """
+    snippet = models.ForeignKey(to=Snippet, on_delete=models.CASCADE, related_name='bands')
+    bucket = models.BigIntegerField(db_index=True)
+
+    @classmethod
+    def replace_for(cls, snippet_id, buckets):
+        """
+        Замена всех корзин сниппета
+
+        :param snippet_id: ID сниппета
+        :param buckets: список номеров корзин
+        """
+        cls.objects.filter(snippet_id=snippet_id).delete()
+        cls.objects.bulk_create([cls(snippet_id=snippet_id, bucket=bucket) for bucket in buckets])
+
+
+@receiver(post_delete, sender=Snippet)
+def release_snippet_blob(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    Освобождение ссылки на файл с кодом, обновление статистики,
+    поискового индекса и кеша страниц при удалении сниппета
+
+    Срабатывает и при каскадном удалении вместе с пользователем.
+    """
+    if instance.user_id:
+        SnippetStats.record_deleted(instance.user_id, Blob.get_size(instance.sha1))
+    Blob.release(instance.sha1)
+    search.remove_snippets([(instance.id, instance.sha1)])
+    invalidate_user_pages(instance.user_id)
+
+
+@receiver(post_save, sender=Snippet)
+def invalidate_snippet_pages(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    Сброс закешированных страниц владельца сниппета после сохранения
+
+    Срабатывает и при загрузке фикстур, когда :meth:`Snippet.save` не вызывается.
+    """
+    invalidate_user_pages(instance.user_id)
+
+
+class FormatJob(models.Model):
+    """
+    Задание на фоновое форматирование кода
+
+    Очередь хранится в основной БД и обрабатывается командой
+    ``manage.py format_worker``.
+
+    :param sha1: SHA1-хеш форматируемого кода
+    :param utility: название утилиты или цепочки утилит (см. :func:`main.formatter.get_formatter`)
+    :param status: состояние задания
+    :param error: текст ошибки, если форматирование не удалось
+    :param priority: приоритет, задания с большим приоритетом выполняются раньше.
+                     Пустая утилита означает подсветку оригинального кода
+    :param created: дата постановки в очередь
+    :param updated: дата последнего изменения состояния
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Выполнено'),
+        (FAILED, 'Ошибка'),
+    )
+    PRIORITY_WARM_UP = 0
+    PRIORITY_REQUESTED = 100
+
+    sha1 = models.CharField(max_length=40)
+    utility = models.CharField(max_length=50, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    error = models.TextField(blank=True)
+    priority = models.IntegerField(default=PRIORITY_REQUESTED)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('sha1', 'utility')
+
+    def get_filename(self):
+        """
+        Получение имени файла с оригинальным кодом
+
+        :return: Имя файла
         """
-        self.md5 = self.get_md5()
-        self.sha1 = self.get_sha1()
-        self.sha256 = self.get_sha256()
-        self.save_to_file()
-        super().save()
+        return Snippet(sha1=self.sha1).get_filename()
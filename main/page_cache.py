@@ -0,0 +1,144 @@
+"""
+Кеширование страниц сниппетов целиком
+
+Страницы зависят от пользователя, поэтому ключ кеша содержит
+ID пользователя и номер поколения его страниц. Изменение сниппетов
+пользователя увеличивает номер поколения (:func:`invalidate_user_pages`),
+и все его старые страницы перестают находиться, а затем вытесняются.
+
+Не кешируются страницы с сообщениями (:mod:`django.contrib.messages`),
+страницы, использующие CSRF-токен, и ответы с кодом, отличным от 200.
+
+Кеш берётся из ``CACHES`` по псевдониму ``PAGE_CACHE_ALIAS``.
+Хранилище должно быть общим для всех процессов: сброс, выполненный
+в одном процессе (например, командой ``manage.py import_snippets``),
+должен быть виден остальным. По умолчанию используется кеш в БД,
+где номер поколения увеличивается в той же транзакции, что и сохранение
+сниппета; кеш в памяти процесса подходит только для одного процесса.
+"""
+
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+GENERATION_KEY = 'pagegen:{}'
+PAGE_KEY = 'page:{}:{}:{}'
+
+
+def get_cache():
+    """
+    Получение кеша страниц
+
+    :rtype: :class:`django.core.cache.backends.base.BaseCache`
+    """
+    return caches[settings.PAGE_CACHE_ALIAS]
+
+
+def get_generation(user_id):
+    """
+    Получение номера поколения страниц пользователя
+
+    :param user_id: ID пользователя
+    :rtype: :class:`int`
+    """
+    return get_cache().get(GENERATION_KEY.format(user_id), 0)
+
+
+def invalidate_user_pages(user_id):
+    """
+    Сброс всех закешированных страниц пользователя
+
+    :param user_id: ID пользователя
+    """
+    if user_id is None:
+        return
+    cache = get_cache()
+    key = GENERATION_KEY.format(user_id)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:  # evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+
+
+def get_page_key(request):
+    """
+    Получение ключа страницы для текущего пользователя
+
+    Ключ запоминается в объекте запроса, чтобы номер поколения
+    читался из кеша один раз.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :rtype: :class:`str`
+    """
+    if '_page_key' not in request.__dict__:
+        path = hashlib.md5(request.get_full_path().encode('utf8')).hexdigest()
+        request._page_key = PAGE_KEY.format(request.user.id, get_generation(request.user.id), path)
+    return request._page_key
+
+
+def is_cacheable_request(request):
+    """
+    Проверка, что ответ на запрос можно искать в кеше и сохранять в него
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :rtype: :class:`bool`
+    """
+    return request.method in ('GET', 'HEAD') and request.user.is_authenticated \
+        and not len(messages.get_messages(request))
+
+
+def get_cached_response(request):
+    """
+    Получение ответа на запрос из кеша страниц
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :return: закешированная страница или ответ 304 по её ETag,
+             ``None``, если страницы нет в кеше или запрос не кешируется
+    :rtype: :class:`django.http.HttpResponse`
+    """
+    if not is_cacheable_request(request) or request.__dict__.get('_page_cache_missed'):
+        return None
+    cached = get_cache().get(get_page_key(request))
+    if cached is None:
+        request._page_cache_missed = True  # the async views look up before the sync ones
+        return None
+    content, headers = cached
+    response = HttpResponse(content)
+    for header, value in headers:
+        response[header] = value
+    return get_conditional_response(request, etag=response.get('ETag'), response=response)
+
+
+def cache_user_page(view):
+    """
+    Декоратор view-функции, кеширующий её ответы для каждого пользователя
+
+    Должен применяться после :func:`django.contrib.auth.decorators.login_required`.
+    Сохранённый ETag позволяет отвечать 304 прямо из кеша.
+
+    :param view: view-функция
+    :return: view-функция с кешированием
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not is_cacheable_request(request):
+            return view(request, *args, **kwargs)
+        response = get_cached_response(request)
+        if response is not None:
+            return response
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming \
+                and not request.META.get('CSRF_COOKIE_USED') \
+                and not getattr(messages.get_messages(request), 'used', False):
+            get_cache().set(get_page_key(request), (response.content, list(response.items())), settings.PAGE_CACHE_TIMEOUT)
+        return response
+    return wrapper
@@ -0,0 +1,204 @@
+"""
+Полнотекстовый поиск по коду сниппетов
+
+Индекс кода хранится в виртуальной таблице SQLite FTS5 ``main_snippet_fts``
+в основной БД. Таблица бесконтентная (``content=''``): в ней только индекс,
+а сам код остаётся в файлах хранилища, поэтому строки удаляются командой
+``delete`` с исходным кодом, прочитанным из файла. Токенизатор ``trigram``
+позволяет искать любые подстроки длиной от трёх символов. Названия ищутся
+по таблице сниппетов, фрагменты для результатов строятся по файлам.
+Индекс обновляется при сохранении и удалении сниппетов и перестраивается
+командой ``manage.py rebuild_search_index``.
+
+На других СУБД поиск отключается.
+"""
+
+import re
+
+from django.db import connection
+from django.utils.html import escape
+
+from main import storage
+
+FTS_TABLE = 'main_snippet_fts'
+SNIPPET_TABLE = 'main_snippet'
+MIN_QUERY_LENGTH = 3
+EXCERPT_LENGTH = 64
+EXCERPT_CONTEXT = 16
+
+
+def is_available():
+    """
+    Проверка доступности поиска
+
+    :rtype: :class:`bool`
+    """
+    return connection.vendor == 'sqlite'
+
+
+def normalize_code(code):
+    """
+    Приведение кода к виду, в котором он хранится в файле
+
+    Удаление из бесконтентного индекса требует точно того же текста,
+    что был проиндексирован, а он читается из файла.
+
+    :param code: код
+    :rtype: :class:`str`
+    """
+    return code.replace('\r\n', '\n')
+
+
+def index_snippets(rows):
+    """
+    Добавление новых сниппетов в индекс
+
+    Сниппет, уже бывший в индексе, нужно сначала удалить
+    (:func:`remove_snippets`).
+
+    :param rows: последовательность пар (ID, код)
+    """
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany('INSERT INTO {} (rowid, code) VALUES (%s, %s)'.format(FTS_TABLE),
+                           [(snippet_id, normalize_code(code)) for snippet_id, code in rows])
+
+
+def remove_snippets(rows):
+    """
+    Удаление сниппетов из индекса
+
+    Код читается из файлов. Сниппеты, чьих файлов уже нет, пропускаются:
+    их строки не попадают в результаты, так как поиск соединяет индекс
+    с таблицей сниппетов, а ID сниппетов не переиспользуются.
+
+    :param rows: последовательность пар (ID, SHA1-хеш кода)
+    """
+    if not is_available():
+        return
+    params = []
+    for snippet_id, sha1 in rows:
+        try:
+            params.append((snippet_id, storage.load_code(storage.get_filename(sha1))))
+        except FileNotFoundError:
+            continue
+    with connection.cursor() as cursor:
+        cursor.executemany("INSERT INTO {0} ({0}, rowid, code) VALUES ('delete', %s, %s)".format(FTS_TABLE),
+                           params)
+
+
+def clear_index():
+    """
+    Очистка индекса
+    """
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO {0} ({0}) VALUES ('delete-all')".format(FTS_TABLE))
+
+
+def get_terms(query):
+    """
+    Выделение слов запроса
+
+    :param query: строка запроса
+    :return: список слов длиной от трёх символов
+    :rtype: :class:`list`
+    """
+    return [term for term in query.split() if len(term) >= MIN_QUERY_LENGTH]
+
+
+def quote_term(term):
+    """
+    Запись слова как фразы FTS5, чтобы его синтаксис не интерпретировался
+
+    :param term: слово
+    :rtype: :class:`str`
+    """
+    return '"{}"'.format(term.replace('"', '""'))
+
+
+def build_match_query(query):
+    """
+    Преобразование пользовательского запроса в запрос FTS5
+
+    Каждое слово запроса ищется как подстрока, все слова обязательны.
+    Синтаксис FTS5 в запросе пользователя не интерпретируется.
+
+    :param query: строка запроса
+    :return: запрос FTS5 или ``None``, если в нём нет слов длиной от трёх символов
+    :rtype: :class:`str`
+    """
+    terms = get_terms(query)
+    if not terms:
+        return None
+    return ' '.join(quote_term(term) for term in terms)
+
+
+def make_excerpt(code, terms):
+    """
+    Построение фрагмента кода вокруг первого совпадения
+    с подсветкой совпадений тегом ``<mark>``
+
+    :param code: код
+    :param terms: слова запроса
+    :return: безопасный HTML-код
+    :rtype: :class:`str`
+    """
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    match = pattern.search(code)
+    start = max(match.start() - EXCERPT_CONTEXT, 0) if match else 0
+    end = min(start + EXCERPT_LENGTH, len(code))
+    parts = ['…'] if start else []
+    position = start
+    for found in pattern.finditer(code, start, end):
+        parts.append(escape(code[position:found.start()]))
+        parts.append('<mark>{}</mark>'.format(escape(found.group())))
+        position = found.end()
+    parts.append(escape(code[position:end]))
+    if end < len(code):
+        parts.append('…')
+    return ''.join(parts)
+
+
+def search(user_id, query, offset, limit):
+    """
+    Поиск по сниппетам пользователя
+
+    Каждое слово запроса должно встречаться в коде или в названии.
+    Результаты с совпадениями в коде упорядочены по релевантности (BM25)
+    и идут первыми.
+
+    :param user_id: ID пользователя
+    :param query: строка запроса
+    :param offset: количество пропускаемых результатов
+    :param limit: максимальное количество результатов
+    :return: список словарей с ключами ``id``, ``name`` и ``excerpt``
+    :rtype: :class:`list`
+    """
+    terms = get_terms(query)
+    if not terms or not is_available():
+        return []
+    conditions = []
+    params = [build_match_query(query), user_id]
+    for term in terms:
+        conditions.append("(s.id IN (SELECT rowid FROM {table} WHERE {table} MATCH %s) "
+                          "OR s.name LIKE %s ESCAPE '\\')")
+        params += [quote_term(term), '%{}%'.format(re.sub(r'([\\%_])', r'\\\1', term))]
+    sql = ('SELECT s.id, s.name, s.sha1 FROM {snippets} s '
+           'LEFT JOIN (SELECT rowid, bm25({table}) AS rank FROM {table} WHERE {table} MATCH %s) f '
+           'ON f.rowid = s.id WHERE s.user_id = %s AND ' + ' AND '.join(conditions) +
+           ' ORDER BY f.rank IS NULL, f.rank, s.id DESC LIMIT %s OFFSET %s') \
+        .format(table=FTS_TABLE, snippets=SNIPPET_TABLE)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [limit, offset])
+        rows = cursor.fetchall()
+    results = []
+    for snippet_id, name, sha1 in rows:
+        try:
+            excerpt = make_excerpt(storage.load_code(storage.get_filename(sha1)), terms)
+        except FileNotFoundError:
+            excerpt = ''
+        results.append({'id': snippet_id, 'name': name, 'excerpt': excerpt})
+    return results
@@ -0,0 +1,142 @@
+"""
+Поиск похожих сниппетов (MinHash и LSH)
+
+Код разбивается на токены :mod:`tokenize` без комментариев и отступов,
+поэтому переформатированные копии дают тот же набор токенов.
+Из токенов строятся шинглы - последовательности из :data:`SHINGLE_SIZE`
+токенов, - и по ним вычисляется MinHash-сигнатура из :data:`NUM_PERM` чисел.
+Доля совпадающих чисел двух сигнатур оценивает коэффициент Жаккара
+множеств шинглов. Время вычисления растёт с длиной кода, поэтому для
+длинных сниппетов учитываются только первые ``SNIPPET_INDEX_MAX_LENGTH`` символов.
+
+Сигнатура хранится в модели сниппета как массив 32-битных чисел в байтах.
+Для поиска без попарного сравнения сигнатура делится на :data:`BANDS`
+полос, хеш каждой полосы (корзина) индексируется в модели
+:class:`main.models.SnippetBand`. Кандидатами считаются сниппеты,
+попавшие хотя бы в одну общую корзину.
+"""
+
+import hashlib
+import io
+import random
+import re
+import tokenize
+import zlib
+from array import array
+
+from django.conf import settings
+
+
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 3
+MAX_HASH = (1 << 32) - 1
+MERSENNE_PRIME = (1 << 61) - 1
+
+# Changing the seed or NUM_PERM invalidates all stored signatures
+_random = random.Random(1)
+PERMUTATIONS = [(_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME))
+                for _ in range(NUM_PERM)]
+
+SKIPPED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT,
+                  tokenize.DEDENT, tokenize.ENDMARKER, tokenize.ENCODING}
+FALLBACK_TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+
+def get_tokens(code):
+    """
+    Разбиение кода на нормализованные токены
+
+    Комментарии, переводы строк и отступы отбрасываются.
+    Код, который не удаётся разобрать :mod:`tokenize`, разбивается
+    регулярным выражением на слова и знаки препинания.
+
+    :param code: код
+    :return: список токенов
+    :rtype: :class:`list`
+    """
+    try:
+        return [token.string for token in tokenize.generate_tokens(io.StringIO(code).readline)
+                if token.type not in SKIPPED_TOKENS]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return FALLBACK_TOKEN_RE.findall(code)
+
+
+def get_shingles(tokens):
+    """
+    Получение хешей шинглов
+
+    :param tokens: список токенов
+    :return: множество 32-битных хешей. Для кода короче шингла
+             шинглом считается весь код
+    :rtype: :class:`set`
+    """
+    if not tokens:
+        return set()
+    size = min(SHINGLE_SIZE, len(tokens))
+    return {zlib.crc32(' '.join(tokens[i:i + size]).encode('utf8'))
+            for i in range(len(tokens) - size + 1)}
+
+
+def get_signature(code):
+    """
+    Вычисление MinHash-сигнатуры кода
+
+    Учитываются первые ``SNIPPET_INDEX_MAX_LENGTH`` символов кода.
+
+    :param code: код
+    :return: сигнатура в виде байтов (:data:`NUM_PERM` беззнаковых 32-битных чисел)
+             или ``None`` для кода без токенов
+    :rtype: :class:`bytes`
+    """
+    shingles = get_shingles(get_tokens(code[:settings.SNIPPET_INDEX_MAX_LENGTH]))
+    if not shingles:
+        return None
+    signature = array('I', (min(((a * shingle + b) % MERSENNE_PRIME) & MAX_HASH for shingle in shingles)
+                            for a, b in PERMUTATIONS))
+    return signature.tobytes()
+
+
+def load_signature(data):
+    """
+    Преобразование сохранённой сигнатуры в массив чисел
+
+    :param data: сигнатура в виде байтов
+    :rtype: :class:`array.array`
+    """
+    signature = array('I')
+    signature.frombytes(bytes(data))
+    return signature
+
+
+def get_buckets(data):
+    """
+    Получение корзин LSH для сигнатуры
+
+    Номер полосы входит в хеш, поэтому одинаковые значения
+    в разных полосах попадают в разные корзины.
+
+    :param data: сигнатура в виде байтов или ``None``
+    :return: список знаковых 64-битных номеров корзин
+    :rtype: :class:`list`
+    """
+    if not data:
+        return []
+    data = bytes(data)
+    step = len(data) // BANDS
+    return [int.from_bytes(hashlib.blake2b(bytes([band]) + data[band * step:(band + 1) * step],
+                                           digest_size=8).digest(), 'big', signed=True)
+            for band in range(BANDS)]
+
+
+def estimate_similarity(first, second):
+    """
+    Оценка коэффициента Жаккара по двум сигнатурам
+
+    :param first: сигнатура в виде байтов
+    :param second: сигнатура в виде байтов
+    :return: число от 0 до 1
+    :rtype: :class:`float`
+    """
+    first, second = load_signature(first), load_signature(second)
+    return sum(a == b for a, b in zip(first, second)) / NUM_PERM
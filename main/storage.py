@@ -0,0 +1,621 @@
+"""
+Файловое хранилище кода сниппетов
+
+Код хранится по содержимому: имя файла - SHA1-хеш кода,
+поэтому одинаковый код разных пользователей занимает один файл.
+Отформатированный код (``<sha1>_<utility>.py``) лежит в том же каталоге,
+а подсвеченный HTML - в отдельном каталоге ``MEDIA_ROOT/highlight/ab/``,
+чтобы кеш подсветки можно было обходить, не читая весь ``MEDIA_ROOT``.
+
+Расположение каталогов задаётся настройкой ``SNIPPET_STORAGE_LAYOUT``:
+
+* ``flat`` - все файлы прямо в ``MEDIA_ROOT``;
+* ``sharded`` - двухуровневое разбиение по первым символам хеша:
+  ``MEDIA_ROOT/ab/cd/abcd....py``.
+
+На время переноса файлов между схемами (``manage.py migrate_storage``)
+старые схемы перечисляются в ``SNIPPET_STORAGE_LEGACY_LAYOUTS``:
+запись идёт только по новой схеме, а чтение при промахе
+продолжается по старым.
+
+Код может храниться в сжатом виде (``SNIPPET_STORAGE_COMPRESSION``),
+а отформатированные варианты - в виде разницы с оригиналом
+(``SNIPPET_STORAGE_DELTAS``). Формат файла определяется
+по первым байтам, поэтому чтение прозрачно и файлы
+разных форматов могут лежать рядом.
+"""
+
+import difflib
+import json
+import os
+import re
+import tempfile
+import threading
+import weakref
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:  # optional dependency, zlib is used instead
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, locks work only between threads
+    fcntl = None
+
+SHA1_RE = re.compile(r'^[0-9a-f]{40}(?=[._])')
+
+
+def parse_sha1(name):
+    """
+    Получение SHA1-хеша из имени файла хранилища
+
+    :param name: имя файла без каталога
+    :return: хеш или ``None`` для посторонних и временных файлов
+    :rtype: :class:`str`
+    """
+    match = SHA1_RE.match(name)
+    return match.group(0) if match else None
+
+
+class FlatLayout:
+    """
+    Все файлы в одном каталоге ``MEDIA_ROOT``
+    """
+
+    @staticmethod
+    def get_dir(sha1):  # pylint: disable=unused-argument
+        """
+        Получение каталога для файлов с указанным хешем
+
+        :param sha1: SHA1-хеш кода
+        :return: путь к каталогу
+        :rtype: :class:`str`
+        """
+        return settings.MEDIA_ROOT
+
+    @staticmethod
+    def iter_files():
+        """
+        Обход файлов, лежащих по этой схеме
+
+        Файлы блокировок (:func:`lock_file`) пропускаются.
+
+        :return: генератор пар (SHA1-хеш, имя файла)
+        """
+        with os.scandir(settings.MEDIA_ROOT) as entries:
+            for entry in entries:
+                sha1 = parse_sha1(entry.name)
+                if sha1 and not entry.name.endswith(LOCK_SUFFIX) and entry.is_file():
+                    yield sha1, entry.path
+
+
+class ShardedLayout:
+    """
+    Двухуровневое разбиение ``MEDIA_ROOT/ab/cd/`` по первым символам хеша
+
+    Держит количество файлов в каждом каталоге небольшим даже
+    при миллионах сниппетов.
+    """
+
+    @staticmethod
+    def get_dir(sha1):
+        """
+        Получение каталога для файлов с указанным хешем
+
+        :param sha1: SHA1-хеш кода
+        :return: путь к каталогу
+        :rtype: :class:`str`
+        """
+        return os.path.join(settings.MEDIA_ROOT, sha1[:2], sha1[2:4])
+
+    @staticmethod
+    def iter_files():
+        """
+        Обход файлов, лежащих по этой схеме
+
+        Файлы блокировок (:func:`lock_file`) пропускаются.
+
+        :return: генератор пар (SHA1-хеш, имя файла)
+        """
+        for root, _, names in os.walk(settings.MEDIA_ROOT):
+            if os.path.relpath(root, settings.MEDIA_ROOT).count(os.sep) != 1:
+                continue
+            for name in names:
+                sha1 = parse_sha1(name)
+                if sha1 and not name.endswith(LOCK_SUFFIX) and root == ShardedLayout.get_dir(sha1):
+                    yield sha1, os.path.join(root, name)
+
+
+HTML_DIR = 'highlight'
+
+
+def get_html_dir(sha1):
+    """
+    Получение каталога подсвеченного HTML для файлов с указанным хешем
+
+    :param sha1: SHA1-хеш кода или имя производного от него файла
+    :return: путь к каталогу
+    :rtype: :class:`str`
+    """
+    return os.path.join(settings.MEDIA_ROOT, HTML_DIR, sha1[:2])
+
+
+LAYOUTS = {
+    'flat': FlatLayout,
+    'sharded': ShardedLayout,
+}
+
+
+def get_layout(name=None):
+    """
+    Получение схемы расположения файлов
+
+    :param name: название схемы. По умолчанию - из настроек проекта
+    :return: класс схемы
+    """
+    return LAYOUTS[name or settings.SNIPPET_STORAGE_LAYOUT]
+
+
+def get_filename(sha1, modifier=None, layout=None):
+    """
+    Получение имени файла с кодом
+
+    * Формат 1: sha1hash.py
+    * Формат 2 (если указана утилита): sha1hash_utility.py
+
+    :param sha1: SHA1-хеш кода
+    :param modifier: имя утилиты
+    :param layout: название схемы расположения
+    :return: Имя файла
+    :rtype: :class:`str`
+    """
+    name = sha1
+    if modifier:
+        name += '_' + modifier
+    return os.path.join(get_layout(layout).get_dir(sha1), name + '.py')
+
+
+def get_legacy_paths(path):
+    """
+    Получение имён того же файла в старых схемах расположения
+
+    :param path: имя файла в текущей схеме
+    :return: список имён файлов
+    :rtype: :class:`list`
+    """
+    name = os.path.basename(path)
+    sha1 = parse_sha1(name)
+    if not sha1:
+        return []
+    return [os.path.join(get_layout(layout).get_dir(sha1), name)
+            for layout in settings.SNIPPET_STORAGE_LEGACY_LAYOUTS]
+
+
+def resolve(path):
+    """
+    Поиск файла с учётом старых схем расположения
+
+    Текущая схема проверяется повторно в конце, чтобы не промахнуться,
+    если файл был перенесён между проверками.
+
+    :param path: имя файла в текущей схеме
+    :return: имя существующего файла или ``None``
+    :rtype: :class:`str`
+    """
+    for candidate in [path] + get_legacy_paths(path) + [path]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def exists(path):
+    """
+    Проверка существования файла с учётом старых схем расположения
+
+    :param path: имя файла в текущей схеме
+    :rtype: :class:`bool`
+    """
+    return resolve(path) is not None
+
+
+def write_file(path, data):
+    """
+    Атомарная запись файла
+
+    Данные пишутся во временный файл в том же каталоге,
+    который затем переименовывается в целевой. Читатели никогда
+    не видят наполовину записанный файл.
+
+    :param path: имя файла
+    :param data: содержимое
+    :type data: :class:`bytes`
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+LOCK_SUFFIX = '.lock'
+_thread_locks = weakref.WeakValueDictionary()
+_thread_locks_guard = threading.Lock()
+
+
+@contextmanager
+def lock_file(path):
+    """
+    Исключительная блокировка файла между потоками и процессами
+
+    Внутри процесса используется :class:`threading.Lock` на каждое имя файла,
+    между процессами - :func:`fcntl.flock` на файл ``<имя>.lock`` рядом с ним.
+    Файл блокировки удаляется владельцем перед снятием блокировки,
+    поэтому в хранилище он существует только на время работы.
+    Процесс, дождавшийся блокировки уже удалённого файла, сверяет
+    номер inode с файлом по имени и при расхождении повторяет попытку.
+
+    :param path: имя блокируемого файла
+    """
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.get(path)
+        if thread_lock is None:
+            thread_lock = _thread_locks[path] = threading.Lock()
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_path = path + LOCK_SUFFIX
+        while True:
+            file = open(lock_path, 'ab')
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(file.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            file.close()  # the previous owner removed this lock file, take a new one
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+            file.close()
+
+
+ZLIB_MAGIC = b'\x00ZL'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+DELTA_MAGIC = b'\x00DL'
+
+
+def compress(data):
+    """
+    Сжатие данных алгоритмом из настройки ``SNIPPET_STORAGE_COMPRESSION``
+
+    Если выбран ``zstd``, но модуль ``zstandard`` не установлен,
+    используется ``zlib`` из стандартной библиотеки.
+
+    :param data: исходные данные
+    :type data: :class:`bytes`
+    :return: сжатые данные с сигнатурой формата
+    :rtype: :class:`bytes`
+    """
+    method = settings.SNIPPET_STORAGE_COMPRESSION
+    if not method:
+        return data
+    if method == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(data)
+    return ZLIB_MAGIC + zlib.compress(data)
+
+
+def decompress(data):
+    """
+    Распаковка данных по сигнатуре формата
+
+    :param data: данные из файла
+    :type data: :class:`bytes`
+    :return: распакованные данные
+    :rtype: :class:`bytes`
+    """
+    if data.startswith(ZLIB_MAGIC):
+        return zlib.decompress(data[len(ZLIB_MAGIC):])
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError('Для чтения файла требуется модуль zstandard')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def make_delta(base_sha1, base_code, code):
+    """
+    Построение разницы между оригинальным и отформатированным кодом
+
+    Разница - список операций по строкам: пара ``[начало, конец]``
+    означает копирование строк оригинала, строка - вставку текста.
+
+    :param base_sha1: SHA1-хеш оригинального кода
+    :param base_code: оригинальный код
+    :param code: отформатированный код
+    :return: разница с сигнатурой формата
+    :rtype: :class:`bytes`
+    """
+    base_lines = base_code.splitlines(keepends=True)
+    lines = code.splitlines(keepends=True)
+    operations = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, base_start, base_end, start, end in matcher.get_opcodes():
+        if tag == 'equal':
+            operations.append([base_start, base_end])
+        elif start != end:
+            operations.append(''.join(lines[start:end]))
+    payload = json.dumps(operations, ensure_ascii=False, separators=(',', ':'))
+    return DELTA_MAGIC + base_sha1.encode('ascii') + payload.encode('utf8')
+
+
+def apply_delta(data):
+    """
+    Восстановление кода по разнице с оригиналом
+
+    :param data: разница с сигнатурой формата
+    :type data: :class:`bytes`
+    :return: код
+    :rtype: :class:`str`
+    """
+    header = len(DELTA_MAGIC)
+    base_sha1 = data[header:header + 40].decode('ascii')
+    base_lines = load_code(get_filename(base_sha1)).splitlines(keepends=True)
+    parts = []
+    for operation in json.loads(data[header + 40:].decode('utf8')):
+        if isinstance(operation, str):
+            parts.append(operation)
+        else:
+            parts.extend(base_lines[operation[0]:operation[1]])
+    return ''.join(parts)
+
+
+def save_code(path, code, base=None):
+    """
+    Атомарное сохранение кода в файл
+
+    :param path: имя файла
+    :param code: код
+    :type code: :class:`str`
+    :param base: имя файла, от которого получен код. Если указано и включена
+                 настройка ``SNIPPET_STORAGE_DELTAS``, сохраняется разница
+                 с оригиналом (файлом ``<sha1>.py`` по хешу из имени),
+                 когда она короче самого кода
+    """
+    data = code.encode('utf8')
+    base_sha1 = parse_sha1(os.path.basename(base)) if base else None
+    if base_sha1 and settings.SNIPPET_STORAGE_DELTAS:
+        delta = make_delta(base_sha1, load_code(get_filename(base_sha1)), code)
+        if len(delta) < len(data):
+            data = delta
+    write_file(path, compress(data))
+
+
+def load_code(path):
+    """
+    Загрузка кода из файла
+
+    Сжатые файлы распаковываются, разницы применяются к оригиналу,
+    переводы строк приводятся к ``\\n``.
+
+    :param path: имя файла
+    :raises: :class:`FileNotFoundError` в случае отсутствия файла
+    :return: код
+    :rtype: :class:`str`
+    """
+    with open(resolve(path) or path, 'rb') as file:
+        data = decompress(file.read())
+    if data.startswith(DELTA_MAGIC):
+        return apply_delta(data)
+    return data.decode('utf8').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def get_code_size(sha1):
+    """
+    Получение размера хранимого кода
+
+    :param sha1: SHA1-хеш кода
+    :return: размер кода в байтах (UTF-8) или 0, если файла нет
+    :rtype: :class:`int`
+    """
+    try:
+        return len(load_code(get_filename(sha1)).encode('utf8'))
+    except FileNotFoundError:
+        return 0
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def open_plain(path):
+    """
+    Открытие файла для отдачи без преобразования
+
+    Несжатый файл с кодом (не разница) можно передать клиенту как есть,
+    в том числе средствами сервера без копирования (``sendfile``).
+
+    :param path: имя файла
+    :raises: :class:`FileNotFoundError` в случае отсутствия файла
+    :return: открытый на чтение бинарный файл или ``None``,
+             если файл сжат или хранит разницу
+    """
+    file = open(resolve(path) or path, 'rb')
+    head = file.read(max(len(ZLIB_MAGIC), len(ZSTD_MAGIC), len(DELTA_MAGIC)))
+    if head.startswith((ZLIB_MAGIC, ZSTD_MAGIC, DELTA_MAGIC)):
+        file.close()
+        return None
+    file.seek(0)
+    return file
+
+
+def iter_decompressed(path, chunk_size):
+    """
+    Потоковая распаковка файла
+
+    :param path: имя файла
+    :param chunk_size: размер читаемого куска в байтах
+    :return: генератор кусков распакованных данных
+    """
+    with open(resolve(path) or path, 'rb') as file:
+        head = file.read(len(ZSTD_MAGIC))
+        if head.startswith(ZLIB_MAGIC):
+            file.seek(len(ZLIB_MAGIC))
+            decompressor = zlib.decompressobj()
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                yield decompressor.decompress(chunk)
+            yield decompressor.flush()
+            return
+        file.seek(0)
+        if head.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise RuntimeError('Для чтения файла требуется модуль zstandard')
+            reader = zstandard.ZstdDecompressor().stream_reader(file)
+            yield from iter(lambda: reader.read(chunk_size), b'')
+            return
+        yield from iter(lambda: file.read(chunk_size), b'')
+
+
+def iter_code(path, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Потоковое чтение кода в кодировке UTF-8
+
+    Сжатые файлы распаковываются кусками, поэтому объём памяти
+    не зависит от размера кода. Разница с оригиналом
+    восстанавливается целиком через :func:`load_code`.
+
+    :param path: имя файла
+    :param chunk_size: размер читаемого куска в байтах
+    :raises: :class:`FileNotFoundError` в случае отсутствия файла
+    :return: генератор кусков кода
+    """
+    chunks = iter_decompressed(path, chunk_size)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(DELTA_MAGIC):
+            break
+    if head.startswith(DELTA_MAGIC):
+        chunks.close()
+        yield load_code(path).encode('utf8')
+        return
+    if head:
+        yield head
+    yield from chunks
+
+
+def list_blob_files(directory, sha1):
+    """
+    Получение списка файлов каталога, относящихся к хешу
+
+    :param directory: каталог
+    :param sha1: SHA1-хеш кода
+    :return: список имён файлов
+    :rtype: :class:`list`
+    """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in names
+            if name.startswith(sha1) and name[len(sha1):len(sha1) + 1] in ('.', '_')]
+
+
+def get_blob_files(sha1, layout=None):
+    """
+    Получение списка всех файлов схемы расположения, относящихся к хешу:
+    оригинала и форматированных вариантов
+
+    :param sha1: SHA1-хеш кода
+    :param layout: название схемы расположения
+    :return: список имён файлов
+    :rtype: :class:`list`
+    """
+    return list_blob_files(get_layout(layout).get_dir(sha1), sha1)
+
+
+def remove_blob_files(sha1):
+    """
+    Удаление всех файлов, относящихся к хешу, в текущей и старых схемах
+    и подсвеченного HTML
+
+    Файлы блокировок не трогаются: их удаляют владельцы (:func:`lock_file`),
+    а сборщик мусора сам удерживает блокировку оригинального файла.
+
+    :param sha1: SHA1-хеш кода
+    :return: количество удалённых файлов
+    :rtype: :class:`int`
+    """
+    layouts = {settings.SNIPPET_STORAGE_LAYOUT}
+    layouts.update(settings.SNIPPET_STORAGE_LEGACY_LAYOUTS)
+    paths = list_blob_files(get_html_dir(sha1), sha1)
+    for layout in layouts:
+        paths.extend(get_blob_files(sha1, layout))
+    return sum(remove_file(path) for path in paths if not path.endswith(LOCK_SUFFIX))
+
+
+def remove_file(path):
+    """
+    Удаление файла, если он ещё существует
+
+    :param path: имя файла
+    :return: 1, если файл удалён, иначе 0
+    :rtype: :class:`int`
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return 1
+
+
+def iter_stored_files():
+    """
+    Обход всех файлов хранилища независимо от схемы расположения
+
+    Временные файлы, файлы блокировок и файлы, чьё имя
+    не начинается с SHA1-хеша, пропускаются.
+
+    :return: генератор пар (SHA1-хеш, имя файла)
+    """
+    for root, _, names in os.walk(settings.MEDIA_ROOT):
+        for name in names:
+            sha1 = parse_sha1(name)
+            if sha1 and not name.endswith(LOCK_SUFFIX):
+                yield sha1, os.path.join(root, name)
+
+
+def move_file(path, layout):
+    """
+    Перенос файла в каталог другой схемы расположения
+
+    Перенос выполняется переименованием, поэтому файл всегда виден
+    читателям хотя бы по одному из имён. Если файл уже есть в новой схеме,
+    старая копия просто удаляется: содержимое совпадает по построению.
+
+    :param path: имя файла
+    :param layout: название новой схемы
+    :return: новое имя файла
+    :rtype: :class:`str`
+    """
+    name = os.path.basename(path)
+    target = os.path.join(get_layout(layout).get_dir(parse_sha1(name)), name)
+    if target == path:
+        return target
+    if os.path.exists(target):
+        remove_file(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    return target
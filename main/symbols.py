@@ -0,0 +1,93 @@
+"""
+Извлечение символов из кода сниппетов
+
+Код разбирается модулем :mod:`ast`, из дерева извлекаются
+определения функций и классов, импортируемые модули и имена
+вызываемых функций. Результат хранится в модели
+:class:`main.models.SnippetSymbol` и позволяет отвечать на вопросы
+«кто импортирует numpy» без повторного разбора файлов.
+"""
+
+import ast
+
+from django.conf import settings
+
+
+DEFINITION = 'def'
+CLASS = 'class'
+IMPORT = 'import'
+CALL = 'call'
+SYMBOL_KINDS = (
+    (DEFINITION, 'Определение функции'),
+    (CLASS, 'Определение класса'),
+    (IMPORT, 'Импорт модуля'),
+    (CALL, 'Вызов функции'),
+)
+MAX_NAME_LENGTH = 200
+
+
+def get_call_name(node):
+    """
+    Получение имени вызываемой функции
+
+    Для ``f()`` возвращается ``f``, для ``np.linalg.norm()`` - ``norm``.
+
+    :param node: узел :class:`ast.Call`
+    :return: имя или ``None``, если функция вычисляется выражением
+    :rtype: :class:`str`
+    """
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    return None
+
+
+def get_module_names(module):
+    """
+    Получение имени модуля и всех его родительских пакетов
+
+    Для ``numpy.linalg`` возвращаются ``numpy.linalg`` и ``numpy``.
+
+    :param module: полное имя модуля
+    :return: список имён
+    :rtype: :class:`list`
+    """
+    parts = module.split('.')
+    return ['.'.join(parts[:length]) for length in range(len(parts), 0, -1)]
+
+
+def extract_symbols(code):
+    """
+    Извлечение символов из кода
+
+    :param code: код
+    :return: множество пар (вид символа, имя). Для кода
+             с синтаксическими ошибками или слишком глубокой вложенностью,
+             на которой переполняется стек парсера, и для кода длиннее
+             ``SNIPPET_INDEX_MAX_LENGTH`` символов - пустое множество
+    :rtype: :class:`set`
+    """
+    if len(code) > settings.SNIPPET_INDEX_MAX_LENGTH:
+        return set()
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError, MemoryError, RecursionError):
+        return set()
+    symbols = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            symbols.add((DEFINITION, node.name))
+        elif isinstance(node, ast.ClassDef):
+            symbols.add((CLASS, node.name))
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                symbols.update((IMPORT, name) for name in get_module_names(alias.name))
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            symbols.update((IMPORT, name) for name in get_module_names(node.module))
+        elif isinstance(node, ast.Call):
+            name = get_call_name(node)
+            if name:
+                symbols.add((CALL, name))
+    return {(kind, name[:MAX_NAME_LENGTH]) for kind, name in symbols}
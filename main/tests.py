@@ -1,10 +1,35 @@
+import asyncio
+import datetime
+import io
+import json
 import os
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 from django.contrib.auth.models import User
-from django.test import TestCase, Client
-from django.urls import reverse
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
 
-from main.models import Snippet
+from main import async_views, metrics, page_cache, search, storage
+from main.benchmark import Benchmark, benchmark_environment, compare_results
+from main.bulk import SnippetImporter, SnippetRecord, insert_snippets
+from main.hashing import CHUNK_SIZE, get_digests
+from main.highlight import HighlightCache
+from main.jobs import claim_pending_jobs, enqueue_format_job, get_warm_up_utilities, \
+    process_pending_jobs, schedule_warm_up, warmer
+from main.models import Blob, Snippet, SnippetBand, SnippetStats, SnippetSymbol, FormatJob
+from main.formatter import AVAILABLE_FORMATTERS, Pep8Formatter
+from main.similarity import get_buckets, get_signature
+from main.symbols import extract_symbols
+from main.workers import FormatterError, FormatterPool
 
 
 class TestIndexPage(TestCase):
@@ -57,6 +82,47 @@ class TestViewSnippetPage(TestCase):
         response = self.c.get(reverse('view_snippet', kwargs={'snippet_id': self.record.id}))
         self.assertEqual(response.status_code, 200)
 
+    def test_find_by_hash(self):
+        for digest in (self.record.md5, self.record.sha1, self.record.sha256.upper()):
+            response = self.c.get(reverse('find_snippet_by_hash', kwargs={'digest': digest}))
+            self.assertRedirects(response, reverse('view_snippet', kwargs={'snippet_id': self.record.id}))
+        response = self.c.get(reverse('find_snippet_by_hash', kwargs={'digest': '0' * 64}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_stylesheet(self):
+        response = self.c.get(reverse('view_snippet', kwargs={'snippet_id': self.record.id}))
+        css = self.c.get(response.context['pygmentstyle_url'])
+        self.assertEqual(css.status_code, 200)
+        self.assertIn('immutable', css['Cache-Control'])
+        response = self.c.get(reverse('pygments_css', kwargs={'style': 'default', 'fingerprint': '0'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_conditional(self):
+        url = reverse('view_snippet', kwargs={'snippet_id': self.record.id})
+        self.assertNotIn('ETag', self.c.get(url))  # shows the pending "added" message
+        etag = self.c.get(url)['ETag']
+        self.assertEqual(self.c.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        format_url = reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'pep8'})
+        format_etag = self.c.get(format_url)['ETag']
+        self.assertNotEqual(format_etag, etag)
+        self.assertEqual(self.c.get(format_url, HTTP_IF_NONE_MATCH=format_etag).status_code, 304)
+        self.c.post(reverse('add_snippet'), {'name': 'new', 'code': 'pass'})
+        self.c.get(url)
+        self.assertEqual(self.c.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_raw(self):
+        url = reverse('raw_snippet', kwargs={'snippet_id': self.record.id})
+        response = self.c.get(url)
+        self.assertEqual(b''.join(response.streaming_content), b'   a    =   b   +   c   ')
+        self.assertEqual(response['ETag'], '"{}"'.format(self.record.sha1))
+        self.assertEqual(self.c.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        response = self.c.get(reverse('raw_format', kwargs={'snippet_id': self.record.id, 'utility': 'pep8'}),
+                              {'download': ''})
+        self.assertEqual(b''.join(response.streaming_content), b'a = b + c\n')
+        self.assertIn('attachment', response['Content-Disposition'])
+        response = self.c.get(reverse('raw_format', kwargs={'snippet_id': self.record.id, 'utility': 'x'}))
+        self.assertEqual(response.status_code, 404)
+
 
 class TestViewMySnippetPage(TestCase):
     fixtures = ['test_db.json']
@@ -74,6 +140,20 @@ class TestViewMySnippetPage(TestCase):
         self.response = self.c.post(reverse('my_snippets'))
         self.assertEqual(self.response.context['count'], 2)
 
+    @override_settings(SNIPPETS_PAGE_SIZE=2)
+    def test_pages(self):
+        for name in ('1', '2', '3'):
+            self.c.post(reverse('add_snippet'), {'name': name, 'code': 'import this'})
+        names = []
+        url = reverse('my_snippets')
+        while url:
+            response = self.c.get(url)
+            names.extend(record.name for record in response.context['records'])
+            cursor = response.context['next_cursor']
+            url = '{}?after={}'.format(reverse('my_snippets'), cursor) if cursor else None
+        self.assertEqual(names, ['3', '2', '1', 'Классная работа', 'test'])
+        self.assertEqual(response.context['count'], 5)
+
 
 class TestDeleteSnippetPage(TestCase):
     fixtures = ['test_db.json']
@@ -92,6 +172,464 @@ class TestDeleteSnippetPage(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+class TestSnippetStats(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.c = Client()
+        self.user = User.objects.get(username='vasya')
+        self.c.force_login(self.user)
+
+    def test_incremental(self):
+        self.assertEqual(SnippetStats.for_user(self.user).count, 2)
+        self.c.post(reverse('add_snippet'), {'name': 'stats', 'code': 'abc'})
+        record = Snippet.objects.get(name='stats')
+        stats = SnippetStats.for_user(self.user)
+        self.assertEqual((stats.count, stats.total_bytes, stats.last_created), (3, 3, record.creation_date))
+        self.c.post(reverse('delete_snippet', kwargs={'snippet_id': record.id}), {'confirm': '1'})
+        stats = SnippetStats.for_user(self.user)
+        self.assertEqual((stats.count, stats.total_bytes), (2, 0))
+        self.assertEqual(stats.last_created, Snippet.objects.get(pk=10).creation_date)
+
+    def test_dashboard(self):
+        SnippetStats.rebuild(self.user.id)  # fixtures bypass the backfill migration
+        response = self.c.get(reverse('stats'))
+        self.assertEqual(response.context['totals']['snippets'], 2)
+        self.assertEqual(response.context['top'][0].user, self.user)
+
+
+class TestMetrics(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.c = Client()
+        self.user = User.objects.get(username='vasya')
+        self.c.force_login(self.user)
+        metrics.registry.clear()
+        page_cache.get_cache().clear()
+
+    def test_server_timing(self):
+        response = self.c.get(reverse('my_snippets'))
+        stages = [item.split(';')[0] for item in response['Server-Timing'].split(', ')]
+        self.assertIn('db', stages)
+        self.assertIn('render', stages)
+        self.assertEqual(stages[-1], 'total')
+
+    def test_async_middleware(self):
+        async def get_response(request):  # pylint: disable=unused-argument
+            with metrics.timed('read'):
+                return HttpResponse()
+
+        middleware = metrics.TimingMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = asyncio.run(middleware(RequestFactory().get('/')))
+        stages = [item.split(';')[0] for item in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['read', 'total'])
+
+    def test_prometheus(self):
+        self.c.get(reverse('my_snippets'))
+        response = self.c.get(reverse('metrics'))
+        self.assertContains(response, 'snippet_request_duration_seconds{view="my_snippets",quantile="0.99"}')
+        self.assertContains(response, 'snippet_stage_duration_seconds_count{view="my_snippets",stage="db"} 1')
+        self.c.force_login(User.objects.create_user('petya'))
+        self.assertEqual(self.c.get(reverse('metrics')).status_code, 302)
+
+
+class TestSearchPage(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.c = Client()
+        self.c.force_login(User.objects.get(username='vasya'))
+        self.c.post(reverse('add_snippet'), {'name': 'search', 'code': 'def find_me_please(x):\n    return x < 1\n'})
+        self.record = Snippet.objects.get(name='search')
+
+    def test_search(self):
+        response = self.c.get(reverse('search'), {'q': 'me_plea'})
+        self.assertEqual([item['id'] for item in response.context['results']], [self.record.id])
+        self.assertIn('<mark>me_plea</mark>', response.context['results'][0]['excerpt'])
+        self.assertIn('&lt;', response.context['results'][0]['excerpt'])
+        self.assertTrue(self.c.get(reverse('search'), {'q': 'ab'}).context['query_too_short'])
+        self.record.delete()
+        response = self.c.get(reverse('search'), {'q': 'me_plea'})
+        self.assertEqual(response.context['results'], [])
+
+    def test_other_user(self):
+        self.c.force_login(User.objects.create_user('petya'))
+        response = self.c.get(reverse('search'), {'q': 'find_me'})
+        self.assertEqual(response.context['results'], [])
+
+    def test_name_and_code(self):
+        response = self.c.get(reverse('search'), {'q': 'searc find_me'})
+        self.assertEqual([item['id'] for item in response.context['results']], [self.record.id])
+
+    def test_contentless(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT code FROM {} WHERE rowid = %s'.format(search.FTS_TABLE), [self.record.id])
+            self.assertEqual(cursor.fetchall(), [(None,)])
+        record = Snippet.objects.get(id=self.record.id)
+        record.code = 'def other_name(y):\r\n    return y\r\n'
+        record.save()
+        self.assertEqual(search.search(record.user_id, 'me_plea', 0, 10), [])
+        self.assertEqual([item['id'] for item in search.search(record.user_id, 'other_na', 0, 10)], [record.id])
+        record.delete()
+        self.assertEqual(search.search(record.user_id, 'other_na', 0, 10), [])
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO {0} ({0}) VALUES ('integrity-check')".format(search.FTS_TABLE))
+
+
+class TestSymbolIndex(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.c = Client()
+        self.c.force_login(User.objects.get(username='vasya'))
+        self.c.post(reverse('add_snippet'), {'name': 'symbols', 'code': 'import numpy.linalg\ndef main(): print(1)\n'})
+        self.record = Snippet.objects.get(name='symbols')
+
+    def find(self, kind, name):
+        response = self.c.get(reverse('symbols'), {'kind': kind, 'name': name})
+        return [record.id for record in response.context['records']]
+
+    def test_query(self):
+        self.assertEqual(self.find('import', 'numpy'), [self.record.id])
+        self.assertEqual(self.find('def', 'main'), [self.record.id])
+        self.assertEqual(self.find('call', 'print'), [self.record.id])
+        self.assertEqual(self.find('import', 'scipy'), [])
+
+    def test_rebuild(self):
+        SnippetSymbol.objects.all().delete()
+        call_command('index_symbols', '--missing', '--workers', '1', stdout=io.StringIO())
+        self.assertEqual(self.find('import', 'numpy.linalg'), [self.record.id])
+
+    def test_parser_overflow(self):
+        response = self.c.post(reverse('add_snippet'), {'name': 'deep', 'code': '-' * 4000 + '1'})
+        record = Snippet.objects.get(name='deep')  # RecursionError in the parser
+        self.assertRedirects(response, reverse('view_snippet', kwargs={'snippet_id': record.id}),
+                             fetch_redirect_response=False)
+        record = Snippet(name='huge', creation_date=timezone.now(), user=record.user)
+        record.code = '-' * 200000 + '1'  # MemoryError in the parser
+        record.save()
+        self.assertFalse(SnippetSymbol.objects.filter(snippet__name__in=['deep', 'huge']).exists())
+
+
+class TestSimilarSnippets(TestCase):
+    fixtures = ['test_db.json']
+    code = 'def add(first, second):\n    total = first + second\n    print(total)\n    return total\n'
+
+    def setUp(self):
+        self.c = Client()
+        self.c.force_login(User.objects.get(username='vasya'))
+        self.c.post(reverse('add_snippet'), {'name': 'original', 'code': self.code})
+        self.c.post(reverse('add_snippet'), {'name': 'reformatted',
+                                             'code': '# sum\ndef add( first,second ):\n  total=first+second\n'
+                                                     '  print( total )\n  return total\n'})
+        self.c.post(reverse('add_snippet'), {'name': 'other', 'code': 'import os\nprint(os.getcwd())\n'})
+        self.record = Snippet.objects.get(name='original')
+
+    def test_similar(self):
+        response = self.c.get(reverse('view_snippet', kwargs={'snippet_id': self.record.id}))
+        self.assertEqual([(item.name, score) for item, score in response.context['similar']],
+                         [('reformatted', 1.0)])
+
+    @override_settings(SNIPPET_INDEX_MAX_LENGTH=len(code))
+    def test_long_code(self):
+        long_code = self.code + 'import os\n' * 10
+        self.assertEqual(get_signature(long_code), get_signature(self.code))
+        self.assertEqual(extract_symbols(long_code), set())
+        self.assertIn(('def', 'add'), extract_symbols(self.code))
+
+    def test_rebuild(self):
+        SnippetBand.objects.all().delete()
+        Snippet.objects.update(minhash=None)
+        call_command('index_similarity', '--missing', '--workers', '1', stdout=io.StringIO())
+        similar = Snippet.objects.get(id=self.record.id).get_similar(0.5, 5, 100)
+        self.assertEqual([item.name for item, _ in similar], ['reformatted'])
+
+    def test_rebuild_batches(self):
+        Snippet.objects.update(minhash=None)
+        out = io.StringIO()
+        call_command('index_similarity', '--missing', '--workers', '1', '--batch-size', '1', stdout=out)
+        self.assertTrue(out.getvalue().endswith('Обработано сниппетов: 3\n'))  # fixture snippets have no files
+        names = ['original', 'reformatted', 'other']
+        self.assertFalse(Snippet.objects.filter(name__in=names, minhash__isnull=True).exists())
+
+
+class TestBulkTransfer(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='vasya')
+        self.tempdir = tempfile.TemporaryDirectory()
+        for number in range(3):
+            record = Snippet(name='bulk{}'.format(number), creation_date=timezone.now(), user=self.user)
+            record.code = 'import numpy\nvalue = {}\n'.format(number % 2)
+            record.save()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def roundtrip(self, filename):
+        path = os.path.join(self.tempdir.name, filename)
+        call_command('export_snippets', path, '--user', 'vasya', stderr=io.StringIO())
+        Snippet.objects.filter(name__startswith='bulk').delete()
+        blob = Blob.objects.get(sha1=get_digests('import numpy\nvalue = 0\n').sha1)
+        call_command('import_snippets', path, '--workers', '1', '--batch-size', '2', stdout=io.StringIO())
+        records = Snippet.objects.filter(name__startswith='bulk').order_by('name')
+        self.assertEqual([record.name for record in records], ['bulk0', 'bulk1', 'bulk2'])
+        self.assertEqual(records[2].get_code(), 'import numpy\nvalue = 0\n')
+        self.assertEqual(Blob.objects.get(pk=blob.pk).refcount, 2)
+        self.assertEqual(SnippetStats.objects.get(user=self.user).count,
+                         Snippet.objects.filter(user=self.user).count())
+        self.assertEqual(SnippetSymbol.objects.filter(kind='import', name='numpy').count(), 3)
+        self.assertEqual([(item.name, score) for item, score in records[0].get_similar(1.0, 5, 100)],
+                         [('bulk2', 1.0)])
+
+    def test_jsonl(self):
+        self.roundtrip('dump.jsonl')
+
+    def test_tar(self):
+        self.roundtrip('dump.tar.gz')
+
+    def test_unknown_user(self):
+        path = os.path.join(self.tempdir.name, 'dump.jsonl')
+        with open(path, 'w') as file:
+            file.write('{"name": "x", "user": "nobody", "code": "pass"}\n')
+        with override_settings(MEDIA_ROOT=self.tempdir.name), self.assertRaises(CommandError):
+            call_command('import_snippets', path, '--workers', '1', stdout=io.StringIO())
+        self.assertEqual(os.listdir(self.tempdir.name), ['dump.jsonl'])
+
+    def test_file_collected_during_import(self):
+
+        class CollectingExecutor:
+
+            @staticmethod
+            def map(func, codes):
+                prepared = [func(code) for code in codes]
+                for item in prepared:  # as a concurrent GC run would
+                    storage.remove_blob_files(item.digests.sha1)
+                return prepared
+
+        with override_settings(MEDIA_ROOT=self.tempdir.name):
+            importer = SnippetImporter(CollectingExecutor(), 10, self.user)
+            self.assertEqual(list(importer.run([SnippetRecord('gc', None, timezone.now(), 'e = 5\n')])), [1])
+            self.assertEqual(Snippet.objects.get(name='gc').get_code(), 'e = 5\n')
+
+    def test_insert_ids(self):
+        sha1 = get_digests('pass').sha1
+        snippets = [Snippet(name=name, creation_date=timezone.now(), user=self.user, sha1=sha1)
+                    for name in ('same', 'other', 'same', 'last')]
+        insert_snippets(snippets)
+        self.assertEqual(len({snippet.id for snippet in snippets}), 4)
+        for snippet in snippets:
+            self.assertEqual(Snippet.objects.get(id=snippet.id).name, snippet.name)
+
+    def test_insert_ids_concurrent(self):
+        sha1 = get_digests('pass').sha1
+        bulk_create = Snippet.objects.bulk_create
+
+        def create_with_concurrent_save(snippets):
+            bulk_create(snippets)
+            # another process saves a snippet with the same user, hash and name
+            record = Snippet(name='same', creation_date=timezone.now(), user=self.user)
+            record.code = 'pass'
+            record.save()
+
+        snippets = [Snippet(name='same', creation_date=timezone.now(), user=self.user, sha1=sha1)]
+        with mock.patch.object(Snippet.objects, 'bulk_create', create_with_concurrent_save):
+            insert_snippets(snippets)
+        self.assertEqual(snippets[0].id, Snippet.objects.filter(name='same').order_by('id').first().id)
+
+
+class TestBenchmark(TestCase):
+    fixtures = ['test_db.json']
+
+    def test_run(self):
+        count = Snippet.objects.count()
+        with benchmark_environment():
+            results = Benchmark(2, 10, 1).run()['results']
+        for name in ['snippet.save', 'snippet.get_code', 'highlight', 'view.view_snippet', 'view.stats'] + \
+                ['format.' + utility for utility in AVAILABLE_FORMATTERS]:
+            self.assertEqual(results[name]['cold']['count'], 2)
+            self.assertEqual(results[name]['warm']['count'], 2)
+        self.assertIn('render', results['view.view_snippet']['cold']['server_timing_ms'])
+        self.assertEqual(Snippet.objects.count(), count + 2)  # the command runs on a throwaway test database
+        baseline = {'results': {'highlight': {'cold': {'p50_ms': 0.001}, 'warm': {'p50_ms': 1000.0}}}}
+        self.assertEqual(compare_results(baseline, {'results': results}, 0.2)[0][:2], ('highlight', 'cold'))
+
+    def test_bad_arguments(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark', '--snippets', '0')
+
+
+class TestPageCache(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.c = Client()
+        self.c.force_login(User.objects.get(username='vasya'))
+        self.c.post(reverse('add_snippet'), {'name': 'cached', 'code': 'x = 1\n'})
+        self.record = Snippet.objects.get(name='cached')
+        self.url = reverse('view_snippet', kwargs={'snippet_id': self.record.id})
+        self.c.get(self.url)  # shows the pending "added" message, not cached
+
+    def test_hit(self):
+        first = self.c.get(self.url)
+        Snippet.objects.filter(id=self.record.id).update(name='renamed behind the cache')
+        second = self.c.get(self.url)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(self.c.get(self.url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+    def test_invalidation(self):
+        self.c.get(self.url)
+        self.record.name = 'renamed'
+        self.record.save()
+        self.assertContains(self.c.get(self.url), 'renamed')
+        self.c.get(reverse('my_snippets'))
+        self.c.post(reverse('delete_snippet', kwargs={'snippet_id': self.record.id}), {'confirm': '1'})
+        self.c.get(reverse('my_snippets'))  # shows messages, if any
+        self.assertNotContains(self.c.get(reverse('my_snippets')), 'renamed')
+
+
+class TestAsyncViews(TestCase):
+
+    def test_run_once(self):
+        calls = []
+
+        def slow_format(code):
+            calls.append(code)
+            time.sleep(0.05)
+            return code.upper()
+
+        async def run():
+            return await asyncio.gather(*[async_views.run_once('key', slow_format, 'x = 1') for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), ['X = 1'] * 5)
+        self.assertEqual(calls, ['x = 1'])
+        self.assertEqual(async_views._in_flight, {})  # pylint: disable=protected-access
+
+    def test_run_blocking_timings(self):
+        timings = defaultdict(float)
+
+        def read():
+            with metrics.timed('read'):
+                return 'x = 1'
+
+        async def run():
+            metrics._request_timings.set(timings)  # pylint: disable=protected-access
+            return await async_views.run_blocking(read)
+
+        self.assertEqual(asyncio.run(run()), 'x = 1')
+        self.assertIn('read', timings)
+
+
+class TestAsyncSnippetPages(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.c = Client()
+        self.c.force_login(User.objects.get(username='vasya'))
+        self.async_client.force_login(User.objects.get(username='vasya'))
+        self.c.post(reverse('add_snippet'), {'name': 'async', 'code': 'x  =  1\n'})
+        self.record = Snippet.objects.get(name='async')
+        self.c.get(reverse('my_snippets'))  # shows the pending "added" message
+        page_cache.get_cache().clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def test_routed(self):
+        match = resolve(reverse('view_snippet', kwargs={'snippet_id': self.record.id}))
+        self.assertIs(match.func, async_views.view_snippet_page)
+
+    def test_single_lookup(self):
+        url = reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'pep8'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.c.get(url)
+        self.assertEqual(response.status_code, 200)
+        lookups = [query for query in queries.captured_queries
+                   if '"main_snippet"."id" = {}'.format(self.record.id) in query['sql']]
+        self.assertEqual(len(lookups), 1)
+        stages = [item.split(';')[0] for item in response['Server-Timing'].split(', ')]
+        self.assertIn('format', stages)  # recorded in the executor thread
+
+    def test_not_found(self):
+        url = reverse('view_snippet', kwargs={'snippet_id': self.record.id + 1000})
+        self.assertEqual(self.c.get(url).status_code, 404)
+
+    def test_formatter_error(self):
+        urls = [reverse(name, kwargs={'snippet_id': self.record.id, 'utility': 'pep8'})
+                for name in ('view_format', 'raw_format')]
+        with mock.patch('main.formatter.run_formatter', side_effect=FormatterError('pep8: timeout')):
+            for url in urls:
+                response = self.c.get(url)
+                self.assertEqual(response.status_code, 503)
+                self.assertIn('no-store', response['Cache-Control'])
+        for url in urls:
+            self.assertEqual(self.c.get(url).status_code, 200)
+
+    async def test_async_chain(self):
+        url = reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'pep8'})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        stages = [item.split(';')[0] for item in response['Server-Timing'].split(', ')]
+        self.assertIn('db', stages)  # queries run in sync_to_async threads
+        self.assertIn('format', stages)
+
+    def test_missing_file(self):
+        os.remove(self.record.get_filename())
+        self.assertEqual(self.c.get(reverse('view_snippet', kwargs={'snippet_id': self.record.id})).status_code, 404)
+        url = reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'pep8'})
+        self.assertEqual(self.c.get(url).status_code, 404)
+
+    def test_hit_without_files(self):
+        url = reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'pep8'})
+        etag = self.c.get(url)['ETag']
+        formatter = self.record.get_formatter('pep8')
+        os.remove(formatter.get_formatted_code_name())
+        self.assertEqual(self.c.get(url).status_code, 200)  # from the page cache
+        page_cache.get_cache().clear()
+        self.assertEqual(self.c.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertFalse(formatter.formatted_code_exists())
+
+
+class SlowFormatter(Pep8Formatter):
+    UTILITY = 'slow'
+    calls = []
+
+    @classmethod
+    def format_code(cls, code):
+        cls.calls.append(code)
+        time.sleep(0.05)
+        return code.strip() + '\n'
+
+
+class TestSingleFlightFormatting(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.filename = storage.get_filename('1' * 40)
+        storage.save_code(self.filename, '  x = 1  ')
+        SlowFormatter.calls.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def test_concurrent_requests(self):
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: SlowFormatter(self.filename).get_formatted_code(), range(5)))
+        self.assertEqual(results, ['x = 1\n'] * 5)
+        self.assertEqual(SlowFormatter.calls, ['  x = 1  '])
+        self.assertFalse(os.path.exists(SlowFormatter(self.filename).get_formatted_code_name() + storage.LOCK_SUFFIX))
+
+
 class TestPep8SnippetPage(TestCase):
     fixtures = ['test_db.json']
 
@@ -156,3 +694,409 @@ class TestAutoflakeSnippetPage(TestCase):
     def test_invalid_get(self):
         response = self.c.get(reverse('view_format', kwargs={'snippet_id': 100, 'utility': 'autoflake'}))
         self.assertEqual(response.status_code, 404)
+
+
+class TestDocformatterSnippetPage(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.c = Client()
+        user = User.objects.get(username='vasya')
+        self.c.force_login(user)
+        self.c.post(reverse('add_snippet'), {'name': '123', 'code': 'def f():\n    """   hello.   """\n'})
+        self.record = Snippet.objects.filter(name='123').last()
+
+    def test_get(self):
+        response = self.c.get(reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'docformatter'}))
+        self.assertEqual(response.context['code'], 'def f():\n    """hello."""\n')
+        self.assertTrue(os.path.exists(self.record.get_filename('docformatter')))
+
+
+class TestPipelineSnippetPage(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.c = Client()
+        user = User.objects.get(username='vasya')
+        self.c.force_login(user)
+        self.c.post(reverse('add_snippet'), {'name': '123', 'code': 'import math\nx  =  "a"\n'})
+        self.record = Snippet.objects.filter(name='123').last()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def test_get(self):
+        response = self.c.get(reverse('view_format', kwargs={'snippet_id': self.record.id,
+                                                             'utility': 'autoflake+unify+pep8'}))
+        self.assertEqual(response.context['code'], "x = 'a'\n")
+        self.assertTrue(os.path.exists(self.record.get_filename('autoflake_unify_autopep8')))
+        self.assertFalse(os.path.exists(self.record.get_filename('autoflake+unify+autopep8')))
+        self.assertTrue(os.path.exists(self.record.get_filename('autoflake')))
+        response = self.c.get(reverse('view_format', kwargs={'snippet_id': self.record.id,
+                                                             'utility': 'autoflake+unify'}))
+        self.assertEqual(response.context['code'], 'x  =  \'a\'\n')
+
+    def test_invalid_get(self):
+        response = self.c.get(reverse('view_format', kwargs={'snippet_id': self.record.id,
+                                                             'utility': 'autoflake+black'}))
+        self.assertEqual(response.status_code, 404)
+        for utility in ('pep8+pep8', '+'.join(['pep8'] * 60)):
+            response = self.c.get(reverse('view_format', kwargs={'snippet_id': self.record.id,
+                                                                 'utility': utility}))
+            self.assertEqual(response.status_code, 404)
+
+
+class TestHighlightCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, 'abc.py')
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_code(self):
+        self.calls += 1
+        return 'a = 1\n'
+
+    def test_memory_and_disk(self):
+        with override_settings(MEDIA_ROOT=self.tmpdir.name):
+            cache = HighlightCache(2, 1024 * 1024)
+            html = cache.get_highlighted_code(self.filename, self.get_code)
+            self.assertEqual(cache.get_highlighted_code(self.filename, self.get_code), html)
+            self.assertTrue(os.path.exists(cache.get_html_name(self.filename)))
+            cold = HighlightCache(2, 1024 * 1024)
+            self.assertEqual(cold.get_highlighted_code(self.filename, self.get_code), html)
+        self.assertEqual(self.calls, 1)
+
+    def test_disk_eviction(self):
+        with override_settings(MEDIA_ROOT=self.tmpdir.name):
+            cache = HighlightCache(2, 1)
+            cache.get_highlighted_code(self.filename, self.get_code)
+            self.assertFalse(os.path.exists(cache.get_html_name(self.filename)))
+
+    def test_own_directory(self):
+        outside = os.path.join(self.tmpdir.name, 'ab', 'abc.html')
+        storage.write_file(outside, b'not a cache entry')
+        with override_settings(MEDIA_ROOT=self.tmpdir.name):
+            cache = HighlightCache(2, 1)
+            self.assertTrue(cache.get_html_name(self.filename).startswith(
+                os.path.join(self.tmpdir.name, storage.HTML_DIR) + os.sep))
+            cache.get_highlighted_code(self.filename, self.get_code)
+            self.assertEqual(cache.scan_disk_usage(), 0)
+        self.assertTrue(os.path.exists(outside))
+
+
+@override_settings(FORMAT_JOBS_ASYNC=True)
+class TestFormatJobQueue(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.c = Client()
+        user = User.objects.get(username='vasya')
+        self.c.force_login(user)
+        self.c.post(reverse('add_snippet'), {'name': '123', 'code': 'import os\nimport sys\nprint(sys)\n'})
+        self.record = Snippet.objects.filter(name='123').last()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def test_pending_then_done(self):
+        url = reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'autoflake'})
+        response = self.c.get(url)
+        self.assertEqual(response.status_code, 202)
+        self.assertTemplateUsed(response, 'pages/pending_snippet.html')
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(process_pending_jobs(executor, 10), 1)
+        self.assertEqual(FormatJob.objects.get(sha1=self.record.sha1).status, FormatJob.DONE)
+        response = self.c.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['code'], 'import sys\nprint(sys)\n')
+
+    def test_requeue_missing_output(self):
+        url = reverse('view_format', kwargs={'snippet_id': self.record.id, 'utility': 'autoflake'})
+        self.c.get(url)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(process_pending_jobs(executor, 10), 1)
+            os.remove(self.record.get_filename('autoflake'))
+            self.assertEqual(self.c.get(url).status_code, 202)
+            self.assertEqual(FormatJob.objects.get(sha1=self.record.sha1).status, FormatJob.PENDING)
+            self.assertEqual(process_pending_jobs(executor, 10), 1)
+        self.assertEqual(self.c.get(url).status_code, 200)
+        FormatJob.objects.filter(sha1=self.record.sha1).update(status=FormatJob.FAILED, error='boom')
+        job = enqueue_format_job(self.record.sha1, 'autoflake')
+        self.assertEqual((job.status, job.error), (FormatJob.PENDING, ''))
+
+    def test_warm_up_priorities(self):
+        schedule_warm_up(self.record.sha1)
+        enqueue_format_job(self.record.sha1, 'unify')
+        utilities = [job.utility for job in claim_pending_jobs(10)]
+        self.assertEqual(utilities[:3], ['unify', '', 'pep8'])
+        self.assertEqual(sorted(utilities), sorted(get_warm_up_utilities()))
+
+
+class TestWarmOnWrite(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def test_background_thread(self):
+        record = Snippet(name='warm', creation_date=timezone.now(), user=User.objects.get(username='vasya'))
+        record.code = 'import os\nx  =  1\n'
+        record.save()
+        schedule_warm_up(record.sha1)
+        warmer.queue.join()
+        for utility in AVAILABLE_FORMATTERS:
+            formatter = record.get_formatter(utility)
+            self.assertTrue(formatter.formatted_code_exists())
+            self.assertTrue(os.path.exists(HighlightCache.get_html_name(formatter.get_formatted_code_name())))
+        self.assertTrue(os.path.exists(HighlightCache.get_html_name(record.get_filename())))
+
+
+@override_settings(WARM_ON_WRITE=True, FORMAT_JOBS_ASYNC=True)
+class TestWarmOnCommit(TransactionTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.user = User.objects.create_user('warm')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def test_scheduled_after_commit(self):
+        record = Snippet(name='warm', creation_date=timezone.now(), user=self.user)
+        record.code = 'import os\nx  =  1\n'
+        with transaction.atomic():
+            record.save()
+            self.assertFalse(FormatJob.objects.exists())
+        self.assertEqual(sorted(FormatJob.objects.filter(sha1=record.sha1).values_list('utility', flat=True)),
+                         sorted(get_warm_up_utilities()))
+        FormatJob.objects.all().delete()
+        record.name = 'renamed'
+        record.save()
+        self.assertFalse(FormatJob.objects.exists())  # same code, nothing to warm up
+        with transaction.atomic():
+            record.code = 'y = 2\n'
+            record.save()
+            transaction.set_rollback(True)
+        self.assertFalse(FormatJob.objects.exists())
+
+
+class TestFormatterPool(TestCase):
+
+    def setUp(self):
+        self.pool = FormatterPool(1, 30, 2, 1024 * 1024)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_run(self):
+        self.assertEqual(self.pool.run('autopep8', 'a  =  1'), 'a = 1\n')
+        self.assertEqual(self.pool.run('autopep8', 'b  =  2'), 'b = 2\n')
+        self.assertEqual(self.pool.workers[0].jobs_done, 0)
+
+    def test_restart_after_crash(self):
+        self.pool.workers[0].process.kill()
+        self.pool.workers[0].process.join()
+        with self.assertRaises(FormatterError):
+            self.pool.run('autopep8', 'a  =  1')
+        self.assertEqual(self.pool.run('autopep8', 'a  =  1'), 'a = 1\n')
+
+
+class TestBlobStore(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.user = User.objects.get(username='vasya')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    def create_snippet(self, code):
+        record = Snippet(name='blob', creation_date=datetime.datetime.now(tz=timezone.utc), user=self.user)
+        record.code = code
+        record.save()
+        return record
+
+    def test_refcount_and_gc(self):
+        first = self.create_snippet('a = 1\n')
+        second = self.create_snippet('a = 1\n')
+        self.assertEqual(Blob.objects.get(sha1=first.sha1).refcount, 2)
+        first.get_formatted_code('pep8')
+        first.delete()
+        self.assertEqual(Blob.collect_garbage(), 0)
+        self.assertEqual(second.get_code(), 'a = 1\n')
+        second.delete()
+        self.assertEqual(Blob.objects.get(sha1=first.sha1).refcount, 0)
+        self.assertEqual(Blob.collect_garbage(), 2)
+        self.assertFalse(os.path.exists(first.get_filename()))
+        self.assertFalse(os.path.exists(first.get_filename('autopep8')))
+
+    def test_recount(self):
+        record = self.create_snippet('b = 2\n')
+        Blob.objects.filter(sha1=record.sha1).update(refcount=5)
+        self.assertEqual(Blob.recount(), 3)  # this blob and the two fixture snippets
+        self.assertEqual(Blob.objects.get(sha1=record.sha1).refcount, 1)
+        Blob.objects.filter(sha1=record.sha1).delete()
+        Blob.recount()
+        self.assertEqual(Blob.objects.get(sha1=record.sha1).size, len('b = 2\n'))
+
+    @override_settings(SNIPPET_STORAGE_DELTAS=True)
+    def test_pipeline_gc(self):
+        record = self.create_snippet('import math\nx  =  "a"\n')
+        self.assertEqual(record.get_formatted_code('autoflake+unify+pep8'), "x = 'a'\n")
+        self.assertTrue(all(name.startswith(record.sha1) for name in os.listdir(self.tmpdir.name)))
+        record.delete()
+        Blob.collect_garbage()
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_rename_loaded(self):
+        record = self.create_snippet('import math\nprint(math.pi)\n')
+        loaded = Snippet.objects.get(id=record.id)  # as the admin does, without code
+        loaded.name = 'renamed'
+        loaded.save()
+        loaded = Snippet.objects.get(id=record.id)
+        self.assertEqual((loaded.name, loaded.sha1, loaded.minhash), ('renamed', record.sha1, record.minhash))
+        self.assertEqual(Blob.objects.get(sha1=record.sha1).refcount, 1)
+        self.assertEqual(Blob.collect_garbage(), 0)
+        self.assertEqual(loaded.get_code(), 'import math\nprint(math.pi)\n')
+        self.assertTrue(SnippetSymbol.objects.filter(snippet=loaded, kind='import', name='math').exists())
+        self.assertEqual(SnippetBand.objects.filter(snippet=loaded).count(), len(get_buckets(record.minhash)))
+        self.assertEqual([item['name'] for item in search.search(self.user.id, 'math.pi', 0, 10)], ['renamed'])
+
+    def test_gc_highlight(self):
+        record = self.create_snippet('d = 4\n')
+        HighlightCache(2, 1024 * 1024).get_highlighted_code(record.get_filename(), record.get_code)
+        html_name = HighlightCache.get_html_name(record.get_filename())
+        self.assertTrue(os.path.exists(html_name))
+        record.delete()
+        Blob.collect_garbage()
+        self.assertFalse(os.path.exists(html_name))
+
+    def test_resave_after_gc(self):
+        record = self.create_snippet('c = 3\n')
+        record.delete()
+        self.assertEqual(Blob.collect_garbage(), 1)
+        again = self.create_snippet('c = 3\n')
+        self.assertEqual(again.get_code(), 'c = 3\n')
+        self.assertEqual(Blob.objects.get(sha1=again.sha1).refcount, 1)
+        self.assertEqual(Blob.collect_garbage(), 0)
+        self.assertFalse(os.path.exists(again.get_filename() + storage.LOCK_SUFFIX))
+
+
+class TestShardedStorage(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.record = Snippet(name='shard', creation_date=datetime.datetime.now(tz=timezone.utc),
+                              user=User.objects.get(username='vasya'))
+        self.record.code = 'a = 1\n'
+        self.record.save()
+        self.record.get_formatted_code('pep8')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    @override_settings(SNIPPET_STORAGE_LAYOUT='sharded', SNIPPET_STORAGE_LEGACY_LAYOUTS=['flat'])
+    def test_online_migration(self):
+        flat_name = os.path.join(self.tmpdir.name, self.record.sha1 + '.py')
+        sharded_name = self.record.get_filename()
+        self.assertEqual(sharded_name, os.path.join(self.tmpdir.name, self.record.sha1[:2],
+                                                    self.record.sha1[2:4], self.record.sha1 + '.py'))
+        self.assertEqual(self.record.get_code(), 'a = 1\n')
+        call_command('migrate_storage', '--from', 'flat', '--pause', '0', stdout=io.StringIO())
+        self.assertFalse(os.path.exists(flat_name))
+        self.assertTrue(os.path.exists(sharded_name))
+        self.assertTrue(os.path.exists(self.record.get_filename('autopep8')))
+        self.assertEqual(self.record.get_code(), 'a = 1\n')
+
+    def test_lock_files_skipped(self):
+        flat_lock = os.path.join(self.tmpdir.name, self.record.sha1 + '.py' + storage.LOCK_SUFFIX)
+        sharded_lock = os.path.join(storage.ShardedLayout.get_dir(self.record.sha1),
+                                    self.record.sha1 + '.py' + storage.LOCK_SUFFIX)
+        os.makedirs(os.path.dirname(sharded_lock))
+        for path in (flat_lock, sharded_lock):
+            open(path, 'w').close()
+        for layout in (storage.FlatLayout, storage.ShardedLayout):
+            self.assertFalse([path for _, path in layout.iter_files() if path.endswith(storage.LOCK_SUFFIX)])
+        self.assertTrue(list(storage.FlatLayout.iter_files()))
+
+
+class TestCompressedStorage(TestCase):
+    fixtures = ['test_db.json']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.code = ''.join('value_{0}  =  {0}\n'.format(i) for i in range(50))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+
+    @override_settings(SNIPPET_STORAGE_COMPRESSION='zlib', SNIPPET_STORAGE_DELTAS=True)
+    def test_roundtrip(self):
+        record = Snippet(name='zip', creation_date=datetime.datetime.now(tz=timezone.utc),
+                         user=User.objects.get(username='vasya'))
+        record.code = self.code + 'x = 1\n'
+        record.save()
+        formatted = record.get_formatted_code('pep8')
+        with open(record.get_filename(), 'rb') as file:
+            self.assertTrue(file.read().startswith(storage.ZLIB_MAGIC))
+        self.assertLess(os.path.getsize(record.get_filename('autopep8')), len(formatted))
+        self.assertEqual(record.get_code(), record.code)
+        self.assertEqual(record.get_formatted_code('pep8'), formatted)
+        self.assertEqual(formatted, self.code.replace('  =  ', ' = ') + 'x = 1\n')
+        self.assertEqual(b''.join(storage.iter_code(record.get_filename(), chunk_size=16)),
+                         record.code.encode('utf8'))
+        self.assertEqual(b''.join(storage.iter_code(record.get_filename('autopep8'))),
+                         formatted.encode('utf8'))
+        self.assertIsNone(storage.open_plain(record.get_filename()))
+
+    def test_plain_files_stay_readable(self):
+        path = storage.get_filename('0' * 40)
+        storage.save_code(path, self.code)
+        with override_settings(SNIPPET_STORAGE_COMPRESSION='zstd'):
+            self.assertEqual(storage.load_code(path), self.code)
+            storage.save_code(path, self.code)
+            self.assertEqual(storage.load_code(path), self.code)
+
+
+class TestHashing(TestCase):
+
+    def test_single_pass(self):
+        record = Snippet()
+        record.code = 'ы' * CHUNK_SIZE + 'a'
+        digests = get_digests(record.code)
+        self.assertEqual(digests.md5, record.get_md5())
+        self.assertEqual(digests.sha1, record.get_sha1())
+        self.assertEqual(digests.sha256, record.get_sha256())
+        self.assertEqual(digests.size, 2 * CHUNK_SIZE + 1)
@@ -3,18 +3,32 @@ View-функции Django размещаются здесь
 """
 
 import datetime
+import hashlib
+
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
-from django.contrib.auth.decorators import login_required
-from django.http import Http404
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.db.models import Count, Max, Q, Sum
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.utils import timezone
-from pygments import highlight
-from pygments.formatters.html import HtmlFormatter
-from pygments.lexers.python import PythonLexer
+from django.utils.cache import add_never_cache_headers, patch_cache_control
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
+from main import search, storage
 from main.forms import LoginForm, BaseSnippetForm
-from main.models import Snippet
+from main.highlight import get_available_styles, get_highlighted_code, \
+    get_options_fingerprint, get_stylesheet, get_stylesheet_url
+from main.jobs import enqueue_format_job
+from main.formatter import get_formatter
+from main.metrics import render_prometheus, timed
+from main.models import Snippet, SnippetStats
+from main.page_cache import cache_user_page
+from main.symbols import SYMBOL_KINDS
+from main.workers import FormatterError
 
 
 def get_base_context(request, pagename):
@@ -87,7 +101,87 @@ def add_snippet_page(request):
         return render(request, 'pages/add_snippet.html', context)
 
 
+def get_owned_snippet(request, snippet_id):
+    """
+    Получение сниппета текущего пользователя
+
+    Запись запоминается в объекте запроса, поэтому функция ETag,
+    view-функция и её асинхронный вариант выполняют один запрос к БД.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :return: сниппет или ``None``, если пользователь не авторизован или сниппет не найден
+    :rtype: :class:`main.models.Snippet`
+    """
+    records = request.__dict__.setdefault('_owned_snippets', {})
+    if snippet_id not in records:
+        records[snippet_id] = Snippet.objects.filter(id=snippet_id, user=request.user).first() \
+            if request.user.is_authenticated else None
+    return records[snippet_id]
+
+
+def get_page_etag(request, snippet_id, utility=None):
+    """
+    Получение ETag для страницы сниппета с запоминанием в объекте запроса
+
+    Асинхронные view-функции проверяют ``If-None-Match`` до подготовки кода,
+    после чего тег повторно нужен декоратору ``condition``.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :param utility: имя утилиты или ``None`` для исходного кода
+    :return: тег или ``None``, если страницу нельзя кешировать
+    :rtype: :class:`str`
+    """
+    etags = request.__dict__.setdefault('_page_etags', {})
+    if (snippet_id, utility) not in etags:
+        etags[(snippet_id, utility)] = build_page_etag(request, snippet_id, utility)
+    return etags[(snippet_id, utility)]
+
+
+def build_page_etag(request, snippet_id, utility=None):
+    """
+    Построение ETag для страницы сниппета
+
+    Тег строится без чтения файлов из SHA1-хеша кода, утилиты,
+    версии шаблонов (``SNIPPET_PAGE_VERSION``), параметров подсветки,
+    пользователя и его статистики (от неё зависит список похожих сниппетов).
+    Страницы с непоказанными сообщениями и страницы ожидания
+    фонового форматирования не кешируются.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :param utility: имя утилиты или ``None`` для исходного кода
+    :return: тег или ``None``, если страницу нельзя кешировать
+    :rtype: :class:`str`
+    """
+    if not request.user.is_authenticated or len(messages.get_messages(request)):
+        return None
+    record = get_owned_snippet(request, snippet_id)
+    if record is None:
+        return None
+    sha1 = record.sha1
+    if utility:
+        try:
+            formatter = get_formatter(storage.get_filename(sha1), utility)
+        except KeyError:
+            return None
+        if settings.FORMAT_JOBS_ASYNC and not formatter.formatted_code_exists():
+            return None
+    stats = SnippetStats.objects.filter(user=request.user) \
+        .values_list('count', 'total_bytes', 'last_created').first()
+    raw = repr((sha1, utility, settings.SNIPPET_PAGE_VERSION, get_options_fingerprint(),
+                settings.PYGMENTS_STYLE, request.user.id, request.user.username, stats))
+    return hashlib.sha1(raw.encode('utf8')).hexdigest()
+
+
 @login_required(login_url='/login/')
+@cache_user_page
+@cache_control(private=True)
+@condition(etag_func=get_page_etag)
 def view_snippet_page(request, snippet_id):
     """
     Отображение определённого сниппета
@@ -103,7 +197,9 @@ def view_snippet_page(request, snippet_id):
     """
     context = get_base_context(request, 'Просмотр сниппета')
     try:
-        record = Snippet.objects.get(id=snippet_id, user=request.user)
+        record = get_owned_snippet(request, snippet_id)
+        if record is None:
+            raise Snippet.DoesNotExist
         context['record'] = record
         context['addform'] = BaseSnippetForm(
             initial={
@@ -113,12 +209,106 @@ def view_snippet_page(request, snippet_id):
                 'sha256': record.sha256,
             }
         )
-        context['pygmentcode'] = highlight(
-            record.get_code(), PythonLexer(), HtmlFormatter())
-        context['pygmentstyle'] = HtmlFormatter().get_style_defs('.highlight')
+        context['pygmentcode'] = get_highlighted_code(
+            record.get_filename(), record.get_code)
+        context['pygmentstyle_url'] = get_stylesheet_url()
+        context['raw_url'] = reverse('raw_snippet', kwargs={'snippet_id': record.id})
+        context['similar'] = record.get_similar(settings.SIMILAR_SNIPPETS_THRESHOLD,
+                                                settings.SIMILAR_SNIPPETS_LIMIT,
+                                                settings.SIMILAR_SNIPPETS_CANDIDATES)
     except Snippet.DoesNotExist:
         raise Http404
-    return render(request, 'pages/view_snippet.html', context)
+    with timed('render'):
+        return render(request, 'pages/view_snippet.html', context)
+
+
+@login_required(login_url='/login/')
+def search_page(request):
+    """
+    Полнотекстовый поиск по коду и названиям сниппетов пользователя
+
+    Результаты упорядочены по релевантности и разбиты на страницы
+    по ``SEARCH_PAGE_SIZE`` записей (параметр ``?page=``).
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :return: объект ответа сервера с HTML-кодом внутри
+    """
+    context = get_base_context(request, 'Поиск')
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    page_size = settings.SEARCH_PAGE_SIZE
+    results = search.search(request.user.id, query, (page - 1) * page_size, page_size + 1)
+    context['query'] = query
+    context['results'] = results[:page_size]
+    context['page'] = page
+    context['has_next'] = len(results) > page_size
+    context['query_too_short'] = bool(query) and search.build_match_query(query) is None
+    return render(request, 'pages/search.html', context)
+
+
+@login_required(login_url='/login/')
+def symbols_page(request):
+    """
+    Поиск сниппетов пользователя по символам из индекса
+
+    Например, ``?kind=import&name=numpy`` выбирает сниппеты,
+    импортирующие ``numpy`` или любой из его модулей.
+    Выводятся не более ``SEARCH_PAGE_SIZE`` самых новых сниппетов.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :return: объект ответа сервера с HTML-кодом внутри
+    """
+    context = get_base_context(request, 'Поиск по символам')
+    kind = request.GET.get('kind', '')
+    name = request.GET.get('name', '').strip()
+    records = []
+    if name and kind in dict(SYMBOL_KINDS):
+        records = Snippet.objects.filter(user=request.user, symbols__kind=kind, symbols__name=name) \
+            .distinct().only('id', 'name', 'creation_date') \
+            .order_by('-creation_date', '-id')[:settings.SEARCH_PAGE_SIZE]
+    context['kinds'] = SYMBOL_KINDS
+    context['kind'] = kind
+    context['name'] = name
+    context['records'] = records
+    return render(request, 'pages/symbols.html', context)
+
+
+HASH_FIELDS_BY_LENGTH = {
+    32: 'md5',
+    40: 'sha1',
+    64: 'sha256',
+}
+
+
+@login_required(login_url='/login/')
+def find_snippet_by_hash(request, digest):
+    """
+    Поиск сниппета по хешу кода
+
+    Тип хеша (MD5, SHA1 или SHA256) определяется по длине.
+    Среди нескольких сниппетов с одинаковым кодом выбирается самый новый.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param digest: хеш в шестнадцатеричной записи
+    :type digest: :class:`str`
+    :raises: :class:`django.http.Http404` в случае,
+    если у пользователя нет сниппета с таким хешем
+    :return: перенаправление на страницу сниппета
+    """
+    field = HASH_FIELDS_BY_LENGTH.get(len(digest))
+    if field is None:
+        raise Http404
+    record = Snippet.objects.filter(user=request.user, **{field: digest.lower()}) \
+        .only('id').order_by('-creation_date', '-id').first()
+    if record is None:
+        raise Http404
+    return redirect('view_snippet', snippet_id=record.id)
 
 
 def login_page(request):
@@ -162,21 +352,117 @@ def logout_page(request):
     return redirect('index')
 
 
+def get_page_cursor(record):
+    """
+    Получение курсора страницы списка сниппетов
+
+    Курсор указывает на последнюю запись страницы: дата создания
+    в микросекундах от начала эпохи и ID через подчёркивание.
+
+    :param record: последняя запись страницы
+    :type record: :class:`main.models.Snippet`
+    :return: курсор
+    :rtype: :class:`str`
+    """
+    delta = record.creation_date - datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return '{}_{}'.format(delta // datetime.timedelta(microseconds=1), record.id)
+
+
+def parse_page_cursor(cursor):
+    """
+    Разбор курсора страницы списка сниппетов
+
+    :param cursor: курсор из :func:`get_page_cursor`
+    :type cursor: :class:`str`
+    :return: кортеж (дата создания, ID) или ``None`` для некорректного курсора
+    :rtype: :class:`tuple`
+    """
+    try:
+        microseconds, record_id = (int(part) for part in cursor.split('_'))
+    except (AttributeError, ValueError):
+        return None
+    return (datetime.datetime(1970, 1, 1, tzinfo=timezone.utc) +
+            datetime.timedelta(microseconds=microseconds), record_id)
+
+
 @login_required(login_url='/login/')
+@cache_user_page
 def my_snippets_page(request):
     """
     Отображение списка всех сниппетов, когда-либо созданных пользователем
 
+    Список разбит на страницы по ``SNIPPETS_PAGE_SIZE`` записей, от новых к старым.
+    Следующая страница выбирается по курсору ``?after=``
+    (keyset-пагинация), поэтому её стоимость не зависит от номера страницы.
+    Из БД загружаются только отображаемые поля, а общее количество
+    берётся из :class:`main.models.SnippetStats`.
+
     :param request: объект c деталями запроса
     :type request: :class:`django.http.HttpRequest`
     :return: объект ответа сервера с HTML-кодом внутри
     """
     context = get_base_context(request, 'Мои сниппеты')
-    context['records'] = Snippet.objects.filter(user=request.user)
-    context['count'] = len(context['records'])
-    return render(request, 'pages/my_snippets.html', context)
+    page_size = settings.SNIPPETS_PAGE_SIZE
+    records = Snippet.objects.filter(user=request.user) \
+        .only('id', 'name', 'creation_date') \
+        .order_by('-creation_date', '-id')
+    cursor = parse_page_cursor(request.GET.get('after'))
+    if cursor:
+        creation_date, record_id = cursor
+        records = records.filter(Q(creation_date__lt=creation_date) |
+                                 Q(creation_date=creation_date, id__lt=record_id))
+    records = list(records[:page_size + 1])
+    context['records'] = records[:page_size]
+    context['next_cursor'] = get_page_cursor(records[page_size - 1]) \
+        if len(records) > page_size else None
+    context['is_first_page'] = cursor is None
+    context['count'] = SnippetStats.for_user(request.user).count
+    with timed('render'):
+        return render(request, 'pages/my_snippets.html', context)
+
+
+@user_passes_test(lambda user: user.is_staff, login_url='/login/')
+def stats_page(request):
+    """
+    Сводная статистика по всем пользователям
+
+    Строится только по таблице :class:`main.models.SnippetStats`,
+    без сканирования таблицы сниппетов. Доступна только персоналу.
 
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :return: объект ответа сервера с HTML-кодом внутри
+    """
+    context = get_base_context(request, 'Статистика')
+    context['totals'] = SnippetStats.objects.filter(count__gt=0).aggregate(
+        users=Count('id'), snippets=Sum('count'),
+        total_bytes=Sum('total_bytes'), last_created=Max('last_created'))
+    context['top'] = SnippetStats.objects.filter(count__gt=0) \
+        .select_related('user').order_by('-count')[:settings.STATS_TOP_USERS]
+    return render(request, 'pages/stats.html', context)
+
+
+def get_formatter_error_response(utility):
+    """
+    Ответ на ошибку процесса-форматтера: превышение времени ожидания,
+    падение процесса или ошибку утилиты (:class:`main.workers.FormatterError`)
 
+    Ответ не кешируется, чтобы повторный запрос снова запустил форматирование.
+
+    :param utility: имя утилиты
+    :return: объект ответа сервера с кодом 503
+    """
+    response = HttpResponse('Не удалось отформатировать код утилитой {}, '
+                            'попробуйте позже'.format(utility), status=503,
+                            content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = settings.FORMATTER_POOL_TIMEOUT
+    add_never_cache_headers(response)
+    return response
+
+
+@cache_user_page
+@cache_control(private=True)
+@condition(etag_func=get_page_etag)
 def view_formatted_code_page(request, snippet_id, utility):
     """
     Получение кода, отформатированноего одной из поддерживаемых утилит
@@ -192,10 +478,15 @@ def view_formatted_code_page(request, snippet_id, utility):
     :raises: :class:`django.http.Http404` в случае,
     если указанная утилита не поддерживается
     :return: объект ответа сервера с HTML-кодом внутри
+    :return: страница ожидания с кодом 202 в случае, если включено
+    фоновое форматирование и код ещё не отформатирован
+    :return: ответ с кодом 503 в случае ошибки процесса-форматтера
     """
     context = get_base_context(request, 'Форматирование {}'.format(utility))
     try:
-        record = Snippet.objects.get(id=snippet_id, user=request.user)
+        record = get_owned_snippet(request, snippet_id)
+        if record is None:
+            raise Snippet.DoesNotExist
         context['record'] = record
         context['addform'] = BaseSnippetForm(
             initial={
@@ -203,14 +494,101 @@ def view_formatted_code_page(request, snippet_id, utility):
                 'name': record.name,
             }
         )
-        formatted_code = record.get_formatted_code(utility)
+        formatter = record.get_formatter(utility)
+        if settings.FORMAT_JOBS_ASYNC and not formatter.formatted_code_exists():
+            context['job'] = enqueue_format_job(record.sha1, utility)
+            context['poll_interval'] = settings.FORMAT_JOB_POLL_INTERVAL
+            return render(request, 'pages/pending_snippet.html', context, status=202)
+        try:
+            formatted_code = formatter.get_formatted_code()
+        except FormatterError:
+            return get_formatter_error_response(utility)
         context['code'] = formatted_code
-        context['pygmentcode'] = highlight(formatted_code,
-                                           PythonLexer(), HtmlFormatter())
-        context['pygmentstyle'] = HtmlFormatter().get_style_defs('.highlight')
-    except Snippet.DoesNotExist:
+        context['pygmentcode'] = get_highlighted_code(
+            formatter.get_formatted_code_name(), lambda: formatted_code)
+        context['pygmentstyle_url'] = get_stylesheet_url()
+        context['raw_url'] = reverse('raw_format', kwargs={'snippet_id': record.id, 'utility': utility})
+    except (Snippet.DoesNotExist, FileNotFoundError):
         raise Http404
-    return render(request, 'pages/base_snippet.html', context)
+    with timed('render'):
+        return render(request, 'pages/base_snippet.html', context)
+
+
+def get_raw_etag(request, snippet_id, utility=None):
+    """
+    Получение ETag для исходного или отформатированного кода сниппета
+
+    Код неизменяем и адресуется SHA1-хешем, поэтому тег строится
+    из хеша (и утилиты) без чтения файла.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :param utility: имя утилиты или ``None`` для исходного кода
+    :return: тег или ``None``, если сниппет не найден
+    :rtype: :class:`str`
+    """
+    sha1 = Snippet.objects.filter(id=snippet_id, user=request.user) \
+        .values_list('sha1', flat=True).first()
+    if sha1 is None:
+        return None
+    return '{}-{}'.format(sha1, utility) if utility else sha1
+
+
+@login_required(login_url='/login/')
+@condition(etag_func=get_raw_etag)
+def raw_snippet_page(request, snippet_id, utility=None):
+    """
+    Отдача исходного или отформатированного кода сниппета как текста
+
+    Несжатые файлы отдаются через :class:`django.http.FileResponse`,
+    что позволяет серверу использовать ``sendfile``; сжатые файлы
+    распаковываются потоково. Повторный запрос с ``If-None-Match``
+    получает ответ 304 без обращения к файлу.
+    С параметром ``?download`` файл отдаётся как вложение.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param snippet_id: id сниппета
+    :type snippet_id: :class:`int`
+    :param utility: имя утилиты или ``None`` для исходного кода
+    :type utility: :class:`str`
+    :raises: :class:`django.http.Http404` в случае,
+    если сниппет не существует или утилита не поддерживается
+    :return: объект ответа сервера с кодом внутри
+    :return: ответ с кодом 202 в случае, если включено
+    фоновое форматирование и код ещё не отформатирован
+    :return: ответ с кодом 503 в случае ошибки процесса-форматтера
+    """
+    try:
+        record = Snippet.objects.only('id', 'name', 'sha1').get(id=snippet_id, user=request.user)
+        path = record.get_filename()
+        if utility:
+            formatter = record.get_formatter(utility)
+            if not formatter.formatted_code_exists():
+                if settings.FORMAT_JOBS_ASYNC:
+                    enqueue_format_job(record.sha1, utility)
+                    response = HttpResponse('Код форматируется', status=202,
+                                            content_type='text/plain; charset=utf-8')
+                    response['Retry-After'] = settings.FORMAT_JOB_POLL_INTERVAL
+                    return response
+                try:
+                    formatter.get_formatted_code()
+                except FormatterError:
+                    return get_formatter_error_response(utility)
+            path = formatter.get_formatted_code_name()
+        file = storage.open_plain(path)
+    except (Snippet.DoesNotExist, FileNotFoundError):
+        raise Http404
+    content_type = 'text/plain; charset=utf-8'
+    filename = '{}.py'.format(record.name)
+    if file is not None:
+        return FileResponse(file, content_type=content_type,
+                            as_attachment='download' in request.GET, filename=filename)
+    response = StreamingHttpResponse(storage.iter_code(path), content_type=content_type)
+    if 'download' in request.GET:
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename.replace('"', ''))
+    return response
 
 
 @login_required(login_url='/login/')
@@ -240,3 +618,47 @@ def delete_snippet_page(request, snippet_id):
         record.delete()
         return redirect('my_snippets')
     return render(request, 'pages/delete_snippet.html', context)
+
+
+@user_passes_test(lambda user: user.is_staff, login_url='/login/')
+def metrics_page(request):
+    """
+    Отдача замеров времени обработки запросов в формате Prometheus
+
+    Доступна только персоналу.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :return: объект ответа сервера с метриками в текстовом формате
+    :rtype: :class:`django.http.HttpResponse`
+    """
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def pygments_stylesheet(request, style, fingerprint):
+    """
+    Отдача таблицы стилей Pygments
+
+    Адрес содержит отпечаток содержимого, поэтому ответ
+    разрешено кешировать на длительный срок.
+
+    :param request: объект c деталями запроса
+    :type request: :class:`django.http.HttpRequest`
+    :param style: название стиля Pygments
+    :type style: :class:`str`
+    :param fingerprint: отпечаток содержимого таблицы стилей
+    :type fingerprint: :class:`str`
+    :raises: :class:`django.http.Http404` в случае,
+    если стиль не поддерживается или отпечаток устарел
+    :return: объект ответа сервера с CSS-кодом внутри
+    :rtype: :class:`django.http.HttpResponse`
+    """
+    if style not in get_available_styles():
+        raise Http404
+    css, current_fingerprint = get_stylesheet(style)
+    if fingerprint != current_fingerprint:
+        raise Http404
+    response = HttpResponse(css, content_type='text/css; charset=utf-8')
+    patch_cache_control(response, public=True, immutable=True,
+                        max_age=settings.PYGMENTS_STYLESHEET_MAX_AGE)
+    return response
@@ -0,0 +1,211 @@
+"""
+Пул долгоживущих процессов-форматтеров
+
+Каждый процесс один раз импортирует все утилиты
+из :data:`main.formatter.AVAILABLE_FORMATTERS` и получает задания через канал
+(:func:`multiprocessing.Pipe`). Зависшие процессы, а также процессы,
+выполнившие слишком много заданий или занявшие слишком много памяти,
+перезапускаются автоматически.
+"""
+
+import multiprocessing
+import queue
+import resource
+import threading
+
+from django.conf import settings
+
+
+class FormatterError(Exception):
+    """
+    Ошибка форматирования в процессе пула
+    """
+
+
+def worker_main(conn):
+    """
+    Основной цикл процесса-форматтера
+
+    Получает из канала пары (утилита, код) и отправляет обратно
+    кортежи (успех, результат, пиковый размер памяти в КиБ).
+
+    :param conn: конец канала :func:`multiprocessing.Pipe`
+    """
+    from main.formatter import AVAILABLE_FORMATTERS
+    formatters = {cls.UTILITY: cls for cls in AVAILABLE_FORMATTERS.values()}
+    while True:
+        try:
+            utility, code = conn.recv()
+        except EOFError:
+            break
+        try:
+            result = (True, formatters[utility].format_code(code))
+        except Exception as error:  # pylint: disable=broad-except
+            result = (False, repr(error))
+        conn.send(result + (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,))
+
+
+class FormatterWorker:
+    """
+    Один долгоживущий процесс-форматтер
+
+    :param max_jobs: количество заданий, после которого процесс перезапускается
+    :param max_memory: пиковый размер памяти в КиБ, после которого процесс перезапускается
+    """
+
+    def __init__(self, max_jobs, max_memory):
+        """
+        Конструктор объекта. Сразу запускает процесс.
+
+        :param max_jobs: количество заданий до перезапуска
+        :param max_memory: пиковый размер памяти в КиБ до перезапуска
+        """
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.process = None
+        self.conn = None
+        self.jobs_done = 0
+        self.start()
+
+    def start(self):
+        """
+        Запуск процесса
+
+        Используется метод ``spawn``, чтобы процесс не наследовал
+        потоки и соединения с БД веб-сервера.
+        """
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn,),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs_done = 0
+
+    def stop(self):
+        """
+        Остановка процесса
+        """
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+    def restart(self):
+        """
+        Перезапуск процесса
+        """
+        self.stop()
+        self.start()
+
+    def run(self, utility, code, timeout):
+        """
+        Выполнение задания в процессе
+
+        :param utility: название утилиты (``UTILITY`` класса форматтера)
+        :param code: исходный код
+        :param timeout: время ожидания результата в секундах
+        :raises: :class:`FormatterError` в случае ошибки утилиты,
+                 падения или зависания процесса
+        :return: форматированный код
+        :rtype: :class:`str`
+        """
+        try:
+            self.conn.send((utility, code))
+            if not self.conn.poll(timeout):
+                self.restart()
+                raise FormatterError('{}: превышено время ожидания'.format(utility))
+            success, result, memory = self.conn.recv()
+        except (EOFError, OSError) as error:
+            self.restart()
+            raise FormatterError('{}: процесс завершился аварийно'.format(utility)) from error
+        self.jobs_done += 1
+        if self.jobs_done >= self.max_jobs or memory > self.max_memory:
+            self.restart()
+        if not success:
+            raise FormatterError(result)
+        return result
+
+
+class FormatterPool:
+    """
+    Пул процессов-форматтеров фиксированного размера
+
+    :param size: количество процессов
+    :param timeout: время ожидания результата одного задания в секундах
+    :param max_jobs: количество заданий до перезапуска процесса
+    :param max_memory: пиковый размер памяти процесса в КиБ до перезапуска
+    """
+
+    def __init__(self, size, timeout, max_jobs, max_memory):
+        """
+        Конструктор объекта. Запускает все процессы пула.
+        """
+        self.timeout = timeout
+        self.workers = [FormatterWorker(max_jobs, max_memory) for _ in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def run(self, utility, code):
+        """
+        Выполнение задания на первом свободном процессе
+
+        :param utility: название утилиты (``UTILITY`` класса форматтера)
+        :param code: исходный код
+        :return: форматированный код
+        :rtype: :class:`str`
+        """
+        worker = self.idle.get()
+        try:
+            return worker.run(utility, code, self.timeout)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        """
+        Остановка всех процессов пула
+        """
+        for worker in self.workers:
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_formatter_pool():
+    """
+    Получение общего пула процессов
+
+    Пул создаётся при первом обращении по настройкам ``FORMATTER_POOL_*``.
+
+    :return: пул или ``None``, если ``FORMATTER_POOL_SIZE`` равен нулю
+    :rtype: :class:`FormatterPool`
+    """
+    global _pool  # pylint: disable=global-statement
+    if not settings.FORMATTER_POOL_SIZE:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = FormatterPool(settings.FORMATTER_POOL_SIZE,
+                                  settings.FORMATTER_POOL_TIMEOUT,
+                                  settings.FORMATTER_POOL_MAX_JOBS,
+                                  settings.FORMATTER_POOL_MAX_MEMORY)
+        return _pool
+
+
+def run_formatter(formatter_class, code):
+    """
+    Форматирование кода в пуле процессов или,
+    если пул отключён, в текущем процессе
+
+    :param formatter_class: класс форматтера
+    :param code: исходный код
+    :return: форматированный код
+    :rtype: :class:`str`
+    """
+    pool = get_formatter_pool()
+    if pool is None:
+        return formatter_class.format_code(code)
+    return pool.run(formatter_class.UTILITY, code)
@@ -0,0 +1,2 @@
+def other_name(y):
+    return y
@@ -0,0 +1,2 @@
+import numpy
+value = 0
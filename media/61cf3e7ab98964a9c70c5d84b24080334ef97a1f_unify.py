@@ -0,0 +1 @@
+ x = 'abc' y
\ No newline at end of file
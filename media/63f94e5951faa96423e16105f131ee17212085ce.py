@@ -0,0 +1,4 @@
+def add(first, second):
+    total = first + second
+    print(total)
+    return total
@@ -0,0 +1 @@
+x  =  "a"
@@ -0,0 +1,2 @@
+def find_me_please(x):
+    return x < 1
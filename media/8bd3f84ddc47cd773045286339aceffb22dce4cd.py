@@ -0,0 +1 @@
+import math
\ No newline at end of file
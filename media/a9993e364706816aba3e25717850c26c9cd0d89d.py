@@ -0,0 +1 @@
+abc
\ No newline at end of file
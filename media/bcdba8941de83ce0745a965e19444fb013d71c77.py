@@ -0,0 +1,2 @@
+import math
+x  =  "a"
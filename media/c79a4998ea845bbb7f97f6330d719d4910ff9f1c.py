@@ -0,0 +1,2 @@
+import numpy.linalg
+def main(): print(1)
@@ -0,0 +1 @@
+import this
\ No newline at end of file
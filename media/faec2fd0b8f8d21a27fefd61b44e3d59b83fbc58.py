@@ -0,0 +1,5 @@
+# sum
+def add( first,second ):
+  total=first+second
+  print( total )
+  return total
@@ -0,0 +1 @@
+   a    =   b   +   c   
\ No newline at end of file
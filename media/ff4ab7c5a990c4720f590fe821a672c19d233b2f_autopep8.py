@@ -0,0 +1 @@
+a = b + c
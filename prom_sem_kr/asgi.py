@@ -0,0 +1,18 @@
+"""
+ASGI config for prom_sem_kr project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Snippet pages are served by the async views from ``main.async_views``.
+
+Run with any ASGI server, e.g.::
+
+    uvicorn prom_sem_kr.asgi:application --workers 2
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'prom_sem_kr.settings')
+
+application = get_asgi_application()
@@ -45,10 +45,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'main',
+    'main.apps.MainConfig',
 ]
 
 MIDDLEWARE = [
+    'main.metrics.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,6 +72,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'main.context_processors.snippet_stats',
             ],
         },
     },
@@ -88,6 +90,9 @@ DATABASES = {
     }
 }
 
+# primary key type of the existing migrations
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -130,3 +135,90 @@ STATICFILES_DIRS = [
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+
+# directory layout of snippet files in MEDIA_ROOT, see main.storage.LAYOUTS
+SNIPPET_STORAGE_LAYOUT = 'flat'
+# layouts still read from while `manage.py migrate_storage` moves files,
+# e.g. LAYOUT = 'sharded' with LEGACY_LAYOUTS = ['flat']
+SNIPPET_STORAGE_LEGACY_LAYOUTS = []
+# compression of stored code: None, 'zlib' or 'zstd' (falls back to zlib
+# when the zstandard package is not installed)
+SNIPPET_STORAGE_COMPRESSION = None
+# store formatted variants as line deltas against the original code
+SNIPPET_STORAGE_DELTAS = False
+
+# number of snippets per page of the "my snippets" list
+SNIPPETS_PAGE_SIZE = 50
+# number of results per page of full-text search
+SEARCH_PAGE_SIZE = 20
+# minimal estimated similarity (0..1) of snippets listed as similar
+SIMILAR_SNIPPETS_THRESHOLD = 0.5
+# number of similar snippets shown on the snippet page
+SIMILAR_SNIPPETS_LIMIT = 5
+# number of LSH candidates whose signatures are compared per query
+SIMILAR_SNIPPETS_CANDIDATES = 200
+# longest code (characters) indexed in full: the MinHash signature of longer
+# snippets is built from their beginning and their symbols are not extracted
+SNIPPET_INDEX_MAX_LENGTH = 64 * 1024
+# number of most active users shown on the stats dashboard
+STATS_TOP_USERS = 10
+
+# Pygments highlighting: style name and extra HtmlFormatter options
+PYGMENTS_STYLE = 'default'
+PYGMENTS_FORMATTER_OPTIONS = {}
+
+# part of the ETag of snippet pages: bump when their templates change
+# so that browsers stop revalidating pages rendered by the old ones
+SNIPPET_PAGE_VERSION = 1
+
+# lifetime of fingerprinted Pygments stylesheets in browser caches, seconds
+PYGMENTS_STYLESHEET_MAX_AGE = 365 * 24 * 60 * 60
+
+# full-page cache of snippet pages (see main.page_cache). The "pages" backend
+# must be shared by all web, worker and management command processes, or
+# invalidation in one process leaves stale pages in the others: the database
+# cache is shared and keeps invalidation in the saving transaction. Migration
+# 0013 creates the main_page_cache table; a different LOCATION needs
+# "manage.py createcachetable" on deploy. LocMemCache is only correct with a
+# single process; FileBasedCache or Redis work as well
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'main_page_cache',
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+PAGE_CACHE_ALIAS = 'pages'
+PAGE_CACHE_TIMEOUT = 10 * 60
+
+# number of latest timings per view and stage used for /metrics percentiles
+METRICS_WINDOW = 1000
+
+# threads used by async views (ASGI) for file reads, formatting and highlighting
+ASYNC_VIEW_WORKERS = 8
+
+# highlighted HTML cache: entries kept in process memory and bytes kept on disk
+HIGHLIGHT_CACHE_SIZE = 256
+HIGHLIGHT_CACHE_DISK_LIMIT = 256 * 1024 * 1024
+
+# background formatting: when enabled, formatter pages enqueue jobs processed
+# by `manage.py format_worker` instead of running formatters inside the request
+FORMAT_JOBS_ASYNC = False
+# format and highlight every variant of a snippet right after it is saved:
+# through the job queue when FORMAT_JOBS_ASYNC is on, else in a background thread
+WARM_ON_WRITE = False
+FORMAT_WORKERS = 2
+FORMAT_JOB_TIMEOUT = 60
+# how often the "pending" page reloads itself, seconds
+FORMAT_JOB_POLL_INTERVAL = 2
+
+# warm formatter processes (main.workers); 0 runs formatters in the calling process
+FORMATTER_POOL_SIZE = 0
+# per-job timeout, seconds
+FORMATTER_POOL_TIMEOUT = 30
+# a worker is recycled after this many jobs or this peak RSS, KiB
+FORMATTER_POOL_MAX_JOBS = 1000
+FORMATTER_POOL_MAX_MEMORY = 512 * 1024
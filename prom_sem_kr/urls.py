@@ -16,17 +16,25 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from main import views
+from main import async_views, views
 from django.contrib.auth import views as auth_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', views.index_page, name='index'),
     path('snippets/add', views.add_snippet_page, name='add_snippet'),
-    path('snippets/list', views.my_snippets_page, name='my_snippets'),
-    path('snippets/<int:snippet_id>', views.view_snippet_page, name='view_snippet'),
-    path('snippets/<int:snippet_id>/format/<str:utility>', views.view_formatted_code_page, name='view_format'),
+    path('snippets/list', async_views.my_snippets_page, name='my_snippets'),
+    path('snippets/search', views.search_page, name='search'),
+    path('snippets/symbols', views.symbols_page, name='symbols'),
+    path('snippets/stats', views.stats_page, name='stats'),
+    path('snippets/hash/<slug:digest>', views.find_snippet_by_hash, name='find_snippet_by_hash'),
+    path('snippets/<int:snippet_id>', async_views.view_snippet_page, name='view_snippet'),
+    path('snippets/<int:snippet_id>/raw', views.raw_snippet_page, name='raw_snippet'),
+    path('snippets/<int:snippet_id>/format/<str:utility>', async_views.view_formatted_code_page, name='view_format'),
+    path('snippets/<int:snippet_id>/format/<str:utility>/raw', views.raw_snippet_page, name='raw_format'),
     path('snippets/<int:snippet_id>/delete', views.delete_snippet_page, name='delete_snippet'),
+    path('pygments/<slug:style>.<slug:fingerprint>.css', views.pygments_stylesheet, name='pygments_css'),
+    path('metrics', views.metrics_page, name='metrics'),
     path('login/', views.login_page, name='login'),
     path('logout/', views.logout_page, name='logout'),
 ]